@@ -0,0 +1,200 @@
+"""
+Global searchのartifactを読み込んだsessionのメモリ使用量のbenchmark
+
+    python -m benchmarks.artifact_memory --sessions 4 --entities 20000 --dim 1536
+
+sessionごとに1つのprocessを立ち上げ、全processが読み込みを終えた時点のRSSとPSSを比べる。
+data RSSは読み込みの前後のRSSの差で、importの分を含まない。
+PSSは共有しているページをprocess数で割った値で、memory-mapしたArrowのバッファはここで分け合われる。
+
+baseline: parquetを全列読み、全report・entityのオブジェクトを作る
+columnar: load_global_search_data (必要な列だけをmemory-mapし、オブジェクトは参照時に作る)
+"""
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import psutil
+import tiktoken
+from graphrag.query.indexer_adapters import read_indexer_entities, read_indexer_reports
+
+from pages.util.engine_cache import artifacts_dir
+from pages.util.graph_search import (
+    RankedGlobalCommunityContext,
+    load_global_search_data,
+)
+from pages.util.report_ranking import ReportRanker
+
+CONTEXT_PARAMS = {
+    "use_community_summary": False,
+    "include_community_rank": True,
+    "community_weight_name": "occurrence weight",
+    "max_tokens": 8000,
+    "top_k_reports": None,
+    "report_token_budget": 64000,
+}
+
+
+def write_synthetic_artifacts(
+    root: str, n_entities: int, n_reports: int, dim: int, seed: int = 0
+):
+    rng = np.random.default_rng(seed)
+    titles = [f"ENTITY_{i}" for i in range(n_entities)]
+    text_unit_ids = [f"text_unit_{i}" for i in range(n_entities // 4 + 1)]
+    nodes = []
+    for level, n_communities in enumerate([n_reports // 2, n_reports - n_reports // 2]):
+        offset = level * (n_reports // 2)
+        nodes.append(
+            pd.DataFrame(
+                {
+                    "title": titles,
+                    "level": level,
+                    "community": (
+                        offset + rng.integers(0, n_communities, n_entities)
+                    ).astype(str),
+                    "degree": rng.integers(1, 20, n_entities),
+                }
+            )
+        )
+    entities = pd.DataFrame(
+        {
+            "id": [f"entity_{i}" for i in range(n_entities)],
+            "name": titles,
+            "type": "PERSON",
+            "description": [f"{title} is an entity of the graph." for title in titles],
+            "human_readable_id": np.arange(n_entities),
+            "text_unit_ids": [
+                list(rng.choice(text_unit_ids, 3)) for _ in range(n_entities)
+            ],
+            "description_embedding": list(
+                rng.standard_normal((n_entities, dim)).astype(np.float64)
+            ),
+        }
+    )
+    communities = [str(i) for i in range(n_reports)]
+    reports = pd.DataFrame(
+        {
+            "community": communities,
+            "level": [0] * (n_reports // 2) + [1] * (n_reports - n_reports // 2),
+            "title": [f"Community {c}" for c in communities],
+            "summary": [f"Summary of community {c}." for c in communities],
+            "full_content": [
+                f"# Community {c}\n\n" + "The members work together. " * 200
+                for c in communities
+            ],
+            "rank": rng.uniform(1, 10, n_reports),
+        }
+    )
+    data_dir = artifacts_dir(root)
+    os.makedirs(data_dir, exist_ok=True)
+    pd.concat(nodes, ignore_index=True).to_parquet(
+        f"{data_dir}/create_final_nodes.parquet"
+    )
+    entities.to_parquet(f"{data_dir}/create_final_entities.parquet")
+    reports.to_parquet(f"{data_dir}/create_final_community_reports.parquet")
+
+
+def load_baseline(root: str):
+    """The loader this benchmark replaces: whole tables and all objects in memory."""
+    data_dir = artifacts_dir(root)
+    final_nodes = pd.read_parquet(f"{data_dir}/create_final_nodes.parquet")
+    final_entities = pd.read_parquet(f"{data_dir}/create_final_entities.parquet")
+    final_community_reports = pd.read_parquet(
+        f"{data_dir}/create_final_community_reports.parquet"
+    )
+    reports = read_indexer_reports(final_community_reports, final_nodes, 2)
+    entities = read_indexer_entities(final_nodes, final_entities, 2)
+    token_encoder = tiktoken.get_encoding("cl100k_base")
+    ranker = ReportRanker(reports, entities, token_encoder)
+    return reports, entities, token_encoder, ranker
+
+
+def load_columnar(root: str):
+    data = load_global_search_data(root)
+    return data.reports, data.entities, data.token_encoder, data.report_ranker
+
+
+def session(root: str, mode: str, barrier, results) -> None:
+    # importだけで使うメモリは両方で同じため、読み込みの前のRSSを差し引く
+    rss_before = psutil.Process().memory_info().rss
+    start = time.perf_counter()
+    reports, entities, token_encoder, ranker = (
+        load_baseline(root) if mode == "baseline" else load_columnar(root)
+    )
+    context_builder = RankedGlobalCommunityContext(
+        community_reports=reports,
+        ranker=ranker,
+        entities=entities,
+        token_encoder=token_encoder,
+    )
+    context_builder.build_context(query="community members", **CONTEXT_PARAMS)
+    load_time = time.perf_counter() - start
+
+    # 全sessionが読み込みを終えてから計測する
+    barrier.wait()
+    memory = psutil.Process().memory_full_info()
+    results.put(
+        (
+            load_time,
+            memory.rss - rss_before,
+            memory.rss,
+            getattr(memory, "pss", memory.rss),
+        )
+    )
+    barrier.wait()
+
+
+def run_sessions(root: str, mode: str, n_sessions: int) -> list[tuple]:
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(n_sessions)
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(target=session, args=(root, mode, barrier, results))
+        for _ in range(n_sessions)
+    ]
+    for process in processes:
+        process.start()
+    measurements = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return measurements
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=4)
+    parser.add_argument("--entities", type=int, default=20000)
+    parser.add_argument("--reports", type=int, default=1000)
+    parser.add_argument("--dim", type=int, default=1536)
+    args = parser.parse_args()
+
+    # load_global_search_dataはconfig/graphrag.yamlを読むため、repoのrootで実行する
+    with tempfile.TemporaryDirectory() as root:
+        write_synthetic_artifacts(root, args.entities, args.reports, args.dim)
+        # columnarの変換は初回だけ行われるため、計測の前に済ませておく
+        load_columnar(root)
+
+        print(
+            f"sessions={args.sessions} entities={args.entities}"
+            f" reports={args.reports} dim={args.dim}"
+        )
+        for mode in ["baseline", "columnar"]:
+            measurements = run_sessions(root, mode, args.sessions)
+            load_time = max(m[0] for m in measurements)
+            data_rss = sum(m[1] for m in measurements) / 1024**2
+            rss = sum(m[2] for m in measurements) / 1024**2
+            pss = sum(m[3] for m in measurements) / 1024**2
+            print(
+                f"{mode:9}: load {load_time:6.2f} s,"
+                f" data RSS {data_rss / args.sessions:7.1f} MB/session,"
+                f" RSS total {rss:8.1f} MB, PSS total {pss:8.1f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,415 @@
+"""
+検索・可視化・side-by-sideの処理を、合成したGraphStoreとローカルのfake serverで通して計るbenchmark
+
+    python -m benchmarks.e2e_query --entities 2000 --communities 100 --queries 20 \\
+        --concurrency 4 --latency 0.2 --jitter 0.05
+
+global_load    : create_global_search_engine (cold: artifactの読み込み / warm: engine_cacheから)
+global_asearch : asearch (community contextの作成・map・reduce用のcontextの作成)
+reduce         : _reduce_response (map結果からreduce用のcontextを作る)
+local_asearch  : local searchのasearch (クエリのembeddingとcontextの作成)
+viz_payload    : load_graph_payload (全体表示のpayload、cold)
+viz_lod        : community_overview・expand_community・k_hop
+viz_filter     : GraphFilterIndex.query
+side_by_side   : 2つのAssistantの回答と、global search→回答の3つを並行に行う
+
+シナリオごとにp50・p95・平均のlatency、throughput、処理中のRSSの増加の最大値を出し、
+結果をbenchmarks/results/{日時}_{commit}.jsonに保存する。--compareで以前の結果と比べる。
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+from collections.abc import Awaitable, Callable
+from datetime import datetime
+
+import numpy as np
+import psutil
+
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.reduce_context import synthetic_map_responses
+from benchmarks.synthetic_artifacts import write_synthetic_artifacts
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+SCENARIOS = [
+    "global_load",
+    "global_asearch",
+    "reduce",
+    "local_asearch",
+    "viz_payload",
+    "viz_lod",
+    "viz_filter",
+    "side_by_side",
+]
+API_KEY = "sk-benchmark"
+LLM_MODEL = "gpt-4o-mini"
+QUERY_TEMPLATES = [
+    "ENTITY_{}はどのような組織と関係がありますか?",
+    "What is the role of ENTITY_{} in the community?",
+    "ENTITY_{}に関する主要な出来事をまとめてください",
+    "Summarize the relationships of ENTITY_{}.",
+]
+
+
+class PeakRSS:
+    """処理中のRSSを別threadで一定間隔に読み、開始時からの増加の最大値を記録する"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self.start_rss = 0
+        self.peak_rss = 0
+
+    def __enter__(self) -> "PeakRSS":
+        self.start_rss = self.peak_rss = self._process.memory_info().rss
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, self._process.memory_info().rss)
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, self._process.memory_info().rss)
+
+    @property
+    def peak_delta_mb(self) -> float:
+        return (self.peak_rss - self.start_rss) / 1024**2
+
+
+def summarize(latencies: list[float], elapsed: float) -> dict:
+    values = np.array(latencies) * 1000
+    return {
+        "n": len(latencies),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "mean_ms": float(values.mean()),
+        "throughput_per_s": len(latencies) / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def measure(func: Callable[[int], object], n: int) -> dict:
+    """Call `func(i)` `n` times in sequence."""
+    latencies = []
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        for i in range(n):
+            call_start = time.perf_counter()
+            func(i)
+            latencies.append(time.perf_counter() - call_start)
+        elapsed = time.perf_counter() - start
+    return {**summarize(latencies, elapsed), "peak_rss_mb": rss.peak_delta_mb}
+
+
+def measure_async(
+    func: Callable[[int], Awaitable[object]], n: int, concurrency: int
+) -> dict:
+    """Run `func(i)` for `n` values of i on one event loop, `concurrency` at a time."""
+    from pages.util import openai_clients
+
+    latencies = []
+
+    async def _run_all() -> None:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def _run(i: int) -> None:
+            async with semaphore:
+                call_start = time.perf_counter()
+                await func(i)
+                latencies.append(time.perf_counter() - call_start)
+
+        await asyncio.gather(*(_run(i) for i in range(n)))
+
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        openai_clients.run(_run_all())
+        elapsed = time.perf_counter() - start
+    return {**summarize(latencies, elapsed), "peak_rss_mb": rss.peak_delta_mb}
+
+
+def queries(n: int, n_entities: int) -> list[str]:
+    return [
+        QUERY_TEMPLATES[i % len(QUERY_TEMPLATES)].format(i * 7919 % n_entities)
+        for i in range(n)
+    ]
+
+
+def run_scenarios(root: str, args: argparse.Namespace, server: FakeOpenAIServer):
+    # fake serverのURLを使わせるため、clientを作るmoduleはここでimportする
+    from pages.util import graph_search, openai_clients, rate_limiter
+    from pages.util import streamlit_components as stc
+    from pages.util.engine_cache import engine_cache
+    from pages.util.graph_filter import GraphFilter, load_graph_filter_index
+    from pages.util.graph_lod import load_graph_lod_index
+    from pages.util.graph_payload import load_graph_payload, payload_cache
+
+    # fake serverには上限がないため、--rate-limitsを指定しない限りrate limiterで待たせない
+    requests_per_minute, tokens_per_minute = (
+        rate_limiter.read_rate_limits(args.config) if args.rate_limits else (0, 0)
+    )
+    rate_limiter.set_rate_limiter(
+        rate_limiter.RateLimiter(requests_per_minute, tokens_per_minute)
+    )
+
+    results = {}
+    query_list = queries(args.queries, args.entities)
+    selected = set(args.scenarios)
+
+    def _report(name: str, result: dict) -> None:
+        results[name] = result
+        print(
+            f"{name:<22} n={result['n']:<4} p50 {result['p50_ms']:9.1f} ms"
+            f"  p95 {result['p95_ms']:9.1f} ms"
+            f"  {result['throughput_per_s']:8.2f}/s"
+            f"  peak +{result['peak_rss_mb']:7.1f} MB"
+        )
+
+    def _create_global_engine():
+        engine = graph_search.create_global_search_engine(
+            root, API_KEY, LLM_MODEL, args.config
+        )
+        # 同じクエリでもmapを毎回通すよう、map結果のキャッシュは使わない
+        engine.map_cache = None
+        return engine
+
+    if "global_load" in selected:
+
+        def _cold(i: int) -> None:
+            engine_cache.clear()
+            _create_global_engine()
+
+        _report("global_load.cold", measure(_cold, args.repeat))
+        _report(
+            "global_load.warm",
+            measure(lambda i: _create_global_engine(), args.repeat * 10),
+        )
+
+    engine = _create_global_engine()
+    if "global_asearch" in selected:
+        _report(
+            "global_asearch",
+            measure_async(
+                lambda i: engine.asearch(query_list[i]), args.queries, args.concurrency
+            ),
+        )
+
+    if "reduce" in selected:
+        map_responses = synthetic_map_responses(args.map_batches, args.map_points)
+        _report(
+            "reduce",
+            measure_async(
+                lambda i: engine._reduce_response(map_responses, query_list[i]),
+                args.queries,
+                1,
+            ),
+        )
+
+    if "local_asearch" in selected:
+        local_engine = graph_search.create_local_search_engine(
+            root, API_KEY, LLM_MODEL, args.config
+        )
+        _report(
+            "local_asearch",
+            measure_async(
+                lambda i: local_engine.asearch(query_list[i]),
+                args.queries,
+                args.concurrency,
+            ),
+        )
+
+    if "viz_payload" in selected:
+
+        def _payload(i: int) -> None:
+            payload_cache.clear()
+            _ = load_graph_payload(root, level=i % 2).data_json
+
+        _report("viz_payload.cold", measure(_payload, args.repeat))
+
+    if "viz_lod" in selected:
+        lod = load_graph_lod_index(root)
+        communities = [str(c) for c in range(args.communities)]
+        _report(
+            "viz_lod.overview",
+            measure(lambda i: lod.community_overview(i % 2), args.queries),
+        )
+        _report(
+            "viz_lod.expand",
+            measure(
+                lambda i: lod.expand_community(0, communities[i % len(communities)]),
+                args.queries,
+            ),
+        )
+        _report(
+            "viz_lod.k_hop",
+            measure(
+                lambda i: lod.k_hop(f"ENTITY_{i * 7919 % args.entities}", k=2),
+                args.queries,
+            ),
+        )
+
+    if "viz_filter" in selected:
+        filter_index = load_graph_filter_index(root)
+        filters = [
+            GraphFilter(level=0, min_degree=5),
+            GraphFilter(level=1, entity_types=["PERSON", "GEO"], min_weight=5.0),
+            GraphFilter(level=0, communities=["1", "2", "3"]),
+            GraphFilter(title_prefix="ENTITY_1"),
+        ]
+        _report(
+            "viz_filter",
+            measure(
+                lambda i: filter_index.query(filters[i % len(filters)]), args.queries
+            ),
+        )
+
+    if "side_by_side" in selected:
+        async_client = openai_clients.get_async_openai_client(API_KEY)
+
+        async def _side_by_side(i: int) -> None:
+            query = query_list[i]
+
+            async def _graphrag() -> str:
+                context = await engine.asearch(query)
+                return await stc.create_assistant_reply_async(
+                    async_client, "asst_graphrag", f"thread_graphrag_{i}", context
+                )
+
+            await asyncio.gather(
+                stc.create_assistant_reply_async(
+                    async_client, "asst_left", f"thread_left_{i}", query
+                ),
+                stc.create_assistant_reply_async(
+                    async_client, "asst_center", f"thread_center_{i}", query
+                ),
+                _graphrag(),
+            )
+
+        _report(
+            "side_by_side",
+            measure_async(_side_by_side, args.queries, args.concurrency),
+        )
+
+    return results
+
+
+def git_revision() -> dict:
+    def _git(*command: str) -> str:
+        try:
+            return subprocess.run(
+                ["git", *command],
+                capture_output=True,
+                text=True,
+                check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return ""
+
+    return {
+        "commit": _git("rev-parse", "--short", "HEAD"),
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+    }
+
+
+def compare(results: dict, baseline_path: str) -> None:
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\ncompared with {baseline_path} ({baseline['git']['commit']})")
+    for name, result in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        ratios = "  ".join(
+            f"{metric} {result[metric] / before[metric]:5.2f}x"
+            for metric in ["p50_ms", "p95_ms"]
+            if before[metric] > 0
+        )
+        print(f"{name:<22} {ratios}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entities", type=int, default=2000)
+    parser.add_argument("--communities", type=int, default=100)
+    parser.add_argument("--relationships", type=int, default=8000)
+    parser.add_argument("--text-units", type=int, default=500)
+    parser.add_argument("--report-words", type=int, default=400)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3, help="for cold loads")
+    parser.add_argument("--map-batches", type=int, default=50)
+    parser.add_argument("--map-points", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="seconds")
+    parser.add_argument("--stream-deltas", type=int, default=50)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--config", default="config/graphrag.yaml")
+    parser.add_argument(
+        "--rate-limits",
+        action="store_true",
+        help="apply query_rate_limits of --config",
+    )
+    parser.add_argument("--output", help="default: benchmarks/results/")
+    parser.add_argument("--compare", help="result file of a previous run")
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        root = stack.enter_context(tempfile.TemporaryDirectory())
+        write_synthetic_artifacts(
+            root,
+            n_entities=args.entities,
+            n_communities=args.communities,
+            n_relationships=args.relationships,
+            n_text_units=args.text_units,
+            report_words=args.report_words,
+            dim=args.dim,
+        )
+        server = stack.enter_context(
+            FakeOpenAIServer(
+                latency=args.latency,
+                jitter=args.jitter,
+                embedding_dim=args.dim,
+                stream_deltas=args.stream_deltas,
+            )
+        )
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        results = run_scenarios(root, args, server)
+        fake_requests = server.requests
+
+    record = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "git": git_revision(),
+        "python": platform.python_version(),
+        "params": {key: value for key, value in vars(args).items() if key != "compare"},
+        "fake_requests": fake_requests,
+        "results": results,
+    }
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(
+            RESULTS_DIR, f"{timestamp}_{record['git']['commit'] or 'unknown'}.json"
+        )
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(record, f, ensure_ascii=False, indent=2)
+    print(f"\n{fake_requests} requests to the fake server, saved to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
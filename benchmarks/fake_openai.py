@@ -0,0 +1,193 @@
+"""
+benchmark用の、OpenAI互換のローカルのfake server
+
+chat completions・embeddings・Assistants APIのmessage作成とstreamingのrunに応答する。
+応答の内容と遅延はrequestの内容のhashから決まるため、同じ入力には毎回同じ応答を返す。
+
+    with FakeOpenAIServer(latency=0.2, jitter=0.05) as server:
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+"""
+
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+class FakeOpenAIServer:
+    def __init__(
+        self,
+        latency: float = 0.2,
+        jitter: float = 0.05,
+        embedding_dim: int = 1536,
+        stream_deltas: int = 50,
+        delta_interval: float = 0.005,
+        points_per_map: int = 5,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.embedding_dim = embedding_dim
+        self.stream_deltas = stream_deltas
+        self.delta_interval = delta_interval
+        self.points_per_map = points_per_map
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server: ThreadingHTTPServer | None = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}/v1"
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("content-length", 0)))
+                server.handle(self, body)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _rng(self, body: bytes) -> random.Random:
+        return random.Random(hashlib.sha256(body).digest())
+
+    def handle(self, handler: BaseHTTPRequestHandler, body: bytes) -> None:
+        with self._lock:
+            self.requests += 1
+        rng = self._rng(body)
+        time.sleep(max(self.latency + rng.uniform(-self.jitter, self.jitter), 0))
+        data = json.loads(body) if body else {}
+        path = handler.path.split("?")[0]
+        if path.endswith("/chat/completions"):
+            self._json(handler, self._chat_completion(data, rng))
+        elif path.endswith("/embeddings"):
+            self._json(handler, self._embeddings(data, rng))
+        elif path.endswith("/messages"):
+            self._json(handler, self._message(path, data))
+        elif path.endswith("/runs") and data.get("stream"):
+            self._stream_run(handler, rng)
+        else:
+            handler.send_error(404)
+
+    def _json(self, handler: BaseHTTPRequestHandler, payload: dict) -> None:
+        data = json.dumps(payload).encode()
+        handler.send_response(200)
+        handler.send_header("content-type", "application/json")
+        handler.send_header("content-length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def _chat_completion(self, data: dict, rng: random.Random) -> dict:
+        system = data["messages"][0]["content"]
+        if "---Data tables---" in system:
+            # global searchのmap: key pointのJSON
+            content = json.dumps(
+                {
+                    "points": [
+                        {
+                            "description": f"Key point {rng.randint(0, 9999)} "
+                            + "about the community. " * rng.randint(3, 20)
+                            + "[Data: Reports (1, 2)]",
+                            "score": rng.randint(0, 100),
+                        }
+                        for _ in range(self.points_per_map)
+                    ]
+                }
+            )
+        else:
+            content = "The answer is based on the reports. " * rng.randint(5, 20)
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": data.get("model", "fake"),
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": content},
+                }
+            ],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+
+    def _embeddings(self, data: dict, rng: random.Random) -> dict:
+        inputs = data["input"] if isinstance(data["input"], list) else [data["input"]]
+        dim = data.get("dimensions") or self.embedding_dim
+        vectors = np.random.default_rng(rng.getrandbits(64)).standard_normal(
+            (len(inputs), dim)
+        )
+        return {
+            "object": "list",
+            "model": data.get("model", "fake"),
+            "data": [
+                {"object": "embedding", "index": index, "embedding": vector.tolist()}
+                for index, vector in enumerate(vectors)
+            ],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }
+
+    def _message(self, path: str, data: dict) -> dict:
+        return {
+            "id": "msg_fake",
+            "object": "thread.message",
+            "created_at": int(time.time()),
+            "thread_id": path.split("/threads/")[1].split("/")[0],
+            "role": data.get("role", "user"),
+            "content": [],
+            "status": "completed",
+            "attachments": [],
+            "metadata": {},
+            "assistant_id": None,
+            "run_id": None,
+            "completed_at": None,
+            "incomplete_at": None,
+            "incomplete_details": None,
+        }
+
+    def _stream_run(self, handler: BaseHTTPRequestHandler, rng: random.Random) -> None:
+        handler.send_response(200)
+        handler.send_header("content-type", "text/event-stream")
+        handler.send_header("transfer-encoding", "chunked")
+        handler.end_headers()
+
+        def _chunk(data: bytes) -> None:
+            handler.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            handler.wfile.flush()
+
+        for _ in range(self.stream_deltas):
+            time.sleep(self.delta_interval)
+            event = {
+                "id": "msg_fake",
+                "object": "thread.message.delta",
+                "delta": {
+                    "content": [
+                        {
+                            "index": 0,
+                            "type": "text",
+                            "text": {"value": f"token{rng.randint(0, 99)} "},
+                        }
+                    ]
+                },
+            }
+            _chunk(
+                f"event: thread.message.delta\ndata: {json.dumps(event)}\n\n".encode()
+            )
+        _chunk(b"event: done\ndata: [DONE]\n\n")
+        _chunk(b"")
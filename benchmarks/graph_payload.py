@@ -0,0 +1,141 @@
+"""
+可視化ページの全体表示で、描画用のpayloadができるまでの時間のbenchmark
+
+    python -m benchmarks.graph_payload --entities 20000 --edges 100000
+
+baseline: parquetを読み、iterrowsでNode・Edgeを作り、agraph()と同様にjson.dumpsする
+cold    : load_graph_payload (列ごとに変換し、JSONを1度だけ作成する)
+warm    : 別sessionからの2回目以降 (payload_cacheのpayloadを再利用する)
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from pages.util.engine_cache import artifacts_dir
+from pages.util.graph_payload import load_graph_payload, payload_cache
+
+
+def write_synthetic_graph(root: str, n_entities: int, n_edges: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    titles = [f"ENTITY_{i}" for i in range(n_entities)]
+    levels = []
+    for level, n_communities in enumerate(
+        [max(n_entities // 40, 1), max(n_entities // 200, 1)]
+    ):
+        levels.append(
+            pd.DataFrame(
+                {
+                    "title": titles,
+                    "level": level,
+                    "community": rng.integers(0, n_communities, n_entities).astype(str),
+                    "size": rng.integers(1, 10, n_entities),
+                    "degree": rng.integers(1, 10, n_entities),
+                    "description": [f"description of {title}" for title in titles],
+                }
+            )
+        )
+    words = ["works with", "is part of", "located in", "met", "関係がある"]
+    relationships = pd.DataFrame(
+        {
+            "source": rng.choice(titles, n_edges),
+            "target": rng.choice(titles, n_edges),
+            "weight": rng.random(n_edges) * 5,
+            "description": [
+                " ".join(random.Random(i).choices(words, k=8)) for i in range(n_edges)
+            ],
+            "id": [f"rel_{i}" for i in range(n_edges)],
+        }
+    )
+    data_dir = artifacts_dir(root)
+    os.makedirs(data_dir, exist_ok=True)
+    pd.concat(levels, ignore_index=True).to_parquet(
+        f"{data_dir}/create_final_nodes.parquet"
+    )
+    relationships.to_parquet(f"{data_dir}/create_final_relationships.parquet")
+
+
+def baseline_payload(root: str, level: int) -> str:
+    """The iterrows implementation this benchmark replaces (Node/Edge.__dict__ as dicts)."""
+    colors = [
+        "crimson",
+        "darkorange",
+        "indigo",
+        "cornflowerblue",
+        "cyan",
+        "teal",
+        "green",
+    ]
+    data_dir = artifacts_dir(root)
+    entity_df = pd.read_parquet(f"{data_dir}/create_final_nodes.parquet")
+    relationship_df = pd.read_parquet(f"{data_dir}/create_final_relationships.parquet")
+    entity_df = entity_df[entity_df["level"] == level]
+
+    nodes = []
+    for _, row in entity_df.iterrows():
+        nodes.append(
+            {
+                "id": row["title"],
+                "title": row["title"],
+                "label": row["title"],
+                "shape": "dot",
+                "size": 4 + row["size"] * 4,
+                "color": colors[int(row["community"]) % len(colors)],
+            }
+        )
+    edges = []
+    for _, row in relationship_df.iterrows():
+        edges.append(
+            {
+                "source": row["source"],
+                "from": row["source"],
+                "to": row["target"],
+                "color": "#F7A7A6",
+                "title": row.get("description", ""),
+                "width": row["weight"] * 2,
+            }
+        )
+    return json.dumps({"nodes": nodes, "edges": edges}, default=int)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entities", type=int, default=20000)
+    parser.add_argument("--edges", type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        write_synthetic_graph(root, args.entities, args.edges)
+
+        start = time.perf_counter()
+        baseline = baseline_payload(root, level=0)
+        baseline_time = time.perf_counter() - start
+
+        payload_cache.clear()
+        start = time.perf_counter()
+        payload = load_graph_payload(root, level=0)
+        data_json = payload.data_json
+        cold_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        data_json = load_graph_payload(root, level=0).data_json
+        warm_time = time.perf_counter() - start
+
+        assert json.loads(data_json) == json.loads(baseline)
+
+    print(
+        f"entities={args.entities} edges={args.edges} payload={len(data_json) / 1024**2:.1f}MB"
+    )
+    print(f"baseline : {baseline_time * 1000:9.1f} ms")
+    print(f"cold     : {cold_time * 1000:9.1f} ms ({baseline_time / cold_time:.1f}x)")
+    print(f"warm     : {warm_time * 1000:9.1f} ms ({baseline_time / warm_time:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+_reduce_responseのmicro-benchmark
+
+    python -m benchmarks.reduce_context --batches 200 --points 20
+
+one-shot : 全batchのmap結果からreduce用の入力を一度だけ作る
+streaming: astream_contextと同様に、batchが届くたびに入力を作り直す
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+import tiktoken
+from graphrag.query.llm.text_utils import num_tokens
+from graphrag.query.structured_search.base import SearchResult
+
+from pages.util.graph_search import GlobalSearchForAssistantsAPI
+from pages.util.key_points import KeyPointHeap
+
+
+def synthetic_map_responses(
+    n_batches: int, n_points: int, seed: int = 0
+) -> list[SearchResult]:
+    rng = random.Random(seed)
+    words = ["graph", "community", "entity", "report", "関係", "人物", "組織"]
+    return [
+        SearchResult(
+            response=[
+                {
+                    "answer": " ".join(rng.choices(words, k=rng.randint(5, 30))),
+                    "score": rng.randint(0, 100),
+                }
+                for _ in range(n_points)
+            ],
+            context_data="",
+            context_text="",
+            completion_time=0,
+            llm_calls=1,
+            prompt_tokens=0,
+        )
+        for _ in range(n_batches)
+    ]
+
+
+def baseline_reduce_context(
+    engine: GlobalSearchForAssistantsAPI, map_responses: list[SearchResult], query: str
+) -> str:
+    """The dict + sort + double num_tokens implementation this benchmark replaces."""
+    key_points = []
+    for index, response in enumerate(map_responses):
+        for element in response.response:
+            key_points.append(
+                {
+                    "analyst": index,
+                    "answer": element["answer"],
+                    "score": element["score"],
+                }
+            )
+    filtered_key_points = [point for point in key_points if point["score"] > 0]
+    filtered_key_points = sorted(
+        filtered_key_points, key=lambda x: x["score"], reverse=True
+    )
+    data = []
+    total_tokens = 0
+    for point in filtered_key_points:
+        formatted_response_text = "\n".join(
+            [
+                f"----Analyst {point['analyst'] + 1}----",
+                f"Importance Score: {point['score']}",
+                point["answer"],
+            ]
+        )
+        if (
+            total_tokens + num_tokens(formatted_response_text, engine.token_encoder)
+            > engine.max_data_tokens
+        ):
+            break
+        data.append(formatted_response_text)
+        total_tokens += num_tokens(formatted_response_text, engine.token_encoder)
+    search_prompt = engine.reduce_system_prompt.format(
+        report_data="\n\n".join(data), response_type=engine.response_type
+    )
+    return f"{search_prompt}---User Questions---\n\n{query}"
+
+
+def _best_of(repeat: int, func) -> tuple[float, str]:
+    best = float("inf")
+    result = ""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batches", type=int, default=200)
+    parser.add_argument("--points", type=int, default=20)
+    parser.add_argument("--max-data-tokens", type=int, default=12000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    engine = GlobalSearchForAssistantsAPI(
+        llm=None,  # type: ignore
+        context_builder=None,  # type: ignore
+        token_encoder=tiktoken.get_encoding("cl100k_base"),
+        json_mode=False,
+        max_data_tokens=args.max_data_tokens,
+    )
+    map_responses = synthetic_map_responses(args.batches, args.points)
+    query = "主要な登場人物の関係は?"
+
+    baseline_time, expected = _best_of(
+        args.repeat, lambda: baseline_reduce_context(engine, map_responses, query)
+    )
+    loop = asyncio.new_event_loop()
+    new_time, actual = _best_of(
+        args.repeat,
+        lambda: loop.run_until_complete(engine._reduce_response(map_responses, query)),
+    )
+    assert actual == expected, "reduce context differs from the baseline"
+
+    def baseline_streaming() -> str:
+        context = ""
+        for n in range(1, len(map_responses) + 1):
+            context = baseline_reduce_context(engine, map_responses[:n], query)
+        return context
+
+    def heap_streaming() -> str:
+        key_points = KeyPointHeap()
+        context = ""
+        for index, response in enumerate(map_responses):
+            key_points.push(index, response)
+            context = engine._build_reduce_context(key_points, query)
+        return context
+
+    baseline_stream_time, expected = _best_of(1, baseline_streaming)
+    stream_time, actual = _best_of(1, heap_streaming)
+    assert actual == expected, "streamed reduce context differs from the baseline"
+
+    print(f"key points : {args.batches * args.points}")
+    print("            baseline     heap+batch  speedup")
+    print(
+        f"one-shot  : {baseline_time * 1000:8.2f} ms  {new_time * 1000:8.2f} ms"
+        f"  {baseline_time / new_time:6.2f}x"
+    )
+    print(
+        f"streaming : {baseline_stream_time * 1000:8.2f} ms  "
+        f"{stream_time * 1000:8.2f} ms  {baseline_stream_time / stream_time:6.2f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+benchmark用に、indexingの出力と同じschemaのparquetを乱数で作る
+
+create_final_nodes・entities・community_reports・relationships・text_units・covariatesを、
+ページが読むのと同じ列で`{root}/output/default/artifacts`に書き出す。
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from pages.util.engine_cache import artifacts_dir
+
+WORDS = ["graph", "community", "entity", "report", "組織", "人物", "関係", "会議"]
+ENTITY_TYPES = ["PERSON", "ORGANIZATION", "GEO", "EVENT"]
+
+
+def _sentences(rng: np.random.Generator, n: int, min_words: int, max_words: int):
+    return [
+        " ".join(rng.choice(WORDS, rng.integers(min_words, max_words)))
+        for _ in range(n)
+    ]
+
+
+def write_synthetic_artifacts(
+    root: str,
+    n_entities: int = 2000,
+    n_communities: int = 100,
+    n_relationships: int = 8000,
+    n_text_units: int = 500,
+    report_words: int = 400,
+    dim: int = 1536,
+    seed: int = 0,
+) -> None:
+    """
+    Write a GraphStore of two community levels: `n_communities` communities at
+    level 0, grouped into `n_communities // 5` communities at level 1.
+    """
+    rng = np.random.default_rng(seed)
+    titles = np.array([f"ENTITY_{i}" for i in range(n_entities)])
+    entity_ids = [f"entity_{i}" for i in range(n_entities)]
+    entity_types = rng.choice(ENTITY_TYPES, n_entities)
+    text_unit_ids = [f"text_unit_{i}" for i in range(n_text_units)]
+    relationship_ids = [f"relationship_{i}" for i in range(n_relationships)]
+
+    n_parents = max(n_communities // 5, 1)
+    communities_0 = rng.integers(0, n_communities, n_entities)
+    parents = rng.integers(0, n_parents, n_communities)
+    communities_1 = n_communities + parents[communities_0]
+
+    sources = rng.integers(0, n_entities, n_relationships)
+    targets = rng.integers(0, n_entities, n_relationships)
+    degrees = np.bincount(
+        np.concatenate([sources, targets]), minlength=n_entities
+    ).astype(int)
+
+    descriptions = _sentences(rng, n_entities, 5, 20)
+    nodes = pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "id": entity_ids,
+                    "level": level,
+                    "title": titles,
+                    "type": entity_types,
+                    "description": descriptions,
+                    "source_id": [",".join(rng.choice(text_unit_ids, 2))] * n_entities,
+                    "community": communities.astype(str),
+                    "degree": degrees,
+                    "human_readable_id": np.arange(n_entities),
+                    "size": np.maximum(degrees, 1),
+                    "entity_type": entity_types,
+                    "top_level_node_id": entity_ids,
+                    "x": 0,
+                    "y": 0,
+                }
+            )
+            for level, communities in enumerate([communities_0, communities_1])
+        ],
+        ignore_index=True,
+    )
+
+    entities = pd.DataFrame(
+        {
+            "id": entity_ids,
+            "name": titles,
+            "type": entity_types,
+            "description": descriptions,
+            "human_readable_id": np.arange(n_entities),
+            "text_unit_ids": [
+                list(rng.choice(text_unit_ids, 3)) for _ in range(n_entities)
+            ],
+            "description_embedding": list(
+                rng.standard_normal((n_entities, dim)).astype(np.float64)
+            ),
+        }
+    )
+
+    communities = [str(c) for c in range(n_communities + n_parents)]
+    reports = pd.DataFrame(
+        {
+            "community": communities,
+            "full_content": [
+                f"# Community {c}\n\n"
+                + " ".join(rng.choice(WORDS, report_words))
+                + "\n"
+                for c in communities
+            ],
+            "level": [0] * n_communities + [1] * n_parents,
+            "rank": rng.uniform(1, 10, len(communities)),
+            "title": [f"Community {c}" for c in communities],
+            "rank_explanation": "synthetic",
+            "summary": _sentences(rng, len(communities), 10, 30),
+            "findings": [[] for _ in communities],
+            "full_content_json": "{}",
+            "id": [f"report_{c}" for c in communities],
+        }
+    )
+
+    relationships = pd.DataFrame(
+        {
+            "source": titles[sources],
+            "target": titles[targets],
+            "weight": rng.uniform(0, 10, n_relationships),
+            "description": _sentences(rng, n_relationships, 5, 15),
+            "text_unit_ids": [
+                list(rng.choice(text_unit_ids, 2)) for _ in range(n_relationships)
+            ],
+            "id": relationship_ids,
+            "human_readable_id": [str(i) for i in range(n_relationships)],
+            "source_degree": degrees[sources],
+            "target_degree": degrees[targets],
+            "rank": degrees[sources] + degrees[targets],
+        }
+    )
+
+    text_units = pd.DataFrame(
+        {
+            "id": text_unit_ids,
+            "text": _sentences(rng, n_text_units, 100, 300),
+            "n_tokens": 300,
+            "document_ids": [["document_0"]] * n_text_units,
+            "entity_ids": [list(rng.choice(entity_ids, 5)) for _ in text_unit_ids],
+            "relationship_ids": [
+                list(rng.choice(relationship_ids, 5)) for _ in text_unit_ids
+            ],
+        }
+    )
+
+    n_claims = max(n_entities // 20, 1)
+    covariates = pd.DataFrame(
+        {
+            "id": [str(i) for i in range(n_claims)],
+            "human_readable_id": [str(i) for i in range(n_claims)],
+            "covariate_type": "claim",
+            "type": "FACT",
+            "description": _sentences(rng, n_claims, 5, 15),
+            "subject_id": rng.choice(titles, n_claims),
+            "subject_type": "entity",
+            "object_id": "NONE",
+            "object_type": "NONE",
+            "status": "TRUE",
+            "start_date": "NONE",
+            "end_date": "NONE",
+            "source_text": "synthetic",
+            "text_unit_id": rng.choice(text_unit_ids, n_claims),
+            "document_ids": [["document_0"]] * n_claims,
+            "n_tokens": 10,
+        }
+    )
+
+    data_dir = artifacts_dir(root)
+    os.makedirs(data_dir, exist_ok=True)
+    for name, df in [
+        ("create_final_nodes", nodes),
+        ("create_final_entities", entities),
+        ("create_final_community_reports", reports),
+        ("create_final_relationships", relationships),
+        ("create_final_text_units", text_units),
+        ("create_final_covariates", covariates),
+    ]:
+        df.to_parquet(f"{data_dir}/{name}.parquet")
@@ -33,6 +33,9 @@ def main():
     )
     with st.container(border=True):
         st.page_link("pages/vizualization.py", icon="👓", use_container_width=True)
+        st.page_link(
+            "pages/indexing_profiles.py", icon="⏱️", use_container_width=True
+        )
 
 
 if __name__ == "__main__":
@@ -3,15 +3,21 @@ import random
 import string
 
 import streamlit as st
-from openai import OpenAI
 from openai.types import ChatModel
 
-from pages.util import graph_store
+from pages.util import (
+    graph_store,
+    indexing_jobs,
+    llm_cache,
+    openai_clients,
+    vector_store_upload,
+)
 from pages.util import streamlit_components as stc
+from pages.util.document_store import get_document_store
 
 
 def create_assistant(api_key):
-    client = OpenAI(api_key=api_key)
+    client = openai_clients.get_openai_client(api_key)
     assistant_id = None
 
     st.header("Create Assistant")
@@ -41,9 +47,6 @@ def create_assistant(api_key):
 
 
 def create_vector_store(api_key):
-    client = OpenAI(api_key=api_key)
-    vector_store_id = None
-
     st.header("Create VectorStore")
     with st.container(border=True):
         uploaded_files = st.file_uploader(
@@ -56,60 +59,142 @@ def create_vector_store(api_key):
             use_container_width=True,
             disabled=(len(uploaded_files) == 0),
         ):
-            tmp_file_paths = []
-            for uploaded_file in uploaded_files:
-                bytes_data = uploaded_file.getvalue()
-                location = f"./data/assistants_api/input/{uploaded_file.name}"
-                with open(location, "wb") as f:
-                    f.write(bytes_data)
-                tmp_file_paths.append(location)
-
-            file_streams = [open(path, "rb") for path in tmp_file_paths]
-            vector_store = client.beta.vector_stores.create(
-                name="RAG Demo",
-                expires_after={"anchor": "last_active_at", "days": 1},
-            )
-            client.beta.vector_stores.file_batches.upload_and_poll(
-                vector_store_id=vector_store.id, files=file_streams
+            # ファイルはchunkごとにディスクへ書き出し、アップロードはバックグラウンドで行う
+            local_files = [
+                vector_store_upload.save_upload(uploaded_file, uploaded_file.name)
+                for uploaded_file in uploaded_files
+            ]
+            upload_id = vector_store_upload.get_upload_manager().submit(
+                api_key, local_files
             )
-            vector_store_id = vector_store.id
+            st.session_state["vector_store_uploads"].append(upload_id)
 
-        if vector_store_id is not None:
-            st.success(f"VectorStore ID: {vector_store_id}")
+        vector_store_upload_status()
 
 
 def create_graph_store(api_key):
-    graph_store_id = None
-
     st.header("Create GraphStore")
     with st.container(border=True):
         uploaded_files = st.file_uploader(
             "RAGの対象ファイルをアップロード", accept_multiple_files=True, key="graph"
         )
+        # 既存のGraphStore IDを指定した場合は、そのGraphStoreに文書を追加して再indexingする
+        existing_graph_store_id = st.text_input(
+            "文書を追加するGraphStore ID (新規作成の場合は空欄)",
+            type="password",
+            placeholder="gs_****",
+        )
+        append = existing_graph_store_id != ""
+        if append and not (
+            len(existing_graph_store_id) == 27
+            and existing_graph_store_id.startswith("gs_")
+            and os.path.isdir(f"./data/graphrag/{existing_graph_store_id}/input")
+        ):
+            st.warning("指定されたGraphStoreが見つかりません。")
+            return
+
         if st.button(
-            "Create GraphStore",
+            "Append to GraphStore" if append else "Create GraphStore",
             use_container_width=True,
             disabled=(len(uploaded_files) == 0),
         ):
-            graph_store_id = "gs_" + "".join(
-                random.choices(string.ascii_letters + string.digits, k=24)
+            # 文書は内容のhashで1つだけ保存し、GraphStoreからはハードリンクで参照する
+            document_store = get_document_store()
+            files = {
+                uploaded_file.name: document_store.put(uploaded_file)
+                for uploaded_file in uploaded_files
+            }
+            # 同じ文書・設定でindexing済みのGraphStoreがあれば、indexingせずにそれを返す
+            existing_root = (
+                None if append else graph_store.find_graph_store(files, "gpt-4o-mini")
             )
-            os.makedirs(f"./data/graphrag/{graph_store_id}/input", exist_ok=True)
-
-            for uploaded_file in uploaded_files:
-                bytes_data = uploaded_file.getvalue()
-                location = (
-                    f"./data/graphrag/{graph_store_id}/input/{uploaded_file.name}"
+            if existing_root is not None:
+                st.success(
+                    "同じ文書のGraphStoreがあります。"
+                    f" GraphStore ID: {os.path.basename(existing_root)}"
                 )
-                with open(location, "wb") as f:
-                    f.write(bytes_data)
+            else:
+                if append:
+                    graph_store_id = existing_graph_store_id
+                else:
+                    graph_store_id = "gs_" + "".join(
+                        random.choices(string.ascii_letters + string.digits, k=24)
+                    )
+                document_store.link_inputs(f"./data/graphrag/{graph_store_id}", files)
+
+                # indexingはバックグラウンドで実行し、画面は進捗をポーリングする
+                job_id = indexing_jobs.get_job_manager().submit(
+                    f"./data/graphrag/{graph_store_id}",
+                    graph_store_id,
+                    api_key,
+                    "gpt-4o-mini",
+                    mode="append" if append else "create",
+                )
+                st.session_state["indexing_jobs"].append(job_id)
 
-            graph_store.create(
-                f"./data/graphrag/{graph_store_id}", api_key, "gpt-4o-mini"
-            )
+        indexing_job_status()
+
+        stats = llm_cache.get_indexing_cache().stats()
+        st.caption(
+            f"indexing cache: hit rate {stats['hit_rate']:.0%}"
+            f" ({stats['hits']} hits / {stats['misses']} misses),"
+            f" {stats['entries']} entries, {stats['bytes'] / 1024**2:.1f} MB"
+        )
 
-        if graph_store_id is not None:
-            st.success(f"GraphStore ID: {graph_store_id}")
+
+@st.fragment(run_every=1)
+def vector_store_upload_status():
+    upload_manager = vector_store_upload.get_upload_manager()
+    for upload_id in st.session_state["vector_store_uploads"]:
+        upload = upload_manager.get(upload_id)
+        if upload is None:
+            continue
+
+        if upload.status == vector_store_upload.SUCCEEDED:
+            st.success(f"VectorStore ID: {upload.vector_store_id}")
+        elif upload.status == vector_store_upload.FAILED:
+            st.error(f"VectorStoreの作成に失敗しました: {upload.error}")
+        else:
+            if upload.status == vector_store_upload.PROCESSING:
+                label = "VectorStoreでファイルを処理中"
+            else:
+                label = (
+                    f"アップロード中 ({upload.uploaded_files + upload.skipped_files}"
+                    f"/{upload.total_files} files,"
+                    f" {upload.uploaded_bytes / 1024**2:.1f}"
+                    f"/{upload.total_bytes / 1024**2:.1f} MB,"
+                    f" {upload.skipped_files} files skipped)"
+                )
+            st.progress(upload.progress, text=label)
+
+
+@st.fragment(run_every=2)
+def indexing_job_status():
+    job_manager = indexing_jobs.get_job_manager()
+    for job_id in st.session_state["indexing_jobs"]:
+        job = job_manager.get(job_id)
+        if job is None:
+            continue
+
+        if job.status == indexing_jobs.SUCCEEDED and job.run_id is None:
+            st.info(f"GraphStore {job.graph_store_id} の文書に変更はありませんでした")
+        elif job.status == indexing_jobs.SUCCEEDED:
+            st.success(f"GraphStore ID: {job.graph_store_id}")
+        elif job.status == indexing_jobs.FAILED:
+            st.error(f"GraphStore {job.graph_store_id} の作成に失敗しました: {job.error}")
+        elif job.status == indexing_jobs.CANCELLED:
+            st.warning(f"GraphStore {job.graph_store_id} の作成をキャンセルしました")
+        else:
+            label = (
+                "待機中"
+                if job.status == indexing_jobs.QUEUED
+                else f"indexing中 ({job.completed_workflows}/{job.total_workflows or '?'}"
+                f" workflows, {job.current_workflow or '-'})"
+            )
+            col1, col2 = st.columns([4, 1])
+            col1.progress(job.progress, text=f"{job.graph_store_id}: {label}")
+            if col2.button("Cancel", key=f"cancel_{job_id}"):
+                job_manager.cancel(job_id)
 
 
 def main():
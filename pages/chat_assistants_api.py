@@ -1,13 +1,13 @@
 import random
 
 import streamlit as st
-from openai import OpenAI
 
+from pages.util import openai_clients
 from pages.util import streamlit_components as stc
 
 
 def chat(api_key):
-    client = OpenAI(api_key=api_key)
+    client = openai_clients.get_openai_client(api_key)
     assistant_id, thread_id = stc.setting_assistant(client)
     if not assistant_id:
         return
@@ -1,20 +1,41 @@
 import random
 
 import streamlit as st
-from openai import OpenAI
 
-from pages.util import graph_search
+from pages.util import graph_search, openai_clients, tracing
 from pages.util import streamlit_components as stc
+from pages.util.answer_cache import get_answer_cache
+from pages.util.engine_cache import artifact_version
 
 
 def chat(api_key):
-    client = OpenAI(api_key=api_key)
+    client = openai_clients.get_openai_client(api_key)
     assistant_id, thread_id, graph_store_id = stc.setting_graprag(client)
     if not graph_store_id:
         return
-    search_engine = graph_search.create_global_search_engine(
-        f"./data/graphrag/{graph_store_id}", api_key, "gpt-4o-mini"
+    # Local searchは特定のentityに関する質問に向いており、mapを行わないため高速
+    search_mode = st.radio("Search mode", ["Global", "Local"], horizontal=True)
+    # 回答の再利用は、表記の違いを除いて同じ質問に限る
+    reuse_answers = st.toggle("同じ質問への以前の回答を再利用する", value=False)
+    create_search_engine = (
+        graph_search.create_global_search_engine
+        if search_mode == "Global"
+        else graph_search.create_local_search_engine
     )
+    root = f"./data/graphrag/{graph_store_id}"
+    # 再indexingでartifactが変わると、以前の回答はキャッシュから引かれなくなる
+    # 回答はassistantの指示によって変わるため、assistantごとに分ける
+    cache_key = (graph_store_id, search_mode, assistant_id)
+    cache_version = artifact_version(
+        root,
+        (
+            graph_search.GLOBAL_SEARCH_TABLES
+            if search_mode == "Global"
+            else graph_search.LOCAL_SEARCH_TABLES
+        ),
+        "config/graphrag.yaml",
+    )
+    answer_cache = get_answer_cache()
 
     if thread_id not in st.session_state:
         st.session_state[thread_id] = []
@@ -29,15 +50,64 @@ def chat(api_key):
             st.session_state[thread_id].append({"role": "user", "content": user_query})
 
         # アシスタントの回答を表示・会話履歴に追加
-        with st.chat_message("assistant"):
-            global_context = search_engine.search(user_query)
-            assistant_reply = stc.creat_assistant_reply(
-                client, assistant_id, thread_id, global_context
-            )
-
-            st.session_state[thread_id].append(
-                {"role": "assistant", "content": assistant_reply}
-            )
+        with st.chat_message("assistant"), tracing.trace(
+            "chat.graphrag",
+            {"graph_store": graph_store_id, "search_mode": search_mode},
+        ):
+            with tracing.span("answer_cache.lookup") as span:
+                hit = answer_cache.get(cache_key, cache_version, user_query)
+                span.set_attribute(
+                    "answer_cache.hit",
+                    "miss" if hit is None else "answer" if hit.answer else "context",
+                )
+            if hit is not None and hit.answer is not None and reuse_answers:
+                # threadの会話履歴がずれないよう、今回の質問と回答をthreadにも追加しておく。
+                # hit.contextはキャッシュしたcontextの末尾の質問を今回の質問に差し替えたもの
+                client.beta.threads.messages.create(
+                    thread_id=thread_id, role="user", content=hit.context
+                )
+                client.beta.threads.messages.create(
+                    thread_id=thread_id, role="assistant", content=hit.answer
+                )
+                st.markdown(hit.answer)
+                st.caption(f"キャッシュした回答 (「{hit.entry.query}」)")
+                assistant_reply = hit.answer
+            else:
+                if hit is not None:
+                    global_context = hit.context
+                else:
+                    # 検索が必要になったときだけengineを作る(2回目以降はengine_cacheから)
+                    search_engine = create_search_engine(root, api_key, "gpt-4o-mini")
+                    try:
+                        global_context = search_engine.search(user_query)
+                    except graph_search.ReduceContextError as e:
+                        # key pointsがreduceのcontextに1つも収まらない場合は回答を作らない
+                        st.error(f"検索結果から回答のcontextを作れませんでした: {e}")
+                        global_context = None
+                if global_context is None:
+                    assistant_reply = None
+                else:
+                    assistant_reply = stc.creat_assistant_reply(
+                        client, assistant_id, thread_id, global_context
+                    )
+                    answer_cache.put(
+                        cache_key,
+                        cache_version,
+                        user_query,
+                        global_context,
+                        assistant_reply,
+                    )
+                    if hit is not None:
+                        st.caption(
+                            f"キャッシュしたcontextを使用 (「{hit.entry.query}」)"
+                        )
+
+            if assistant_reply is not None:
+                st.session_state[thread_id].append(
+                    {"role": "assistant", "content": assistant_reply}
+                )
+
+    stc.trace_panel()
 
 
 def main():
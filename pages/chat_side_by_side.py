@@ -2,16 +2,16 @@ import asyncio
 import random
 
 import streamlit as st
-from openai import OpenAI
 
-from pages.util import graph_search
+from pages.util import graph_search, openai_clients, tracing
 from pages.util import streamlit_components as stc
 
 
 async def process_chat(
-    client, assistant_id, thread_id, user_query, col, search_engine=None
+    client, assistant_id, thread_id, user_query, col, search_engine=None, name=""
 ):
-    with col:
+    # 3つの列は並行に処理されるため、列ごとのspanにまとめる
+    with col, tracing.span("side_by_side.column", {"column": name}):
         # ユーザーの質問を表示・会話履歴に追加
         with st.chat_message("user"):
             st.markdown(user_query)
@@ -19,9 +19,16 @@ async def process_chat(
 
         # アシスタントの回答を表示・会話履歴に追加
         with st.chat_message("assistant"):
-            context = (
-                await search_engine.asearch(user_query) if search_engine else user_query
-            )
+            try:
+                context = (
+                    await search_engine.asearch(user_query)
+                    if search_engine
+                    else user_query
+                )
+            except graph_search.ReduceContextError as e:
+                # key pointsがreduceのcontextに1つも収まらない場合は回答を作らない
+                st.error(f"検索結果から回答のcontextを作れませんでした: {e}")
+                return
             assistant_reply = await stc.create_assistant_reply_async(
                 client, assistant_id, thread_id, context
             )
@@ -31,7 +38,7 @@ async def process_chat(
 
 
 async def chat(api_key):
-    client = OpenAI(api_key=api_key)
+    client = openai_clients.get_openai_client(api_key)
 
     left_col, center_col, right_col = st.columns(3)
     with left_col:
@@ -44,10 +51,6 @@ async def chat(api_key):
         )
     if not left_assistant_id or not right_assistant_id or not right_graph_store_id:
         return
-    search_engine = graph_search.create_global_search_engine(
-        f"./data/graphrag/{right_graph_store_id}", api_key, "gpt-4o-mini"
-    )
-
     for col, thread_id in zip(
         [left_col, center_col, right_col],
         [left_thread_id, center_thread_id, right_thread_id],
@@ -60,22 +63,41 @@ async def chat(api_key):
                     st.markdown(message["content"])
 
     if user_query := st.chat_input("Ask me a question"):
-        await asyncio.gather(
-            process_chat(
-                client, left_assistant_id, left_thread_id, user_query, left_col
-            ),
-            process_chat(
-                client, center_assistant_id, center_thread_id, user_query, center_col
-            ),
-            process_chat(
-                client,
-                right_assistant_id,
-                right_thread_id,
-                user_query,
-                right_col,
-                search_engine,
-            ),
-        )
+        # 3つの回答とGraphRAGの検索は同じ接続poolを使って並行に行う
+        async_client = openai_clients.get_async_openai_client(api_key)
+        with tracing.trace("chat.side_by_side", {"graph_store": right_graph_store_id}):
+            search_engine = graph_search.create_global_search_engine(
+                f"./data/graphrag/{right_graph_store_id}", api_key, "gpt-4o-mini"
+            )
+            await asyncio.gather(
+                process_chat(
+                    async_client,
+                    left_assistant_id,
+                    left_thread_id,
+                    user_query,
+                    left_col,
+                    name="left",
+                ),
+                process_chat(
+                    async_client,
+                    center_assistant_id,
+                    center_thread_id,
+                    user_query,
+                    center_col,
+                    name="center",
+                ),
+                process_chat(
+                    async_client,
+                    right_assistant_id,
+                    right_thread_id,
+                    user_query,
+                    right_col,
+                    search_engine,
+                    name="graphrag",
+                ),
+            )
+
+    stc.trace_panel()
 
 
 def main():
@@ -83,7 +105,7 @@ def main():
         st.warning("OpenAI API Keyが設定されていません。")
         return
 
-    asyncio.run(chat(st.session_state["api_key"]))
+    openai_clients.run(chat(st.session_state["api_key"]))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+import pandas as pd
+import streamlit as st
+
+from pages.util.indexing_profiler import load_profiles
+
+
+def summarize_runs(profiles: dict[str, dict]) -> pd.DataFrame:
+    """Build one row per run with the tuned settings and the totals of the run."""
+    rows = []
+    for run_id, profile in profiles.items():
+        rows.append(
+            {
+                "run_id": run_id,
+                "wall_time": profile["wall_time"],
+                "peak_rss_mb": profile["peak_rss_mb"],
+                **profile["totals"],
+                **profile["settings"],
+            }
+        )
+    return pd.DataFrame(rows).set_index("run_id")
+
+
+def workflow_table(profiles: dict[str, dict]) -> pd.DataFrame:
+    frames = []
+    for run_id, profile in profiles.items():
+        df = pd.DataFrame(profile["workflows"])
+        df.insert(0, "run_id", run_id)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def indexing_profiles():
+    with st.container(border=True):
+        graph_store_id = st.text_input(
+            "GraphStore ID",
+            type="password",
+            placeholder="gs_****",
+        )
+    if not (len(graph_store_id) == 27 and graph_store_id.startswith("gs_")):
+        return
+
+    profiles = load_profiles(f"data/graphrag/{graph_store_id}")
+    if not profiles:
+        st.info("計測結果のあるindexingの実行がありません。")
+        return
+
+    run_ids = st.multiselect(
+        "比較するrun", options=list(profiles), default=list(profiles)[-2:]
+    )
+    if not run_ids:
+        return
+    profiles = {run_id: profiles[run_id] for run_id in run_ids}
+
+    st.subheader("Runs")
+    st.dataframe(summarize_runs(profiles), use_container_width=True)
+
+    workflows = workflow_table(profiles)
+    metric = st.selectbox(
+        "workflowごとに比較する指標",
+        options=[
+            "wall_time",
+            "llm_calls",
+            "input_tokens",
+            "output_tokens",
+            "retries",
+            "rate_limit_waits",
+            "cache_hits",
+            "peak_rss_mb",
+        ],
+    )
+    st.subheader("Workflows")
+    # workflowは実行順に並べる
+    order = list(dict.fromkeys(workflows["workflow"]))
+    chart = workflows.pivot_table(
+        index="workflow", columns="run_id", values=metric, aggfunc="sum"
+    ).reindex(order)
+    st.bar_chart(chart, horizontal=True, stack=False)
+    st.dataframe(workflows, use_container_width=True, hide_index=True)
+
+
+if __name__ == "__main__":
+    st.set_page_config(layout="wide")
+
+    indexing_profiles()
@@ -0,0 +1,161 @@
+import re
+import threading
+import time
+import unicodedata
+from collections.abc import Hashable
+from dataclasses import dataclass, field
+
+LRU = "lru"
+LFU = "lfu"
+
+
+def normalize_question(query: str) -> str:
+    """Normalize case, width, whitespace and punctuation of a question."""
+    query = unicodedata.normalize("NFKC", query).lower()
+    # 記号(Unicodeの句読点・記号のカテゴリ)は空白として扱う
+    query = "".join(
+        " " if unicodedata.category(char)[0] in ("P", "S") else char for char in query
+    )
+    return re.sub(r"\s+", " ", query).strip()
+
+
+@dataclass
+class CachedAnswer:
+    query: str
+    key: str
+    context: str
+    answer: str | None = None
+    created_at: float = field(default_factory=time.time)
+    last_used: float = field(default_factory=time.monotonic)
+    hits: int = 0
+
+
+@dataclass
+class CacheHit:
+    entry: CachedAnswer
+    context: str
+    answer: str | None
+
+
+@dataclass
+class _StoreCache:
+    """1つのGraphStore(とsearch mode・assistant)の、質問と回答"""
+
+    version: str
+    entries: dict[str, CachedAnswer] = field(default_factory=dict)
+
+    def victim(self, policy: str) -> str:
+        entries = self.entries
+        if policy == LFU:
+            return min(
+                entries, key=lambda key: (entries[key].hits, entries[key].last_used)
+            )
+        return min(entries, key=lambda key: entries[key].last_used)
+
+
+class AnswerCache:
+    """
+    同じ質問に対して、以前のsearchのcontextと回答を返すプロセス内のキャッシュ。
+    - GraphStoreなどのkeyごとに、artifactのバージョンで引く。再indexingで捨てる
+    - 大文字小文字・空白・記号を正規化した質問が完全に一致した場合だけ返す。
+      言い換えた質問は別の質問として扱う(embeddingの類似度では引かない)
+    - keyごとにcapacity件まで持ち、超えた分はLRUまたはLFUで捨てる
+    """
+
+    def __init__(self, capacity_per_store: int = 256, policy: str = LRU):
+        if policy not in (LRU, LFU):
+            raise ValueError(f"unknown eviction policy: {policy}")
+        self.capacity_per_store = capacity_per_store
+        self.policy = policy
+        self.context_hits = 0
+        self.answer_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._stores: dict[Hashable, _StoreCache] = {}
+        self._lock = threading.Lock()
+
+    def _store(self, store_key: Hashable, version: str) -> _StoreCache:
+        store = self._stores.get(store_key)
+        if store is None or store.version != version:
+            store = _StoreCache(version)
+            self._stores[store_key] = store
+        return store
+
+    def get(self, store_key: Hashable, version: str, query: str) -> CacheHit | None:
+        """Return the cached context and answer of the same question."""
+        key = normalize_question(query)
+        with self._lock:
+            entry = self._store(store_key, version).entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            entry.hits += 1
+            entry.last_used = time.monotonic()
+            if entry.answer is not None:
+                self.answer_hits += 1
+            else:
+                self.context_hits += 1
+        return CacheHit(
+            entry=entry,
+            context=_replace_query(entry.context, entry.query, query),
+            answer=entry.answer,
+        )
+
+    def put(
+        self,
+        store_key: Hashable,
+        version: str,
+        query: str,
+        context: str,
+        answer: str | None = None,
+    ) -> CachedAnswer:
+        key = normalize_question(query)
+        entry = CachedAnswer(query=query, key=key, context=context, answer=answer)
+        with self._lock:
+            store = self._store(store_key, version)
+            # 同じ質問は上書きする
+            if (
+                key not in store.entries
+                and len(store.entries) >= self.capacity_per_store
+            ):
+                del store.entries[store.victim(self.policy)]
+                self.evictions += 1
+            store.entries[key] = entry
+        return entry
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.context_hits + self.answer_hits
+            lookups = hits + self.misses
+            return {
+                "stores": len(self._stores),
+                "entries": sum(len(store.entries) for store in self._stores.values()),
+                "context_hits": self.context_hits,
+                "answer_hits": self.answer_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._stores.clear()
+
+
+def _replace_query(context: str, cached_query: str, query: str) -> str:
+    # search engineのcontextは最後にクエリが付くため、今回のクエリに差し替える
+    if context.endswith(cached_query):
+        return context[: len(context) - len(cached_query)] + query
+    return f"{context}\n\n{query}"
+
+
+_answer_cache: AnswerCache | None = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> AnswerCache:
+    global _answer_cache
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = AnswerCache()
+        return _answer_cache
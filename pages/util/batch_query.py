@@ -0,0 +1,295 @@
+"""
+GraphStoreに対して、JSONLの質問をまとめてglobal searchで処理する
+
+    python -m pages.util.batch_query --graph-store-id gs_xxx \\
+        --questions questions.jsonl --output answers.jsonl --concurrency 4 --answer
+
+質問のファイルは1行に1つ、`{"id": "q1", "question": "..."}` の形式で書く(idは省略可)。
+結果は1問終わるごとに出力のJSONLに追記し、再実行すると終わった質問を飛ばして続きから処理する。
+出力を.parquetにした場合は、`{output}.jsonl`に追記し、全問が終わった時点でparquetに書き出す。
+OPENAI_BASE_URL(または--base-url)を指定すると、OpenAI互換のローカルのエンドポイントに送る。
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+
+import pandas as pd
+from graphrag.query.llm.text_utils import num_tokens
+from graphrag.query.structured_search.global_search.reduce_system_prompt import (
+    NO_DATA_ANSWER,
+)
+
+from . import openai_clients
+from .graph_search import GlobalSearchForAssistantsAPI, create_global_search_engine
+
+log = logging.getLogger(__name__)
+
+DEFAULT_GRAPH_STORE_DIR = "./data/graphrag"
+QUERY_SEPARATOR = "---User Questions---\n\n"
+
+
+@dataclass
+class BatchSummary:
+    output_path: str
+    total: int
+    completed: int
+    skipped: int
+    failed: int
+    elapsed: float
+
+
+def read_questions(path: str) -> list[dict]:
+    """Read `{"id", "question"}` records from a JSONL file; ids default to the line number."""
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            question = record.get("question") or record.get("query")
+            if not question:
+                raise ValueError(f"{path}:{line_number}: no question")
+            questions.append(
+                {"id": str(record.get("id", line_number)), "question": question}
+            )
+    ids = [question["id"] for question in questions]
+    if len(set(ids)) != len(ids):
+        raise ValueError(f"{path}: question ids are not unique")
+    return questions
+
+
+def checkpoint_path(output_path: str) -> str:
+    """Return the JSONL file the results are appended to while the batch runs."""
+    if output_path.endswith(".parquet"):
+        return f"{output_path}.jsonl"
+    return output_path
+
+
+def read_results(path: str) -> dict[str, dict]:
+    """Return the last result of each question id in a checkpoint file."""
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 中断で途中まで書かれた行は捨てる
+                continue
+            results[record["id"]] = record
+    return results
+
+
+async def answer_question(
+    engine: GlobalSearchForAssistantsAPI,
+    question: str,
+    answer: bool = False,
+) -> dict:
+    """Run global search for `question`, and the reduce step too when `answer` is set."""
+    start = time.perf_counter()
+    result = await engine.asearch_result(question)
+    context = result.response
+    record = {
+        "context": context,
+        "context_tokens": num_tokens(context, engine.token_encoder),
+        "search_seconds": time.perf_counter() - start,
+        "llm_calls": result.llm_calls,
+        "prompt_tokens": result.prompt_tokens,
+        "completion_tokens": 0,
+    }
+    if not answer:
+        return record
+
+    answer_start = time.perf_counter()
+    if QUERY_SEPARATOR not in context:
+        # key pointが1つもなかった場合は、graphragと同じくLLMを呼ばない
+        record["answer"] = NO_DATA_ANSWER
+    else:
+        search_prompt, query = context.rsplit(QUERY_SEPARATOR, 1)
+        messages = [
+            {"role": "system", "content": search_prompt},
+            {"role": "user", "content": query},
+        ]
+        record["answer"] = await engine.llm.agenerate(
+            messages=messages, streaming=False, **engine.reduce_llm_params
+        )
+        record["llm_calls"] += 1
+        record["prompt_tokens"] += num_tokens(
+            search_prompt + query, engine.token_encoder
+        )
+        record["completion_tokens"] = num_tokens(record["answer"], engine.token_encoder)
+    record["answer_seconds"] = time.perf_counter() - answer_start
+    return record
+
+
+async def arun_batch(
+    engine: GlobalSearchForAssistantsAPI,
+    questions: list[dict],
+    output_path: str,
+    concurrency: int = 4,
+    answer: bool = False,
+    resume: bool = True,
+) -> BatchSummary:
+    """
+    Answer `questions` with `engine`, at most `concurrency` at a time.
+
+    Each result is appended to the checkpoint file as soon as it finishes. With
+    `resume`, questions that already have a successful result there are skipped.
+    """
+    start = time.perf_counter()
+    path = checkpoint_path(output_path)
+    if not resume and os.path.exists(path):
+        os.remove(path)
+    done = {
+        record_id
+        for record_id, record in read_results(path).items()
+        if not record.get("error")
+    }
+    pending = [question for question in questions if question["id"] not in done]
+    log.info(
+        "%d questions, %d already done, %d to run",
+        len(questions),
+        len(questions) - len(pending),
+        len(pending),
+    )
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    semaphore = asyncio.Semaphore(concurrency)
+    counts = {"completed": 0, "failed": 0}
+
+    with open(path, "a", encoding="utf-8") as f:
+
+        async def _run(question: dict) -> None:
+            async with semaphore:
+                question_start = time.perf_counter()
+                record = {"id": question["id"], "question": question["question"]}
+                try:
+                    record.update(
+                        await answer_question(engine, question["question"], answer)
+                    )
+                    record["error"] = None
+                    counts["completed"] += 1
+                except Exception as e:
+                    log.exception("question %s failed", question["id"])
+                    record["error"] = f"{type(e).__name__}: {e}"
+                    counts["failed"] += 1
+                record["latency_seconds"] = time.perf_counter() - question_start
+                record["finished_at"] = time.time()
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                log.info(
+                    "[%d/%d] %s %.2fs%s",
+                    counts["completed"] + counts["failed"],
+                    len(pending),
+                    question["id"],
+                    record["latency_seconds"],
+                    " (failed)" if record["error"] else "",
+                )
+
+        await asyncio.gather(*(_run(question) for question in pending))
+
+    if path != output_path:
+        ids = {question["id"] for question in questions}
+        results = [
+            record
+            for record_id, record in read_results(path).items()
+            if record_id in ids
+        ]
+        pd.DataFrame(results).to_parquet(output_path, index=False)
+
+    return BatchSummary(
+        output_path=output_path,
+        total=len(questions),
+        completed=counts["completed"],
+        skipped=len(questions) - len(pending),
+        failed=counts["failed"],
+        elapsed=time.perf_counter() - start,
+    )
+
+
+def run_batch(
+    graph_store_id: str,
+    questions: list[dict] | str,
+    output_path: str,
+    api_key: str,
+    llm_model: str = "gpt-4o-mini",
+    concurrency: int = 4,
+    answer: bool = False,
+    resume: bool = True,
+    config_path: str = "config/graphrag.yaml",
+    graph_store_dir: str = DEFAULT_GRAPH_STORE_DIR,
+) -> BatchSummary:
+    """Load the global search engine of `graph_store_id` once and run the batch."""
+    if isinstance(questions, str):
+        questions = read_questions(questions)
+    engine = create_global_search_engine(
+        os.path.join(graph_store_dir, graph_store_id), api_key, llm_model, config_path
+    )
+    return openai_clients.run(
+        arun_batch(
+            engine,
+            questions,
+            output_path,
+            concurrency=concurrency,
+            answer=answer,
+            resume=resume,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--graph-store-id", required=True)
+    parser.add_argument("--questions", required=True, help="JSONL file of questions")
+    parser.add_argument("--output", required=True, help=".jsonl or .parquet")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--answer",
+        action="store_true",
+        help="also generate the answer from the reduce context",
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="discard the results of a previous run",
+    )
+    parser.add_argument("--llm-model", default="gpt-4o-mini")
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY"))
+    parser.add_argument("--base-url", help="OpenAI compatible endpoint")
+    parser.add_argument("--config", default="config/graphrag.yaml")
+    parser.add_argument("--graph-store-dir", default=DEFAULT_GRAPH_STORE_DIR)
+    args = parser.parse_args()
+    if not args.api_key:
+        parser.error("--api-key or OPENAI_API_KEY is required")
+    if args.base_url:
+        os.environ["OPENAI_BASE_URL"] = args.base_url
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    # requestごとのログは多すぎるため出さない
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    summary = run_batch(
+        args.graph_store_id,
+        args.questions,
+        args.output,
+        args.api_key,
+        llm_model=args.llm_model,
+        concurrency=args.concurrency,
+        answer=args.answer,
+        resume=not args.no_resume,
+        config_path=args.config,
+        graph_store_dir=args.graph_store_dir,
+    )
+    print(
+        f"{summary.completed} completed, {summary.skipped} skipped,"
+        f" {summary.failed} failed in {summary.elapsed:.1f}s -> {summary.output_path}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+import hashlib
+import os
+from collections.abc import Callable, Iterator, Sequence
+from typing import Any, TypeVar
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from graphrag.model import CommunityReport, Entity
+
+from .engine_cache import artifacts_dir
+
+T = TypeVar("T")
+
+COLUMNAR_DIR = "columnar"
+# まとめてPythonのオブジェクトにする行数
+BATCH_ROWS = 1024
+
+
+def columnar_table(root: str, table: str, columns: list[str]) -> pa.Table:
+    """
+    Return `columns` of an artifact table as a memory-mapped Arrow table.
+
+    The columns are converted once from parquet to an uncompressed Arrow IPC file
+    next to the artifacts. Its buffers are read straight from the page cache, so the
+    text and embedding columns are not copied into each process that opens them.
+    """
+    data_dir = artifacts_dir(root)
+    digest = hashlib.sha256(",".join(columns).encode()).hexdigest()[:8]
+    path = columnar_path(root, f"{table}.{digest}.arrow")
+    if not os.path.exists(path):
+        write_arrow_file(
+            path, pq.read_table(f"{data_dir}/{table}.parquet", columns=columns)
+        )
+    return map_arrow_file(path)
+
+
+def columnar_path(root: str, name: str) -> str:
+    """Return the path of a file in the columnar directory of the current run."""
+    return os.path.join(os.path.dirname(artifacts_dir(root)), COLUMNAR_DIR, name)
+
+
+def write_arrow_file(path: str, table: pa.Table) -> None:
+    """Write `table` as an uncompressed Arrow IPC file, replacing `path` atomically."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+def map_arrow_file(path: str) -> pa.Table:
+    with pa.memory_map(path, "r") as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+class LazyRecords(Sequence[T]):
+    """
+    Arrow tableの行から、参照されたときにgraphragのモデルのオブジェクトを作るSequence。
+    作ったオブジェクトは保持しないため、変更は次に参照したときには残らない。
+    """
+
+    def __init__(
+        self,
+        table: pa.Table,
+        rows: np.ndarray,
+        build: Callable[[dict[str, Any]], T],
+        extra_columns: dict[str, Sequence] | None = None,
+    ):
+        self._table = table
+        self._rows = np.asarray(rows, dtype=np.int64)
+        self._build = build
+        self._extra_columns = extra_columns or {}
+
+    @property
+    def nbytes(self) -> int:
+        """Heap memory held by this sequence; the Arrow buffers are memory-mapped."""
+        return self._rows.nbytes + sum(
+            column.nbytes if isinstance(column, np.ndarray) else 8 * len(column)
+            for column in self._extra_columns.values()
+        )
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def column(self, name: str) -> pa.ChunkedArray | Sequence:
+        """Return a column for the rows of this sequence without building objects."""
+        if name in self._extra_columns:
+            return self._extra_columns[name]
+        return self._table.column(name).take(pa.array(self._rows))
+
+    def _records(self, positions: np.ndarray) -> list[T]:
+        rows = self._table.take(pa.array(self._rows[positions])).to_pylist()
+        for name, column in self._extra_columns.items():
+            for row, position in zip(rows, positions):
+                row[name] = column[position]
+        return [self._build(row) for row in rows]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._records(np.arange(len(self))[index])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._records(np.array([index]))[0]
+
+    def __iter__(self) -> Iterator[T]:
+        for start in range(0, len(self), BATCH_ROWS):
+            yield from self._records(
+                np.arange(start, min(start + BATCH_ROWS, len(self)))
+            )
+
+
+def _max_community_per_title(nodes: pd.DataFrame, community_level: int) -> pd.DataFrame:
+    # read_indexer_reports・read_indexer_entitiesと同じく、level以下で最も深いcommunityを使う
+    nodes = nodes[nodes["level"] <= community_level].copy()
+    nodes["community"] = nodes["community"].fillna(-1).astype(int)
+    return nodes
+
+
+def read_lazy_entities(
+    root: str, nodes: pd.DataFrame, community_level: int
+) -> LazyRecords[Entity]:
+    """
+    Same entities as graphrag's read_indexer_entities, built lazily from
+    memory-mapped columns of create_final_entities.
+    """
+    nodes = _max_community_per_title(nodes, community_level)
+    nodes["degree"] = nodes["degree"].astype(int)
+    entity_df = (
+        nodes.rename(columns={"title": "name", "degree": "rank"})
+        .groupby(["name", "rank"])
+        .agg({"community": "max"})
+        .reset_index()
+    )
+    table = columnar_table(
+        root,
+        "create_final_entities",
+        [
+            "id",
+            "name",
+            "type",
+            "description",
+            "human_readable_id",
+            "text_unit_ids",
+            "description_embedding",
+        ],
+    )
+    names = pd.DataFrame(
+        {"name": table.column("name").to_pandas(), "row": np.arange(table.num_rows)}
+    )
+    entity_df = entity_df.merge(names, on="name", how="inner").drop_duplicates(
+        subset=["name"]
+    )
+
+    def _build(row: dict[str, Any]) -> Entity:
+        return Entity(
+            id=str(row["id"]),
+            short_id=str(row["human_readable_id"]),
+            title=str(row["name"]),
+            type=row["type"],
+            description=row["description"],
+            description_embedding=row["description_embedding"],
+            community_ids=[str(row["community"])],
+            text_unit_ids=row["text_unit_ids"],
+            rank=int(row["rank"]),
+        )
+
+    return LazyRecords(
+        table,
+        entity_df["row"].to_numpy(),
+        _build,
+        extra_columns={
+            "community": entity_df["community"].to_numpy(),
+            "rank": entity_df["rank"].to_numpy(),
+        },
+    )
+
+
+def community_weights(entities: LazyRecords[Entity]) -> dict[str, int]:
+    """
+    The occurrence weight of each community, as graphrag's _compute_community_weights:
+    the number of distinct text units of the entities in the community.
+    """
+    text_unit_ids = entities.column("text_unit_ids").combine_chunks()
+    flat = pc.list_flatten(text_unit_ids)
+    parents = pc.list_parent_indices(text_unit_ids).to_numpy()
+    communities = np.asarray(entities.column("community"))
+    pairs = pd.DataFrame(
+        {"community": communities[parents].astype(str), "text_unit": flat.to_pandas()}
+    ).drop_duplicates()
+    return pairs.groupby("community").size().to_dict()
+
+
+def read_lazy_reports(
+    root: str,
+    nodes: pd.DataFrame,
+    community_level: int,
+    weights: dict[str, int] | None = None,
+    weight_name: str = "occurrence weight",
+    normalize_weights: bool = True,
+) -> LazyRecords[CommunityReport]:
+    """
+    Same reports as graphrag's read_indexer_reports, built lazily from
+    memory-mapped columns of create_final_community_reports.
+
+    When `weights` is given, each report carries its community weight in
+    `attributes[weight_name]`, as after graphrag's _compute_community_weights.
+    """
+    nodes = _max_community_per_title(nodes, community_level)
+    communities = set(
+        nodes.groupby("title")["community"].max().astype(str).drop_duplicates()
+    )
+    table = columnar_table(
+        root,
+        "create_final_community_reports",
+        ["community", "level", "title", "summary", "full_content", "rank"],
+    )
+    levels = table.column("level").to_numpy()
+    report_communities = table.column("community").to_pandas().astype(str)
+    rows = np.flatnonzero(
+        (levels <= community_level) & report_communities.isin(communities).to_numpy()
+    )
+    if weights is not None and normalize_weights:
+        # graphragと同じく、対象のreportの中の最大値で正規化する
+        max_weight = max(
+            (weights.get(community, 0) for community in report_communities.iloc[rows]),
+            default=0,
+        )
+        if max_weight > 0:
+            weights = {
+                community: weight / max_weight for community, weight in weights.items()
+            }
+
+    def _build(row: dict[str, Any]) -> CommunityReport:
+        community = str(row["community"])
+        return CommunityReport(
+            id=community,
+            short_id=community,
+            title=str(row["title"]),
+            community_id=community,
+            summary=str(row["summary"]),
+            full_content=str(row["full_content"]),
+            rank=row["rank"],
+            attributes=(
+                {weight_name: weights.get(community, 0.0 if normalize_weights else 0)}
+                if weights is not None
+                else None
+            ),
+        )
+
+    return LazyRecords(table, rows, _build)
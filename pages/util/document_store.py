@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from typing import BinaryIO
+
+DEFAULT_BLOB_DIR = "data/graphrag/blobs"
+DEFAULT_CORPUS_INDEX_PATH = "data/graphrag/corpus_index.json"
+CHUNK_SIZE = 1024 * 1024
+
+
+class DocumentStore:
+    """
+    GraphStoreの入力文書を内容のsha256で1つだけ保存する。
+    - 文書は`{blob_dir}/{hash[:2]}/{hash}`に読み取り専用で置く
+    - GraphStoreの`input`にはblobへのハードリンクを置き、文書をコピーしない
+    """
+
+    def __init__(self, blob_dir: str = DEFAULT_BLOB_DIR):
+        self.blob_dir = blob_dir
+
+    def blob_path(self, sha256: str) -> str:
+        return os.path.join(self.blob_dir, sha256[:2], sha256)
+
+    def put(self, f: BinaryIO) -> str:
+        """Store the content of `f` and return its sha256."""
+        os.makedirs(self.blob_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        f.seek(0)
+        fd, tmp_path = tempfile.mkstemp(dir=self.blob_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                while chunk := f.read(CHUNK_SIZE):
+                    digest.update(chunk)
+                    tmp.write(chunk)
+            sha256 = digest.hexdigest()
+            path = self.blob_path(sha256)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.chmod(tmp_path, 0o444)
+                os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return sha256
+
+    def link(self, sha256: str, path: str) -> None:
+        """Place the blob at `path`, as a hard link when the filesystem allows it."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.lexists(path):
+            os.remove(path)
+        try:
+            os.link(self.blob_path(sha256), path)
+        except OSError:
+            shutil.copyfile(self.blob_path(sha256), path)
+
+    def link_inputs(self, root: str, files: dict[str, str]) -> None:
+        """Place the documents `files` (file name -> sha256) in the input directory of `root`."""
+        for name, sha256 in files.items():
+            self.link(sha256, os.path.join(root, "input", os.path.basename(name)))
+
+
+def corpus_hash(files: dict[str, str], **settings) -> str:
+    """
+    Hash a corpus from its file names and contents and the settings that change the index.
+    """
+    data = json.dumps(
+        {"files": sorted(files.items()), "settings": settings}, sort_keys=True
+    )
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class CorpusIndex:
+    """corpusのhashから、そのcorpusをindexingしたGraphStoreのrootを引く索引"""
+
+    def __init__(self, path: str = DEFAULT_CORPUS_INDEX_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self) -> dict[str, str]:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write(self, index: dict[str, str]) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            return self._read().get(key)
+
+    def register(self, key: str, root: str) -> None:
+        with self._lock:
+            index = self._read()
+            index[key] = root
+            self._write(index)
+
+    def remove(self, key: str) -> None:
+        with self._lock:
+            index = self._read()
+            if index.pop(key, None) is not None:
+                self._write(index)
+
+
+_document_store: DocumentStore | None = None
+_corpus_index: CorpusIndex | None = None
+
+
+def get_document_store() -> DocumentStore:
+    global _document_store
+    if _document_store is None:
+        _document_store = DocumentStore()
+    return _document_store
+
+
+def get_corpus_index() -> CorpusIndex:
+    global _corpus_index
+    if _corpus_index is None:
+        _corpus_index = CorpusIndex()
+    return _corpus_index
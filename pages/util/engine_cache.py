@@ -0,0 +1,161 @@
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Hashable
+
+import pandas as pd
+
+from . import tracing
+
+
+def current_run_id(root: str) -> str:
+    """
+    公開済みの最新のindexing結果のrun idを返す。
+    `output/CURRENT`がない場合は、バージョン管理以前のGraphStoreとして"default"を返す。
+    """
+    try:
+        with open(f"{root}/output/CURRENT", encoding="utf-8") as f:
+            return f.read().strip() or "default"
+    except FileNotFoundError:
+        return "default"
+
+
+def artifacts_dir(root: str, run_id: str | None = None) -> str:
+    """Return the directory where the indexing pipeline writes its parquet files."""
+    return f"{root}/output/{run_id or current_run_id(root)}/artifacts"
+
+
+def artifact_version(root: str, tables: list[str], *extra_paths: str) -> str:
+    """
+    artifactの更新時刻からバージョン文字列を作成する。
+    再indexingでparquetが書き換わるとバージョンが変わり、キャッシュが無効になる。
+    """
+    run_id = current_run_id(root)
+    data_dir = artifacts_dir(root, run_id)
+    paths = [f"{data_dir}/{table}.parquet" for table in tables] + list(extra_paths)
+    stamps = [run_id]
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stamps.append("-")
+            continue
+        stamps.append(f"{stat.st_mtime_ns}:{stat.st_size}")
+    return "|".join(stamps)
+
+
+def dataframe_nbytes(*dfs: pd.DataFrame) -> int:
+    """Approximate the memory footprint of the given dataframes."""
+    return int(sum(df.memory_usage(deep=True).sum() for df in dfs))
+
+
+@dataclass
+class _Entry:
+    value: Any
+    version: str
+    nbytes: int
+
+
+class EngineCache:
+    """
+    GraphStoreごとに読み込んだデータをプロセス内で共有するLRUキャッシュ。
+    メモリ使用量の合計が`max_bytes`を超えると、最も古く使われたものから破棄する。
+    """
+
+    def __init__(self, max_bytes: int = 2 * 1024**3):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[Hashable, _Entry] = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks: dict[Hashable, threading.Lock] = {}
+
+    def get_or_load(
+        self,
+        key: Hashable,
+        version: str,
+        loader: Callable[[], tuple[Any, int]],
+    ) -> Any:
+        """
+        Return the cached value for `key` if its version matches.
+
+        Otherwise `loader` is called once (even when several sessions ask
+        concurrently) and must return the value and its size in bytes.
+        """
+        value = self._lookup(key, version)
+        if value is not None:
+            tracing.current_span().set_attribute("engine_cache.hit", True)
+            return value
+
+        with self._key_lock(key):
+            # 他のsessionが読み込みを終えていればそれを使う
+            value = self._lookup(key, version)
+            if value is not None:
+                tracing.current_span().set_attribute("engine_cache.hit", True)
+                return value
+
+            tracing.current_span().set_attribute("engine_cache.hit", False)
+            with tracing.span(
+                "engine_cache.load", {"engine_cache.key": str(key[0])}
+            ) as span:
+                value, nbytes = loader()
+                span.set_attribute("engine_cache.bytes", nbytes)
+            with self._lock:
+                self.misses += 1
+                self._entries[key] = _Entry(value, version, nbytes)
+                self._entries.move_to_end(key)
+                self._evict()
+            return value
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(entry.nbytes for entry in self._entries.values())
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(entry.nbytes for entry in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _lookup(self, key: Hashable, version: str) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.version != version:
+                # artifactが更新されたので古いデータは捨てる
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+    def _key_lock(self, key: Hashable) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _evict(self) -> None:
+        total = sum(entry.nbytes for entry in self._entries.values())
+        # 直近に追加したものは上限を超えていても残す
+        while total > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            total -= entry.nbytes
+            self.evictions += 1
+
+
+engine_cache = EngineCache()
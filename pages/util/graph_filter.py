@@ -0,0 +1,227 @@
+import os
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from .engine_cache import artifact_version, artifacts_dir, engine_cache
+from .graph_lod import LOD_TABLES, GraphLODIndex, GraphView, load_graph_lod_index
+
+
+@dataclass
+class GraphFilter:
+    """Conditions of a filter query. Empty lists and None mean no restriction."""
+
+    level: int | None = None
+    communities: list[str] = field(default_factory=list)
+    entity_types: list[str] = field(default_factory=list)
+    min_degree: int | None = None
+    max_degree: int | None = None
+    min_weight: float | None = None
+    max_weight: float | None = None
+    title_prefix: str = ""
+
+
+def _group(codes: np.ndarray, n_groups: int) -> tuple[np.ndarray, np.ndarray]:
+    """Group the positions of `codes` by code into (offsets, positions) arrays."""
+    valid = np.flatnonzero(codes >= 0)
+    order = valid[np.argsort(codes[valid], kind="stable")]
+    offsets = np.zeros(n_groups + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(codes[valid], minlength=n_groups))
+    return offsets, order
+
+
+class GraphFilterIndex:
+    """
+    可視化ページのフィルタ・entity検索のための列ごとの索引。
+    - weight・degreeはソート済みの配列を持ち、範囲条件を二分探索で求める
+    - community・entity typeは値ごとのentity idのリストを持つ
+    - titleは大文字にしてソートした配列を持ち、前方一致を二分探索で求める
+    """
+
+    def __init__(self, lod: GraphLODIndex, entity_types: pd.Series):
+        self.lod = lod
+        n_entities = len(lod.titles)
+
+        self.degree_order = np.argsort(lod.degrees, kind="stable")
+        self.sorted_degrees = lod.degrees[self.degree_order]
+        self.weight_order = np.argsort(lod.edge_weights, kind="stable")
+        self.sorted_weights = lod.edge_weights[self.weight_order]
+
+        self.community_groups = {
+            level: _group(assignment, len(lod.community_labels[level]))
+            for level, assignment in lod.community_ids.items()
+        }
+
+        types = entity_types.fillna("").astype(str).to_numpy()
+        self.type_labels, type_codes = np.unique(types, return_inverse=True)
+        self.type_groups = _group(type_codes.astype(np.int64), len(self.type_labels))
+
+        upper_titles = np.array([str(title).upper() for title in lod.titles])
+        self.title_order = np.argsort(upper_titles, kind="stable")
+        self.sorted_titles = upper_titles[self.title_order]
+        self._n_entities = n_entities
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [
+            self.degree_order,
+            self.sorted_degrees,
+            self.weight_order,
+            self.sorted_weights,
+            self.title_order,
+            self.sorted_titles,
+            *self.type_groups,
+            *(array for group in self.community_groups.values() for array in group),
+        ]
+        return int(sum(array.nbytes for array in arrays))
+
+    def entity_type_options(self) -> list[str]:
+        return [label for label in self.type_labels.tolist() if label]
+
+    def search_titles(self, prefix: str, limit: int = 20) -> list[str]:
+        """Return entity titles starting with `prefix` (case-insensitive), by degree."""
+        ids = self._prefix_ids(prefix)
+        ids = ids[np.argsort(-self.lod.degrees[ids], kind="stable")[:limit]]
+        return [self.lod.titles[i] for i in ids]
+
+    def _prefix_ids(self, prefix: str) -> np.ndarray:
+        prefix = prefix.upper()
+        start = np.searchsorted(self.sorted_titles, prefix, side="left")
+        end = np.searchsorted(self.sorted_titles, prefix + "\U0010ffff", side="left")
+        return self.title_order[start:end]
+
+    def _grouped_ids(
+        self, groups: tuple[np.ndarray, np.ndarray], codes: list[int]
+    ) -> np.ndarray:
+        offsets, positions = groups
+        if not codes:
+            return np.array([], dtype=np.int64)
+        return np.concatenate(
+            [positions[offsets[code] : offsets[code + 1]] for code in codes]
+        )
+
+    def _restrict(self, mask: np.ndarray, ids: np.ndarray) -> None:
+        keep = np.zeros(len(mask), dtype=bool)
+        keep[ids] = True
+        mask &= keep
+
+    def node_mask(self, graph_filter: GraphFilter) -> np.ndarray:
+        mask = np.ones(self._n_entities, dtype=bool)
+        if graph_filter.communities:
+            level = (
+                graph_filter.level
+                if graph_filter.level is not None
+                else self.lod.levels[0]
+            )
+            labels = self.lod.community_labels[level]
+            known = set(labels.tolist())
+            codes = [
+                int(np.searchsorted(labels, community))
+                for community in graph_filter.communities
+                if community in known
+            ]
+            self._restrict(mask, self._grouped_ids(self.community_groups[level], codes))
+        if graph_filter.entity_types:
+            known = set(self.type_labels.tolist())
+            codes = [
+                int(np.searchsorted(self.type_labels, entity_type))
+                for entity_type in graph_filter.entity_types
+                if entity_type in known
+            ]
+            self._restrict(mask, self._grouped_ids(self.type_groups, codes))
+        if graph_filter.min_degree is not None or graph_filter.max_degree is not None:
+            start = (
+                np.searchsorted(self.sorted_degrees, graph_filter.min_degree, "left")
+                if graph_filter.min_degree is not None
+                else 0
+            )
+            end = (
+                np.searchsorted(self.sorted_degrees, graph_filter.max_degree, "right")
+                if graph_filter.max_degree is not None
+                else len(self.sorted_degrees)
+            )
+            self._restrict(mask, self.degree_order[start:end])
+        if graph_filter.title_prefix:
+            self._restrict(mask, self._prefix_ids(graph_filter.title_prefix))
+        return mask
+
+    def edge_ids(self, graph_filter: GraphFilter) -> np.ndarray:
+        start = (
+            np.searchsorted(self.sorted_weights, graph_filter.min_weight, "left")
+            if graph_filter.min_weight is not None
+            else 0
+        )
+        end = (
+            np.searchsorted(self.sorted_weights, graph_filter.max_weight, "right")
+            if graph_filter.max_weight is not None
+            else len(self.sorted_weights)
+        )
+        return self.weight_order[start:end]
+
+    def query(
+        self, graph_filter: GraphFilter, max_nodes: int = 500, max_edges: int = 1000
+    ) -> GraphView:
+        """
+        Return the entities matching `graph_filter` and the matching edges between them.
+
+        When more than `max_nodes` entities match, the ones with the highest degree are
+        kept; likewise the heaviest `max_edges` edges are kept.
+        """
+        mask = self.node_mask(graph_filter)
+        node_ids = np.flatnonzero(mask)
+        truncated = len(node_ids) > max_nodes
+        if truncated:
+            node_ids = node_ids[
+                np.argsort(-self.lod.degrees[node_ids], kind="stable")[:max_nodes]
+            ]
+            mask = np.zeros(self._n_entities, dtype=bool)
+            mask[node_ids] = True
+
+        # entity数が少ない場合は、接続するedgeだけを調べる
+        if len(node_ids) * 20 < len(self.lod.edge_weights):
+            edge_ids = self.lod.incident_edges(node_ids)
+            edge_mask = np.zeros(len(self.lod.edge_weights), dtype=bool)
+            edge_mask[self.edge_ids(graph_filter)] = True
+            edge_ids = edge_ids[edge_mask[edge_ids]]
+        else:
+            edge_ids = self.edge_ids(graph_filter)
+        edge_ids = edge_ids[
+            mask[self.lod.edge_sources[edge_ids]]
+            & mask[self.lod.edge_targets[edge_ids]]
+        ]
+        if len(edge_ids) > max_edges:
+            truncated = True
+            edge_ids = edge_ids[
+                np.argsort(-self.lod.edge_weights[edge_ids], kind="stable")[:max_edges]
+            ]
+
+        level = (
+            graph_filter.level
+            if graph_filter.level is not None
+            else (self.lod.levels[0] if self.lod.levels else 0)
+        )
+        return GraphView(
+            nodes=[self.lod.entity_node(entity_id, level) for entity_id in node_ids],
+            edges=[self.lod.edge(edge_id) for edge_id in edge_ids],
+            truncated=truncated,
+        )
+
+
+def load_graph_filter_index(root: str) -> GraphFilterIndex:
+    """Load the filter index of a GraphStore, sharing it through `engine_cache`."""
+    version = artifact_version(root, LOD_TABLES)
+    lod = load_graph_lod_index(root)
+
+    def _load() -> tuple[GraphFilterIndex, int]:
+        nodes = pd.read_parquet(
+            f"{artifacts_dir(root)}/create_final_nodes.parquet",
+            columns=["title", "type"],
+        ).drop_duplicates("title")
+        # LOD indexと同じentityの並びに揃える
+        types = nodes.set_index("title")["type"].reindex(lod.titles)
+        index = GraphFilterIndex(lod, types)
+        return index, index.nbytes
+
+    key = ("filter", os.path.abspath(root))
+    return engine_cache.get_or_load(key, version, _load)
@@ -0,0 +1,351 @@
+import os
+from collections import deque
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from .engine_cache import (
+    artifact_version,
+    artifacts_dir,
+    dataframe_nbytes,
+    engine_cache,
+)
+
+LOD_TABLES = ["create_final_nodes", "create_final_relationships"]
+
+
+@dataclass
+class GraphView:
+    """
+    ブラウザに送る部分グラフ。
+    nodesはentity(`kind="entity"`)またはcommunityのsuper-node(`kind="community"`)。
+    """
+
+    nodes: list[dict] = field(default_factory=list)
+    edges: list[dict] = field(default_factory=list)
+    truncated: bool = False
+
+
+class GraphLODIndex:
+    """
+    可視化のためのentityグラフの索引。
+    隣接リストをCSR形式で、communityの所属をlevelごとの配列で事前に計算しておき、
+    community単位の概要・1 communityの展開・entityのk-hop近傍を上限付きで取り出す。
+    """
+
+    def __init__(self, nodes: pd.DataFrame, relationships: pd.DataFrame):
+        # create_final_nodesはentityごと・levelごとに1行
+        entities = nodes.drop_duplicates("title")
+        self.titles = entities["title"].to_numpy(dtype=object)
+        self.title_to_id = {title: i for i, title in enumerate(self.titles)}
+        self.sizes = entities["size"].fillna(1).to_numpy(dtype=np.float32)
+        n_entities = len(self.titles)
+
+        self.levels = sorted(int(level) for level in nodes["level"].unique())
+        self.community_ids: dict[int, np.ndarray] = {}
+        self.community_labels: dict[int, np.ndarray] = {}
+        for level in self.levels:
+            rows = nodes[(nodes["level"] == level) & nodes["community"].notna()]
+            labels, codes = np.unique(
+                rows["community"].astype(str), return_inverse=True
+            )
+            assignment = np.full(n_entities, -1, dtype=np.int64)
+            positions = rows["title"].map(self.title_to_id).to_numpy(dtype=np.int64)
+            assignment[positions] = codes
+            self.community_ids[level] = assignment
+            self.community_labels[level] = labels
+
+        known = relationships["source"].isin(self.title_to_id) & relationships[
+            "target"
+        ].isin(self.title_to_id)
+        relationships = relationships[known]
+        self.edge_sources = (
+            relationships["source"].map(self.title_to_id).to_numpy(dtype=np.int64)
+        )
+        self.edge_targets = (
+            relationships["target"].map(self.title_to_id).to_numpy(dtype=np.int64)
+        )
+        self.edge_weights = (
+            relationships["weight"].fillna(1.0).to_numpy(dtype=np.float32)
+        )
+        self.edge_descriptions = (
+            relationships["description"].fillna("").to_numpy(dtype=object)
+            if "description" in relationships
+            else np.full(len(relationships), "", dtype=object)
+        )
+
+        # 無向グラフとして、entity -> (隣接entity, edge番号) のCSR
+        edge_ids = np.arange(len(self.edge_sources), dtype=np.int64)
+        rows = np.concatenate([self.edge_sources, self.edge_targets])
+        order = np.argsort(rows, kind="stable")
+        self.neighbors = np.concatenate([self.edge_targets, self.edge_sources])[order]
+        self.neighbor_edges = np.concatenate([edge_ids, edge_ids])[order]
+        self.offsets = np.zeros(n_entities + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(np.bincount(rows, minlength=n_entities))
+        self.degrees = np.diff(self.offsets)
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [
+            self.sizes,
+            self.edge_sources,
+            self.edge_targets,
+            self.edge_weights,
+            self.neighbors,
+            self.neighbor_edges,
+            self.offsets,
+            *self.community_ids.values(),
+        ]
+        return int(sum(array.nbytes for array in arrays)) + 100 * (
+            len(self.titles) + len(self.edge_descriptions)
+        )
+
+    def community_members(self, level: int, community: str) -> np.ndarray:
+        labels = self.community_labels[level]
+        code = np.searchsorted(labels, community)
+        if code >= len(labels) or labels[code] != community:
+            return np.array([], dtype=np.int64)
+        return np.flatnonzero(self.community_ids[level] == code)
+
+    def incident_edges(self, entity_ids: np.ndarray) -> np.ndarray:
+        if len(entity_ids) == 0:
+            return np.array([], dtype=np.int64)
+        return np.unique(
+            np.concatenate(
+                [
+                    self.neighbor_edges[self.offsets[i] : self.offsets[i + 1]]
+                    for i in entity_ids
+                ]
+            )
+        )
+
+    def entity_node(self, entity_id: int, level: int) -> dict:
+        code = (
+            self.community_ids[level][entity_id] if level in self.community_ids else -1
+        )
+        return {
+            "id": self.titles[entity_id],
+            "kind": "entity",
+            "label": self.titles[entity_id],
+            "size": float(self.sizes[entity_id]),
+            "community": None if code < 0 else self.community_labels[level][code],
+        }
+
+    def _community_node(self, level: int, code: int, n_members: int) -> dict:
+        community = self.community_labels[level][code]
+        return {
+            "id": f"community:{community}",
+            "kind": "community",
+            "label": f"Community {community} ({n_members})",
+            "size": float(n_members),
+            "community": community,
+        }
+
+    def edge(self, edge_id: int) -> dict:
+        return {
+            "source": self.titles[self.edge_sources[edge_id]],
+            "target": self.titles[self.edge_targets[edge_id]],
+            "weight": float(self.edge_weights[edge_id]),
+            "title": self.edge_descriptions[edge_id],
+        }
+
+    def _aggregate_edges(
+        self, sources: np.ndarray, targets: np.ndarray, weights: np.ndarray, n: int
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Sum the weights of parallel edges between ids in `[0, n)`, ignoring direction."""
+        pairs = np.minimum(sources, targets) * n + np.maximum(sources, targets)
+        pairs, inverse = np.unique(pairs, return_inverse=True)
+        totals = np.bincount(inverse, weights=weights, minlength=len(pairs))
+        return pairs // n, pairs % n, totals
+
+    def community_overview(
+        self, level: int, max_nodes: int = 300, max_edges: int = 500
+    ) -> GraphView:
+        """
+        Return one super-node per community of `level` and the weighted links between them.
+
+        Only the `max_nodes` largest communities are returned.
+        """
+        assignment = self.community_ids[level]
+        n_communities = len(self.community_labels[level])
+        counts = np.bincount(assignment[assignment >= 0], minlength=n_communities)
+        shown = np.argsort(-counts, kind="stable")[: min(max_nodes, n_communities)]
+        shown = shown[counts[shown] > 0]
+        shown_mask = np.zeros(n_communities + 1, dtype=bool)
+        shown_mask[shown] = True
+        view = GraphView(
+            nodes=[
+                self._community_node(level, code, int(counts[code])) for code in shown
+            ],
+            truncated=int((counts > 0).sum()) > len(shown),
+        )
+
+        # assignmentの-1は末尾(常にFalse)のshown_maskを参照する
+        sources = assignment[self.edge_sources]
+        targets = assignment[self.edge_targets]
+        between = shown_mask[sources] & shown_mask[targets] & (sources != targets)
+        low, high, totals = self._aggregate_edges(
+            sources[between],
+            targets[between],
+            self.edge_weights[between],
+            n_communities,
+        )
+        top = np.argsort(-totals, kind="stable")
+        view.truncated = view.truncated or len(top) > max_edges
+        labels = self.community_labels[level]
+        for index in top[:max_edges]:
+            view.edges.append(
+                {
+                    "source": f"community:{labels[low[index]]}",
+                    "target": f"community:{labels[high[index]]}",
+                    "weight": float(totals[index]),
+                    "title": "",
+                }
+            )
+        return view
+
+    def expand_community(
+        self, level: int, community: str, max_nodes: int = 200, max_edges: int = 500
+    ) -> GraphView:
+        """
+        Return the overview with one community replaced by its member entities.
+
+        Members are limited to the `max_nodes` with the highest degree. Their links to
+        other communities are drawn to those communities' super-nodes.
+        """
+        overview = self.community_overview(level, max_edges=max_edges)
+        members = self.community_members(level, community)
+        if len(members) == 0:
+            return overview
+        truncated = overview.truncated or len(members) > max_nodes
+        members = members[np.argsort(-self.degrees[members], kind="stable")[:max_nodes]]
+        member_mask = np.zeros(len(self.titles), dtype=bool)
+        member_mask[members] = True
+        expanded_id = f"community:{community}"
+
+        view = GraphView(
+            nodes=[node for node in overview.nodes if node["id"] != expanded_id]
+            + [self.entity_node(entity_id, level) for entity_id in members],
+            edges=[
+                edge
+                for edge in overview.edges
+                if expanded_id not in (edge["source"], edge["target"])
+            ],
+            truncated=truncated,
+        )
+
+        edge_ids = self.incident_edges(members)
+        sources = self.edge_sources[edge_ids]
+        targets = self.edge_targets[edge_ids]
+        internal = member_mask[sources] & member_mask[targets]
+        internal_edges = edge_ids[internal]
+        internal_edges = internal_edges[
+            np.argsort(-self.edge_weights[internal_edges], kind="stable")[:max_edges]
+        ]
+        view.edges.extend(self.edge(edge_id) for edge_id in internal_edges)
+
+        # 展開したcommunityのentityから他のcommunityへのedgeはsuper-nodeへまとめる
+        assignment = self.community_ids[level]
+        outgoing = ~internal
+        member_side = np.where(member_mask[sources], sources, targets)[outgoing]
+        other_side = np.where(member_mask[sources], targets, sources)[outgoing]
+        other_community = assignment[other_side]
+        # 上限で省いた同じcommunityのentityへのedgeは描画しない
+        own_community = assignment[members[0]]
+        labels = self.community_labels[level]
+        shown = np.zeros(len(labels) + 1, dtype=bool)
+        for node in overview.nodes:
+            shown[np.searchsorted(labels, node["community"])] = True
+        shown[own_community] = False
+        keep = shown[other_community]
+        n_communities = len(labels)
+        pairs = member_side[keep] * n_communities + other_community[keep]
+        pairs, inverse = np.unique(pairs, return_inverse=True)
+        totals = np.bincount(
+            inverse,
+            weights=self.edge_weights[edge_ids[outgoing][keep]],
+            minlength=len(pairs),
+        )
+        for index in np.argsort(-totals, kind="stable")[:max_edges]:
+            view.edges.append(
+                {
+                    "source": self.titles[pairs[index] // n_communities],
+                    "target": f"community:{labels[pairs[index] % n_communities]}",
+                    "weight": float(totals[index]),
+                    "title": "",
+                }
+            )
+        return view
+
+    def k_hop(
+        self, title: str, k: int = 1, max_nodes: int = 200, max_edges: int = 500
+    ) -> GraphView:
+        """Return the entities within `k` hops of `title` and the edges between them."""
+        if title not in self.title_to_id:
+            return GraphView()
+        start = self.title_to_id[title]
+        visited = np.zeros(len(self.titles), dtype=bool)
+        visited[start] = True
+        selected = [start]
+        frontier = deque([(start, 0)])
+        truncated = False
+        while frontier and not truncated:
+            entity_id, depth = frontier.popleft()
+            if depth >= k:
+                continue
+            neighbors = self.neighbors[
+                self.offsets[entity_id] : self.offsets[entity_id + 1]
+            ]
+            weights = self.edge_weights[
+                self.neighbor_edges[
+                    self.offsets[entity_id] : self.offsets[entity_id + 1]
+                ]
+            ]
+            # 上限に達する場合に重要なものが残るよう、重みの大きいedgeから辿る
+            for neighbor in neighbors[np.argsort(-weights, kind="stable")]:
+                if visited[neighbor]:
+                    continue
+                if len(selected) >= max_nodes:
+                    truncated = True
+                    break
+                visited[neighbor] = True
+                selected.append(int(neighbor))
+                frontier.append((int(neighbor), depth + 1))
+
+        selected = np.array(selected, dtype=np.int64)
+        edge_ids = self.incident_edges(selected)
+        edge_ids = edge_ids[
+            visited[self.edge_sources[edge_ids]] & visited[self.edge_targets[edge_ids]]
+        ]
+        if len(edge_ids) > max_edges:
+            truncated = True
+            edge_ids = edge_ids[
+                np.argsort(-self.edge_weights[edge_ids], kind="stable")[:max_edges]
+            ]
+        level = self.levels[0] if self.levels else 0
+        return GraphView(
+            nodes=[self.entity_node(entity_id, level) for entity_id in selected],
+            edges=[self.edge(edge_id) for edge_id in edge_ids],
+            truncated=truncated,
+        )
+
+
+def load_graph_lod_index(root: str) -> GraphLODIndex:
+    """Load the visualization index of a GraphStore, sharing it through `engine_cache`."""
+    version = artifact_version(root, LOD_TABLES)
+
+    def _load() -> tuple[GraphLODIndex, int]:
+        data_dir = artifacts_dir(root)
+        nodes = pd.read_parquet(
+            f"{data_dir}/create_final_nodes.parquet",
+            columns=["title", "level", "community", "size"],
+        )
+        relationships = pd.read_parquet(
+            f"{data_dir}/create_final_relationships.parquet"
+        )
+        index = GraphLODIndex(nodes, relationships)
+        return index, index.nbytes + dataframe_nbytes(nodes)
+
+    key = ("lod", os.path.abspath(root))
+    return engine_cache.get_or_load(key, version, _load)
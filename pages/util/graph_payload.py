@@ -0,0 +1,202 @@
+import json
+import os
+from dataclasses import dataclass
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+
+from .engine_cache import EngineCache, artifact_version, artifacts_dir
+from .graph_lod import LOD_TABLES, GraphView
+
+COMMUNITY_COLORS = np.array(
+    [
+        "crimson",
+        "darkorange",
+        "indigo",
+        "cornflowerblue",
+        "cyan",
+        "teal",
+        "green",
+    ],
+    dtype=object,
+)
+NO_COMMUNITY_COLOR = "lightgray"
+EDGE_COLOR = "#F7A7A6"
+
+# payloadのkeyには自由入力の最小weightが入るため、search engineなどを追い出さないよう
+# engine_cacheとは別の小さなキャッシュに置く
+payload_cache = EngineCache(max_bytes=256 * 1024**2)
+
+
+class PayloadElement(dict):
+    """
+    streamlit-agraphのNode・Edgeと同じ形のdict。
+    agraph()が使う`id`と`to_dict()`だけを持ち、Node・Edgeオブジェクトを作らずに済ませる。
+    """
+
+    @property
+    def id(self):
+        return self["id"]
+
+    def to_dict(self) -> dict:
+        return self
+
+
+def community_colors(communities: pd.Series) -> np.ndarray:
+    """Map communities to colors; entities without a community are light gray."""
+    codes = pd.to_numeric(communities, errors="coerce").to_numpy(dtype=np.float64)
+    missing = np.isnan(codes)
+    indices = np.where(missing, 0, codes).astype(np.int64) % len(COMMUNITY_COLORS)
+    return np.where(missing, NO_COMMUNITY_COLOR, COMMUNITY_COLORS[indices])
+
+
+def entity_node_records(df: pd.DataFrame) -> list[PayloadElement]:
+    """Convert the entities dataframe to streamlit-agraph node dicts, column by column."""
+    titles = df["title"].to_numpy(dtype=object)
+    sizes = (4 + df["size"].fillna(0).to_numpy(dtype=np.float64) * 4).tolist()
+    colors = community_colors(df["community"]).tolist()
+    return [
+        PayloadElement(
+            id=title,
+            title=title,
+            label=title,
+            shape="dot",
+            size=size,
+            color=color,
+        )
+        for title, size, color in zip(titles.tolist(), sizes, colors)
+    ]
+
+
+def relationship_edge_records(df: pd.DataFrame) -> list[PayloadElement]:
+    """Convert the relationships dataframe to streamlit-agraph edge dicts, column by column."""
+    sources = df["source"].tolist()
+    targets = df["target"].tolist()
+    titles = (
+        df["description"].fillna("").tolist() if "description" in df else [""] * len(df)
+    )
+    widths = (df["weight"].fillna(0).to_numpy(dtype=np.float64) * 2).tolist()
+    return [
+        PayloadElement(
+            {
+                "source": source,
+                "from": source,
+                "to": target,
+                "color": EDGE_COLOR,
+                "title": title,
+                "width": width,
+            }
+        )
+        for source, target, title, width in zip(sources, targets, titles, widths)
+    ]
+
+
+def view_records(view: GraphView) -> tuple[list[PayloadElement], list[PayloadElement]]:
+    """Convert a GraphView of the LOD index to streamlit-agraph node and edge dicts."""
+    nodes = pd.DataFrame(
+        view.nodes, columns=["id", "kind", "label", "size", "community"]
+    )
+    is_community = (nodes["kind"] == "community").to_numpy()
+    sizes = nodes["size"].to_numpy(dtype=np.float64)
+    # communityのsuper-nodeはメンバー数、entityはgraphragのsizeから大きさを決める
+    sizes = np.where(is_community, 8 + np.sqrt(sizes) * 4, 4 + sizes * 4).tolist()
+    colors = community_colors(nodes["community"]).tolist()
+    node_records = [
+        PayloadElement(
+            id=node_id,
+            title=node_id,
+            label=label,
+            shape="diamond" if community else "dot",
+            size=size,
+            color=color,
+        )
+        for node_id, label, community, size, color in zip(
+            nodes["id"].tolist(), nodes["label"].tolist(), is_community, sizes, colors
+        )
+    ]
+
+    weights = np.array([edge["weight"] for edge in view.edges], dtype=np.float64)
+    # communityをまとめたedgeは重みが大きくなるため、最大値で正規化する
+    max_weight = weights.max(initial=0) or 1.0
+    widths = (1 + 4 * weights / max_weight).tolist()
+    edge_records = [
+        PayloadElement(
+            {
+                "source": edge["source"],
+                "from": edge["source"],
+                "to": edge["target"],
+                "color": EDGE_COLOR,
+                "title": edge["title"],
+                "width": width,
+            }
+        )
+        for edge, width in zip(view.edges, widths)
+    ]
+    return node_records, edge_records
+
+
+@dataclass
+class GraphPayload:
+    nodes: list[PayloadElement]
+    edges: list[PayloadElement]
+
+    @cached_property
+    def data_json(self) -> str:
+        """The JSON that streamlit-agraph sends to the browser, serialized once."""
+        return json.dumps({"nodes": self.nodes, "edges": self.edges})
+
+    @property
+    def nbytes(self) -> int:
+        # dictとして保持している分を含めた概算
+        return 4 * len(self.data_json)
+
+
+def build_graph_payload(
+    nodes: pd.DataFrame,
+    relationships: pd.DataFrame,
+    level: int | None = None,
+    min_weight: float = 0.0,
+) -> GraphPayload:
+    # create_final_nodesはlevelごとに同じentityの行を持つため、1つのlevelだけを使う
+    if level is None and len(nodes) > 0:
+        level = int(nodes["level"].min())
+    if level is not None:
+        nodes = nodes[nodes["level"] == level]
+    nodes = nodes.drop_duplicates("title")
+    if min_weight > 0:
+        relationships = relationships[relationships["weight"] >= min_weight]
+    payload = GraphPayload(
+        nodes=entity_node_records(nodes),
+        edges=relationship_edge_records(relationships),
+    )
+    _ = payload.data_json
+    return payload
+
+
+def load_graph_payload(
+    root: str, level: int | None = None, min_weight: float = 0.0
+) -> GraphPayload:
+    """
+    Build the whole-graph payload of a GraphStore for the given filters.
+
+    Payloads are shared between sessions through `payload_cache`, keyed by the
+    GraphStore, the artifact version and the filter settings.
+    """
+    version = artifact_version(root, LOD_TABLES)
+
+    def _load() -> tuple[GraphPayload, int]:
+        data_dir = artifacts_dir(root)
+        nodes = pd.read_parquet(
+            f"{data_dir}/create_final_nodes.parquet",
+            columns=["title", "level", "community", "size"],
+        )
+        relationships = pd.read_parquet(
+            f"{data_dir}/create_final_relationships.parquet",
+            columns=["source", "target", "weight", "description"],
+        )
+        payload = build_graph_payload(nodes, relationships, level, min_weight)
+        return payload, payload.nbytes
+
+    key = ("payload", os.path.abspath(root), level, min_weight)
+    return payload_cache.get_or_load(key, version, _load)
@@ -1,20 +1,31 @@
 import asyncio
+import logging
+import math
+import os
+import time
+from collections.abc import AsyncGenerator
+from dataclasses import dataclass
+from functools import partial
 from typing import Any
 
+import numpy as np
 import pandas as pd
 import tiktoken
+from graphrag.config.models import GraphRagConfig
+from graphrag.model import CommunityReport, Entity
 from graphrag.query.context_builder.builders import GlobalContextBuilder
 from graphrag.query.context_builder.conversation_history import (
     ConversationHistory,
 )
 from graphrag.query.indexer_adapters import (
+    read_indexer_covariates,
     read_indexer_entities,
+    read_indexer_relationships,
     read_indexer_reports,
+    read_indexer_text_units,
 )
 from graphrag.query.llm.base import BaseLLM
-from graphrag.query.llm.oai.chat_openai import ChatOpenAI
 from graphrag.query.llm.oai.typing import OpenaiApiType
-from graphrag.query.llm.text_utils import num_tokens
 from graphrag.query.structured_search.base import SearchResult
 from graphrag.query.structured_search.global_search.community_context import (
     GlobalCommunityContext,
@@ -25,8 +36,124 @@ from graphrag.query.structured_search.global_search.search import (
     GlobalSearch,
 )
 from graphrag.query.structured_search.local_search.search import LocalSearch
+from graphrag.vector_stores import VectorStoreDocument
 
+from . import tracing
+from .columnar_artifacts import (
+    LazyRecords,
+    community_weights,
+    read_lazy_entities,
+    read_lazy_reports,
+)
 from .common import create_graphrag_config_from_yaml
+from .engine_cache import (
+    artifact_version,
+    artifacts_dir,
+    dataframe_nbytes,
+    engine_cache,
+)
+from .key_points import KeyPointHeap
+from .local_context import IndexedLocalSearchMixedContext, NumpyVectorStore
+from .map_cache import MapResponseCache, get_map_cache
+from .openai_clients import PooledChatOpenAI, PooledOpenAIEmbedding, run
+from .report_context import (
+    ReportContextFormat,
+    ReportContextRows,
+    load_report_context_rows,
+)
+from .report_ranking import ReportRanker
+
+log = logging.getLogger(__name__)
+
+# engine_cacheのデータは全sessionで共有するため、configにsessionのAPI keyやmodelを入れない。
+# API keyとmodelは、engineを作るときにsessionごとに渡す
+SHARED_CONFIG_API_KEY = "<per-session api key>"
+SHARED_CONFIG_LLM_MODEL = "<per-session llm model>"
+
+GLOBAL_SEARCH_TABLES = [
+    "create_final_nodes",
+    "create_final_entities",
+    "create_final_community_reports",
+]
+
+# global searchのcontextの作り方。max_tokensなどconfigで決まるものは除く
+GLOBAL_CONTEXT_BUILDER_PARAMS = {
+    "use_community_summary": False,
+    "shuffle_data": True,
+    "include_community_rank": True,
+    "min_community_rank": 0,
+    "community_rank_name": "rank",
+    "include_community_weight": True,
+    "community_weight_name": "occurrence weight",
+    "normalize_community_weight": True,
+    "context_name": "Reports",
+}
+
+
+@dataclass
+class GlobalSearchData:
+    """Global searchに必要な、GraphStoreごとに一度だけ読み込めばよいデータ"""
+
+    config: GraphRagConfig
+    reports: LazyRecords[CommunityReport]
+    entities: LazyRecords[Entity]
+    token_encoder: tiktoken.Encoding
+    report_ranker: ReportRanker
+    report_rows: ReportContextRows
+
+
+def load_global_search_data(
+    root: str,
+    config_path: str = "config/graphrag.yaml",
+) -> GlobalSearchData:
+    """Load the artifacts, sharing them between sessions through `engine_cache`."""
+    version = artifact_version(root, GLOBAL_SEARCH_TABLES, config_path)
+
+    def _load() -> tuple[GlobalSearchData, int]:
+        config = create_graphrag_config_from_yaml(
+            root, config_path, SHARED_CONFIG_API_KEY, SHARED_CONFIG_LLM_MODEL
+        )
+
+        # 小さい列だけをDataFrameで読み、文章・embeddingの列はmemory-mapしたまま、
+        # reportとentityのオブジェクトはcontext builderが参照したときに作る
+        final_nodes: pd.DataFrame = pd.read_parquet(
+            f"{artifacts_dir(root)}/create_final_nodes.parquet",
+            columns=["title", "level", "community", "degree"],
+        )
+        entities = read_lazy_entities(root, final_nodes, 2)
+        reports = read_lazy_reports(
+            root, final_nodes, 2, weights=community_weights(entities)
+        )
+        token_encoder = tiktoken.get_encoding(config.encoding_model)
+        # reportの行とそのtoken数はrunごとに一度だけ作ってディスクに置いておく
+        report_rows = load_report_context_rows(
+            root,
+            reports,
+            token_encoder,
+            ReportContextFormat.from_params(GLOBAL_CONTEXT_BUILDER_PARAMS),
+        )
+        report_ranker = ReportRanker(
+            reports, None, token_encoder, token_counts=report_rows.tokens
+        )
+        data = GlobalSearchData(
+            config=config,
+            reports=reports,
+            entities=entities,
+            token_encoder=token_encoder,
+            report_ranker=report_ranker,
+            report_rows=report_rows,
+        )
+        nbytes = (
+            dataframe_nbytes(final_nodes)
+            + entities.nbytes
+            + reports.nbytes
+            + report_ranker.nbytes
+            + report_rows.nbytes
+        )
+        return data, nbytes
+
+    key = ("global", os.path.abspath(root), config_path)
+    return engine_cache.get_or_load(key, version, _load)
 
 
 def create_global_search_engine(
@@ -36,34 +163,23 @@ def create_global_search_engine(
     config_path: str = "config/graphrag.yaml",
 ) -> GlobalSearch:
     """Run a global search with the given query."""
-    config = create_graphrag_config_from_yaml(root, config_path, api_key, llm_model)
-
-    data_dir = f"{root}/output/default/artifacts"
-    final_nodes: pd.DataFrame = pd.read_parquet(
-        f"{data_dir}/create_final_nodes.parquet"
-    )
-    final_entities: pd.DataFrame = pd.read_parquet(
-        f"{data_dir}/create_final_entities.parquet"
-    )
-    final_community_reports: pd.DataFrame = pd.read_parquet(
-        f"{data_dir}/create_final_community_reports.parquet"
-    )
-
-    reports = read_indexer_reports(final_community_reports, final_nodes, 2)
-    entities = read_indexer_entities(final_nodes, final_entities, 2)
-    token_encoder = tiktoken.get_encoding(config.encoding_model)
-    gs_config = config.global_search
+    with tracing.span("global_search.create_engine", {"graph_store": root}):
+        data = load_global_search_data(root, config_path)
+    token_encoder = data.token_encoder
+    gs_config = data.config.global_search
     return GlobalSearchForAssistantsAPI(
-        llm=ChatOpenAI(
+        llm=PooledChatOpenAI(
             api_key=api_key,
             model=llm_model,
             api_type=OpenaiApiType.OpenAI,  # OpenaiApiType.OpenAI or OpenaiApiType.AzureOpenAI
             max_retries=20,
         ),
-        context_builder=GlobalCommunityContext(
-            community_reports=reports,
-            entities=entities,
+        context_builder=RankedGlobalCommunityContext(
+            community_reports=data.reports,
+            ranker=data.report_ranker,
+            entities=data.entities,
             token_encoder=token_encoder,
+            report_rows=data.report_rows,
         ),
         token_encoder=token_encoder,
         max_data_tokens=gs_config.data_max_tokens,
@@ -82,22 +198,285 @@ def create_global_search_engine(
         allow_general_knowledge=False,
         json_mode=False,
         context_builder_params={
-            "use_community_summary": False,
-            "shuffle_data": True,
-            "include_community_rank": True,
-            "min_community_rank": 0,
-            "community_rank_name": "rank",
-            "include_community_weight": True,
-            "community_weight_name": "occurrence weight",
-            "normalize_community_weight": True,
+            **GLOBAL_CONTEXT_BUILDER_PARAMS,
             "max_tokens": gs_config.max_tokens,
-            "context_name": "Reports",
+            # 関連度の高いreportだけをmapに回す (最大でおよそ8batch分)
+            "top_k_reports": None,
+            "report_token_budget": 8 * gs_config.max_tokens,
         },
         concurrent_coroutines=gs_config.concurrency,
         response_type="multiple paragraphs",
+        map_cache=get_map_cache(),
+        map_batch_timeout=30.0,
+        # 遅いbatchはbatchごとのtimeoutと全体の締め切りで打ち切る。
+        # 速さだけで一定割合のbatchを捨てないよう、map_completion_ratioは既定の1.0のまま
+        map_deadline=60.0,
+    )
+
+
+LOCAL_SEARCH_TABLES = [
+    "create_final_nodes",
+    "create_final_entities",
+    "create_final_community_reports",
+    "create_final_relationships",
+    "create_final_text_units",
+    "create_final_covariates",
+]
+
+
+@dataclass
+class LocalSearchData:
+    """Local searchに必要な、GraphStoreごとに一度だけ読み込めばよいデータ"""
+
+    config: GraphRagConfig
+    context_builder: IndexedLocalSearchMixedContext
+    token_encoder: tiktoken.Encoding
+
+
+def load_local_search_data(
+    root: str,
+    config_path: str = "config/graphrag.yaml",
+) -> LocalSearchData:
+    """Load the artifacts for local search, sharing them through `engine_cache`."""
+    version = artifact_version(root, LOCAL_SEARCH_TABLES, config_path)
+
+    def _load() -> tuple[LocalSearchData, int]:
+        config = create_graphrag_config_from_yaml(
+            root, config_path, SHARED_CONFIG_API_KEY, SHARED_CONFIG_LLM_MODEL
+        )
+
+        data_dir = artifacts_dir(root)
+        report_df = pd.read_parquet(f"{data_dir}/create_final_community_reports.parquet")
+        entity_df = pd.read_parquet(f"{data_dir}/create_final_nodes.parquet")
+        entity_embedding_df = pd.read_parquet(
+            f"{data_dir}/create_final_entities.parquet"
+        )
+        relationship_df = pd.read_parquet(
+            f"{data_dir}/create_final_relationships.parquet"
+        )
+        text_unit_df = pd.read_parquet(f"{data_dir}/create_final_text_units.parquet")
+        # claim_extractionが無効の場合はcovariateが出力されない
+        covariate_path = f"{data_dir}/create_final_covariates.parquet"
+        covariate_df = (
+            pd.read_parquet(covariate_path)
+            if os.path.exists(covariate_path)
+            else pd.DataFrame()
+        )
+
+        reports = read_indexer_reports(report_df, entity_df, 2)
+        entities = read_indexer_entities(entity_df, entity_embedding_df, 2)
+        relationships = read_indexer_relationships(relationship_df)
+        text_units = read_indexer_text_units(text_unit_df)
+        covariates = (
+            {"claims": read_indexer_covariates(covariate_df)}
+            if len(covariate_df) > 0
+            else {}
+        )
+
+        entity_text_embeddings = NumpyVectorStore()
+        entity_text_embeddings.load_documents(
+            [
+                VectorStoreDocument(
+                    id=entity.id,
+                    text=entity.description,
+                    vector=entity.description_embedding,
+                )
+                for entity in entities
+            ]
+        )
+        token_encoder = tiktoken.get_encoding(config.encoding_model)
+        context_builder = IndexedLocalSearchMixedContext(
+            entities=entities,
+            entity_text_embeddings=entity_text_embeddings,
+            text_units=text_units,
+            community_reports=reports,
+            relationships=relationships,
+            covariates=covariates,
+            token_encoder=token_encoder,
+        )
+        data = LocalSearchData(
+            config=config,
+            context_builder=context_builder,
+            token_encoder=token_encoder,
+        )
+        nbytes = dataframe_nbytes(
+            report_df,
+            entity_df,
+            entity_embedding_df,
+            relationship_df,
+            text_unit_df,
+            covariate_df,
+        )
+        return data, nbytes
+
+    key = ("local", os.path.abspath(root), config_path)
+    return engine_cache.get_or_load(key, version, _load)
+
+
+def create_local_search_engine(
+    root: str,
+    api_key: str,
+    llm_model: str,
+    config_path: str = "config/graphrag.yaml",
+) -> LocalSearch:
+    """Create a local search engine that returns the final prompt for the Assistants API."""
+    with tracing.span("local_search.create_engine", {"graph_store": root}):
+        data = load_local_search_data(root, config_path)
+    ls_config = data.config.local_search
+    text_embedder = PooledOpenAIEmbedding(
+        api_key=api_key,
+        api_type=OpenaiApiType.OpenAI,
+        model=data.config.embeddings.llm.model,
+        deployment_name=data.config.embeddings.llm.model,
+        max_retries=20,
+    )
+    return LocalSearchForAssistantsAPI(
+        llm=PooledChatOpenAI(
+            api_key=api_key,
+            model=llm_model,
+            api_type=OpenaiApiType.OpenAI,  # OpenaiApiType.OpenAI or OpenaiApiType.AzureOpenAI
+            max_retries=20,
+        ),
+        context_builder=data.context_builder.with_text_embedder(text_embedder),
+        token_encoder=data.token_encoder,
+        llm_params={
+            "max_tokens": ls_config.llm_max_tokens,
+            "temperature": ls_config.temperature,
+            "top_p": ls_config.top_p,
+            "n": ls_config.n,
+        },
+        context_builder_params={
+            "text_unit_prop": ls_config.text_unit_prop,
+            "community_prop": ls_config.community_prop,
+            "conversation_history_max_turns": ls_config.conversation_history_max_turns,
+            "conversation_history_user_turns_only": True,
+            "top_k_mapped_entities": ls_config.top_k_entities,
+            "top_k_relationships": ls_config.top_k_relationships,
+            "include_entity_rank": True,
+            "include_relationship_weight": True,
+            "include_community_rank": False,
+            "return_candidate_context": False,
+            "max_tokens": ls_config.max_tokens,
+        },
+        response_type="multiple paragraphs",
     )
 
 
+class ReduceContextError(Exception):
+    """Raised when the map results cannot be packed into the reduce context."""
+
+
+class RankedGlobalCommunityContext(GlobalCommunityContext):
+    """
+    クエリとの関連度が高いcommunity reportだけからcontextを作るGlobalCommunityContext
+    `report_rows`を渡すと、事前に作った行とtoken数を詰めるだけでbatchを作る
+    """
+
+    def __init__(
+        self,
+        community_reports: list[CommunityReport],
+        ranker: ReportRanker,
+        entities: list[Entity] | None = None,
+        token_encoder: tiktoken.Encoding | None = None,
+        random_state: int = 86,
+        report_rows: ReportContextRows | None = None,
+    ):
+        super().__init__(
+            community_reports=community_reports,
+            entities=entities,
+            token_encoder=token_encoder,
+            random_state=random_state,
+        )
+        self.ranker = ranker
+        self.report_rows = report_rows
+
+    def build_context(
+        self,
+        conversation_history: ConversationHistory | None = None,
+        query: str | None = None,
+        top_k_reports: int | None = None,
+        report_token_budget: int | None = None,
+        **kwargs: Any,
+    ) -> tuple[str | list[str], dict[str, pd.DataFrame]]:
+        ranked = query is not None and (
+            top_k_reports is not None or report_token_budget is not None
+        )
+        if self.report_rows is not None and (
+            self.report_rows.format == ReportContextFormat.from_params(kwargs)
+        ):
+            if ranked:
+                with tracing.span("global_search.rank_reports") as span:
+                    order = self.ranker.select_indices(
+                        query, top_k=top_k_reports, token_budget=report_token_budget
+                    )
+                    span.set_attribute("reports.selected", len(order))
+            elif kwargs.get("shuffle_data", True):
+                order = np.random.default_rng(self.random_state).permutation(
+                    len(self.report_rows)
+                )
+            else:
+                order = np.arange(len(self.report_rows))
+            return self._build_context_from_rows(conversation_history, order, **kwargs)
+
+        if not ranked:
+            return super().build_context(
+                conversation_history=conversation_history, **kwargs
+            )
+
+        selected_reports = self.ranker.select(
+            query, top_k=top_k_reports, token_budget=report_token_budget
+        )
+        builder = GlobalCommunityContext(
+            community_reports=selected_reports,
+            entities=self.entities,
+            token_encoder=self.token_encoder,
+            random_state=self.random_state,
+        )
+        # 関連度の高い順にbatchを作るため、shuffleはしない
+        return builder.build_context(
+            conversation_history=conversation_history,
+            **{**kwargs, "shuffle_data": False},
+        )
+
+    def _build_context_from_rows(
+        self,
+        conversation_history: ConversationHistory | None,
+        order: np.ndarray,
+        column_delimiter: str = "|",
+        min_community_rank: int = 0,
+        max_tokens: int = 8000,
+        conversation_history_user_turns_only: bool = True,
+        conversation_history_max_turns: int | None = 5,
+        **kwargs: Any,
+    ) -> tuple[list[str], dict[str, pd.DataFrame]]:
+        # 会話履歴の扱いはGlobalCommunityContext.build_contextと同じ
+        conversation_history_context = ""
+        final_context_data = {}
+        if conversation_history:
+            (
+                conversation_history_context,
+                conversation_history_context_data,
+            ) = conversation_history.build_context(
+                include_user_turns_only=conversation_history_user_turns_only,
+                max_qa_turns=conversation_history_max_turns,
+                column_delimiter=column_delimiter,
+                max_tokens=max_tokens,
+                recency_bias=False,
+            )
+            if conversation_history_context != "":
+                final_context_data = conversation_history_context_data
+
+        community_context, community_context_data = self.report_rows.build_batches(
+            order, max_tokens, min_community_rank
+        )
+        final_context = [
+            f"{conversation_history_context}\n\n{context}"
+            for context in community_context
+        ]
+        final_context_data.update(community_context_data)
+        return final_context, final_context_data
+
+
 class GlobalSearchForAssistantsAPI(GlobalSearch):
     """
     AssistantsAPIを利用するために、最終的な入力を返却するように修正したGlobalSearch
@@ -116,6 +495,13 @@ class GlobalSearchForAssistantsAPI(GlobalSearch):
         reduce_llm_params: dict[str, Any] = DEFAULT_REDUCE_LLM_PARAMS,
         context_builder_params: dict[str, Any] | None = None,
         concurrent_coroutines: int = 32,
+        map_cache: MapResponseCache | None = None,
+        early_stop_points: int | None = None,
+        early_stop_min_score: int = 50,
+        early_stop_wave_size: int = 4,
+        map_batch_timeout: float | None = None,
+        map_deadline: float | None = None,
+        map_completion_ratio: float = 1.0,
     ):
         super().__init__(
             llm=llm,
@@ -130,6 +516,18 @@ class GlobalSearchForAssistantsAPI(GlobalSearch):
             concurrent_coroutines=concurrent_coroutines,
             response_type=response_type,
         )
+        self.map_cache = map_cache
+        # early_stop_pointsを指定すると、関連度の高いbatchから順に
+        # early_stop_wave_size個ずつmapし、スコアがearly_stop_min_score以上の
+        # key pointが十分集まった時点で打ち切る
+        self.early_stop_points = early_stop_points
+        self.early_stop_min_score = early_stop_min_score
+        self.early_stop_wave_size = early_stop_wave_size
+        # 遅いbatchに全体が引きずられないよう、batchごとのtimeoutと全体の締め切りを設ける。
+        # map_completion_ratioの割合のbatchが終わった時点で残りを待たずにreduceする
+        self.map_batch_timeout = map_batch_timeout
+        self.map_deadline = map_deadline
+        self.map_completion_ratio = map_completion_ratio
 
     async def asearch(
         self,
@@ -137,34 +535,250 @@ class GlobalSearchForAssistantsAPI(GlobalSearch):
         conversation_history: ConversationHistory | None = None,
         **kwargs: Any,
     ):
-        # Step 1: Generate answers for each batch of community short summaries
-        context_chunks, context_records = self.context_builder.build_context(
-            conversation_history=conversation_history, **self.context_builder_params
+        context = query
+        with tracing.span("global_search.asearch"):
+            async for context in self.astream_context(query, conversation_history):
+                pass
+        return context
+
+    def search(
+        self,
+        query: str,
+        conversation_history: ConversationHistory | None = None,
+        **kwargs: Any,
+    ):
+        return run(self.asearch(query, conversation_history, **kwargs))
+
+    async def asearch_result(
+        self,
+        query: str,
+        conversation_history: ConversationHistory | None = None,
+    ) -> SearchResult:
+        """Like asearch, with the map LLM calls and prompt tokens as a SearchResult."""
+        start_time = time.time()
+        map_responses: list[SearchResult] = []
+        context = query
+        with tracing.span("global_search.asearch"):
+            async for context in self.astream_context(
+                query, conversation_history, map_responses=map_responses
+            ):
+                pass
+        return SearchResult(
+            response=context,
+            context_data={},
+            context_text=context,
+            completion_time=time.time() - start_time,
+            llm_calls=sum(response.llm_calls for response in map_responses),
+            prompt_tokens=sum(response.prompt_tokens for response in map_responses),
         )
 
+    async def astream_context(
+        self,
+        query: str,
+        conversation_history: ConversationHistory | None = None,
+        map_responses: list[SearchResult] | None = None,
+    ) -> AsyncGenerator[str, None]:
+        """
+        map結果が届くたびに、その時点までのkey pointから作ったreduce用の入力を返す。
+        最後に返す値がasearchの結果と同じになる。
+        `map_responses`を渡すと、届いたmap結果をそこに追加する。
+        """
+        # Step 1: Generate answers for each batch of community short summaries
+        with tracing.span("global_search.build_context") as span:
+            context_chunks, context_records = self.context_builder.build_context(
+                conversation_history=conversation_history,
+                query=query,
+                **self.context_builder_params,
+            )
+            span.set_attribute("context.batches", len(context_chunks))
+
         if self.callbacks:
             for callback in self.callbacks:
                 callback.on_map_response_start(context_chunks)  # type: ignore
-        map_responses = await asyncio.gather(
-            *[
-                self._map_response_single_batch(
-                    context_data=data, query=query, **self.map_llm_params
-                )
-                for data in context_chunks
-            ]
+
+        # Step 2: Feed the intermediate answers into the reduce context as they arrive
+        key_points = KeyPointHeap()
+        if map_responses is None:
+            map_responses = []
+        context = None
+        # generatorのyieldをまたぐため、current spanにはせずbatchのspanの親として渡す
+        map_span = tracing.start_span(
+            "global_search.map", {"map.batches": len(context_chunks)}
         )
+        n_responses = len(map_responses)
+        try:
+            async for index, response in self._map_as_completed(
+                context_chunks, query, map_span
+            ):
+                map_responses.append(response)
+                if key_points.push(index, response) > 0:
+                    context = self._build_reduce_context(key_points, query)
+                    yield context
+        finally:
+            map_span.set_attributes(
+                {
+                    "map.completed": len(map_responses) - n_responses,
+                    "map.key_points": len(key_points),
+                    "llm.prompt_tokens": sum(
+                        response.prompt_tokens
+                        for response in map_responses[n_responses:]
+                    ),
+                }
+            )
+            map_span.end()
+
         if self.callbacks:
             for callback in self.callbacks:
                 callback.on_map_response_end(map_responses)
 
-        # Step 2: Combine the intermediate answers from step 2 to generate the final answer
-        reduce_response = await self._reduce_response(
-            map_responses=map_responses,
-            query=query,
-            **self.reduce_llm_params,
+        if context is None:
+            yield self._build_reduce_context(key_points, query)
+
+    async def _map_as_completed(
+        self,
+        context_chunks: list[str],
+        query: str,
+        span: tracing.Span | None = None,
+    ) -> AsyncGenerator[tuple[int, SearchResult], None]:
+        """Yield (batch index, map response) in completion order until a cutoff is reached."""
+        loop = asyncio.get_running_loop()
+        deadline = (
+            loop.time() + self.map_deadline if self.map_deadline is not None else None
+        )
+        window = (
+            self.early_stop_wave_size
+            if self.early_stop_points is not None
+            else len(context_chunks)
+        )
+        required = math.ceil(self.map_completion_ratio * len(context_chunks))
+
+        pending: dict[asyncio.Task, int] = {}
+        next_index = 0
+        n_completed = 0
+        n_good_points = 0
+        try:
+            while next_index < len(context_chunks) or pending:
+                while next_index < len(context_chunks) and len(pending) < window:
+                    task = asyncio.create_task(
+                        self._map_with_timeout(
+                            context_chunks[next_index], query, next_index, span
+                        )
+                    )
+                    pending[task] = next_index
+                    next_index += 1
+
+                timeout = None if deadline is None else max(deadline - loop.time(), 0)
+                done, _ = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    tracing.current_span().set_attribute("map.deadline_reached", True)
+                    log.warning(
+                        "map deadline reached, %d batches dropped",
+                        len(pending) + len(context_chunks) - next_index,
+                    )
+                    return
+
+                for task in done:
+                    index = pending.pop(task)
+                    response = task.result()
+                    n_completed += 1
+                    n_good_points += self._count_points(
+                        response, self.early_stop_min_score
+                    )
+                    yield index, response
+
+                if n_completed >= required:
+                    return
+                if (
+                    self.early_stop_points is not None
+                    and n_good_points >= self.early_stop_points
+                ):
+                    return
+        finally:
+            # 打ち切ったbatchのLLM呼び出しはキャンセルする
+            for task in pending:
+                task.cancel()
+
+    async def _map_with_timeout(
+        self,
+        context_data: str,
+        query: str,
+        index: int = 0,
+        parent_span: tracing.Span | None = None,
+    ) -> SearchResult:
+        start_time = time.time()
+        with tracing.span(
+            "global_search.map_batch", {"map.batch": index}, parent=parent_span
+        ) as span:
+            try:
+                result = await asyncio.wait_for(
+                    self._map_response_single_batch(
+                        context_data=context_data, query=query, **self.map_llm_params
+                    ),
+                    timeout=self.map_batch_timeout,
+                )
+            except asyncio.TimeoutError:
+                log.warning(
+                    "map batch timed out after %s seconds", self.map_batch_timeout
+                )
+                span.set_attribute("map.timed_out", True)
+                return SearchResult(
+                    response=[],
+                    context_data=context_data,
+                    context_text=context_data,
+                    completion_time=time.time() - start_time,
+                    llm_calls=1,
+                    prompt_tokens=0,
+                )
+            span.set_attributes(
+                {
+                    "llm.prompt_tokens": result.prompt_tokens,
+                    "map.points": (
+                        len(result.response) if isinstance(result.response, list) else 0
+                    ),
+                }
+            )
+            return result
+
+    @staticmethod
+    def _count_points(response: SearchResult, min_score: float) -> int:
+        if not isinstance(response.response, list):
+            return 0
+        return sum(
+            1
+            for element in response.response
+            if isinstance(element, dict) and element.get("score", 0) >= min_score
         )
 
-        return reduce_response
+    async def _map_response_single_batch(
+        self,
+        context_data: str,
+        query: str,
+        **llm_kwargs,
+    ) -> SearchResult:
+        if self.map_cache is None:
+            return await super()._map_response_single_batch(
+                context_data=context_data, query=query, **llm_kwargs
+            )
+
+        # 同じクエリ・chunkに対するmap結果があればLLMを呼ばない
+        key = self.map_cache.make_key(
+            query,
+            context_data,
+            {"model": getattr(self.llm, "model", None), **llm_kwargs},
+            self.map_system_prompt,
+        )
+        cached = self.map_cache.get(key, context_data)
+        tracing.current_span().set_attribute("map_cache.hit", cached is not None)
+        if cached is not None:
+            return cached
+
+        result = await super()._map_response_single_batch(
+            context_data=context_data, query=query, **llm_kwargs
+        )
+        self.map_cache.set(key, result)
+        return result
 
     async def _reduce_response(
         self,
@@ -172,77 +786,92 @@ class GlobalSearchForAssistantsAPI(GlobalSearch):
         query: str,
         **llm_kwargs,
     ):
-        text_data = ""
-        search_prompt = ""
-        try:
-            # collect all key points into a single list to prepare for sorting
-            key_points = []
-            for index, response in enumerate(map_responses):
-                if not isinstance(response.response, list):
-                    continue
-                for element in response.response:
-                    if not isinstance(element, dict):
-                        continue
-                    if "answer" not in element or "score" not in element:
-                        continue
-                    key_points.append(
-                        {
-                            "analyst": index,
-                            "answer": element["answer"],
-                            "score": element["score"],
-                        }
-                    )
-
-            # filter response with score = 0 and rank r esponses by descending order of score
-            filtered_key_points = [
-                point
-                for point in key_points
-                if point["score"] > 0  # type: ignore
-            ]
-
-            if len(filtered_key_points) == 0 and not self.allow_general_knowledge:
-                # return no data answer if no key points are found
-                return query
+        key_points = KeyPointHeap()
+        for index, response in enumerate(map_responses):
+            key_points.push(index, response)
+        return self._build_reduce_context(key_points, query)
 
-            filtered_key_points = sorted(
-                filtered_key_points,
-                key=lambda x: x["score"],  # type: ignore
-                reverse=True,  # type: ignore
-            )
+    def _build_reduce_context(self, key_points: KeyPointHeap, query: str) -> str:
+        if len(key_points) == 0 and not self.allow_general_knowledge:
+            # return no data answer if no key points are found
+            return query
 
-            data = []
-            total_tokens = 0
-            for point in filtered_key_points:
-                formatted_response_data = []
-                formatted_response_data.append(
-                    f'----Analyst {point["analyst"] + 1}----'
+        with tracing.span("global_search.reduce_context") as span:
+            try:
+                selected, total_tokens = key_points.select(
+                    self.max_data_tokens, self.token_encoder
                 )
-                formatted_response_data.append(
-                    f'Importance Score: {point["score"]}'  # type: ignore
+            except Exception as e:
+                log.exception(
+                    "Failed to count tokens of %d key points", len(key_points)
                 )
-                formatted_response_data.append(point["answer"])  # type: ignore
-                formatted_response_text = "\n".join(formatted_response_data)
-                if (
-                    total_tokens
-                    + num_tokens(formatted_response_text, self.token_encoder)
-                    > self.max_data_tokens
-                ):
-                    break
-                data.append(formatted_response_text)
-                total_tokens += num_tokens(formatted_response_text, self.token_encoder)
-            text_data = "\n\n".join(data)
+                raise ReduceContextError(
+                    f"failed to fit {len(key_points)} key points into "
+                    f"{self.max_data_tokens} tokens"
+                ) from e
+            span.set_attributes(
+                {
+                    "reduce.key_points": len(key_points),
+                    "reduce.selected": len(selected),
+                    "reduce.tokens": total_tokens,
+                }
+            )
 
-            search_prompt = self.reduce_system_prompt.format(
-                report_data=text_data, response_type=self.response_type
+        if len(key_points) > 0 and len(selected) == 0:
+            log.warning(
+                "No key point fits into max_data_tokens=%d (best one needs %d tokens)",
+                self.max_data_tokens,
+                key_points.token_counts[next(key_points.iter_sorted())],
             )
-            if self.allow_general_knowledge:
-                search_prompt += "\n" + self.general_knowledge_inclusion_prompt
-            return f"{search_prompt}---User Questions---\n\n{query}"
+        text_data = "\n\n".join(key_points.format(index) for index in selected)
+        log.debug(
+            "reduce context: %d/%d key points, %d tokens",
+            len(selected),
+            len(key_points),
+            total_tokens,
+        )
 
-        except Exception:
-            return 0
+        search_prompt = self.reduce_system_prompt.format(
+            report_data=text_data, response_type=self.response_type
+        )
+        if self.allow_general_knowledge:
+            search_prompt += "\n" + self.general_knowledge_inclusion_prompt
+        return f"{search_prompt}---User Questions---\n\n{query}"
 
 
 class LocalSearchForAssistantsAPI(LocalSearch):
-    # TODO
-    pass
+    """
+    AssistantsAPIを利用するために、最終的な入力を返却するように修正したLocalSearch
+    """
+
+    async def asearch(
+        self,
+        query: str,
+        conversation_history: ConversationHistory | None = None,
+        **kwargs: Any,
+    ):
+        # contextの作成にはembeddingの取得が含まれるため、event loopを止めないよう別スレッドで行う。
+        # rate limiterがsessionを区別できるよう、contextvarsを引き継ぐto_threadを使う
+        with tracing.span("local_search.build_context") as span:
+            context_text, _ = await asyncio.to_thread(
+                partial(
+                    self.context_builder.build_context,
+                    query=query,
+                    conversation_history=conversation_history,
+                    # 呼び出し側の指定を優先する(同じkeyを2度渡すとTypeErrorになる)
+                    **{**self.context_builder_params, **kwargs},
+                )
+            )
+            span.set_attribute("context.chars", len(context_text))
+        search_prompt = self.system_prompt.format(
+            context_data=context_text, response_type=self.response_type
+        )
+        return f"{search_prompt}---User Questions---\n\n{query}"
+
+    def search(
+        self,
+        query: str,
+        conversation_history: ConversationHistory | None = None,
+        **kwargs: Any,
+    ):
+        return run(self.asearch(query, conversation_history, **kwargs))
@@ -1,41 +1,270 @@
 import asyncio
+import hashlib
+import json
+import os
 import shutil
+import time
 import warnings
+from typing import Callable
 
+import pandas as pd
 import uvloop
+from graphrag.config.models import GraphRagConfig
 from graphrag.index import create_pipeline_config
 from graphrag.index.run import run_pipeline_with_config
 
 from .common import create_graphrag_config_from_yaml
+from .document_store import corpus_hash, get_corpus_index
+from .engine_cache import artifacts_dir, current_run_id
+from .indexing_profiler import IndexingProfiler
+from .llm_cache import get_indexing_cache
 
 warnings.filterwarnings("ignore")
 
+MANIFEST_FILE = "input_manifest.json"
+# 全GraphStoreで共有するprompt。GraphStoreごとにはコピーせず、configから参照する
+SHARED_PROMPTS_DIR = "data/graphrag/prompts"
+
+
+class IndexingError(Exception):
+    """Raised when a workflow of the indexing pipeline fails."""
+
+
+def input_manifest(root: str) -> dict[str, str]:
+    """Return the sha256 of every file in the input directory, keyed by file name."""
+    input_dir = f"{root}/input"
+    manifest = {}
+    for name in sorted(os.listdir(input_dir)):
+        path = os.path.join(input_dir, name)
+        if not os.path.isfile(path):
+            continue
+        manifest[name] = _file_sha256(path)
+    return manifest
+
+
+def load_manifest(root: str, run_id: str | None = None) -> dict:
+    path = f"{root}/output/{run_id or current_run_id(root)}/{MANIFEST_FILE}"
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def diff_manifest(previous: dict[str, str], current: dict[str, str]) -> dict:
+    return {
+        "added": sorted(name for name in current if name not in previous),
+        "changed": sorted(
+            name
+            for name in current
+            if name in previous and previous[name] != current[name]
+        ),
+        "removed": sorted(name for name in previous if name not in current),
+    }
+
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def use_shared_prompts(config: GraphRagConfig) -> None:
+    """Point the prompt paths of `config` at SHARED_PROMPTS_DIR instead of the root."""
+    base_dir = os.path.dirname(os.path.abspath(SHARED_PROMPTS_DIR))
+    for section in [
+        config.entity_extraction,
+        config.summarize_descriptions,
+        config.claim_extraction,
+        config.community_reports,
+    ]:
+        if section.prompt and not os.path.isabs(section.prompt):
+            section.prompt = os.path.join(base_dir, section.prompt)
+
+
+def corpus_key(files: dict[str, str], llm_model: str, config_path: str) -> str:
+    """Hash of a corpus and of everything else that determines its index."""
+    prompts = {
+        name: _file_sha256(os.path.join(SHARED_PROMPTS_DIR, name))
+        for name in sorted(os.listdir(SHARED_PROMPTS_DIR))
+    }
+    return corpus_hash(
+        files,
+        llm_model=llm_model,
+        config=_file_sha256(config_path),
+        prompts=prompts,
+    )
+
+
+def find_graph_store(
+    files: dict[str, str], llm_model: str, config_path: str = "config/graphrag.yaml"
+) -> str | None:
+    """
+    Return the root of a GraphStore whose published index was built from `files`
+    (file name -> sha256) with the same settings, or None.
+    """
+    corpus_index = get_corpus_index()
+    key = corpus_key(files, llm_model, config_path)
+    root = corpus_index.get(key)
+    if root is None:
+        return None
+    # GraphStoreが削除された・文書が追加された場合は、索引から外す
+    if load_manifest(root).get("files") != files:
+        corpus_index.remove(key)
+        return None
+    return root
+
+
+def _text_unit_ids(root: str, run_id: str) -> set[str]:
+    path = f"{artifacts_dir(root, run_id)}/create_final_text_units.parquet"
+    if not os.path.exists(path):
+        return set()
+    return set(pd.read_parquet(path, columns=["id"])["id"])
+
+
+def _new_run_id(root: str) -> str:
+    run_id = time.strftime("%Y%m%d-%H%M%S")
+    suffix = 1
+    while os.path.exists(f"{root}/output/{run_id}"):
+        run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{suffix}"
+        suffix += 1
+    return run_id
+
+
+def publish_run(root: str, run_id: str, keep_versions: int = 2) -> None:
+    """
+    `output/CURRENT`を書き換えて、run_idのartifactを読み込み対象にする。
+    書き換えはos.replaceで行うため、読み込み側が書きかけのartifactを見ることはない。
+    読み込み中の可能性がある直前のバージョンは残し、それより古いものは削除する。
+    削除したrunのprofileは`output/profiles`に残る(IndexingProfiler.save)。
+    """
+    pointer = f"{root}/output/CURRENT"
+    tmp_pointer = f"{pointer}.{os.getpid()}.tmp"
+    with open(tmp_pointer, "w", encoding="utf-8") as f:
+        f.write(run_id)
+    os.replace(tmp_pointer, pointer)
+
+    versions = sorted(
+        name
+        for name in os.listdir(f"{root}/output")
+        if os.path.exists(f"{root}/output/{name}/{MANIFEST_FILE}")
+    )
+    for name in versions[:-keep_versions]:
+        if name != run_id:
+            shutil.rmtree(f"{root}/output/{name}", ignore_errors=True)
+
+
+def discard_run(root: str, run_id: str) -> None:
+    """Delete the output of an unfinished run, unless it has already been published."""
+    if run_id != current_run_id(root):
+        shutil.rmtree(f"{root}/output/{run_id}", ignore_errors=True)
+
 
 def create(
     root: str,
     api_key: str,
     llm_model: str,
     config_path: str = "config/graphrag.yaml",
-):
-    """Run the pipeline with the given config."""
-    run_id = "default"
-    _ = shutil.copytree("data/graphrag/prompts", f"{root}/prompts", dirs_exist_ok=True)
+    on_workflow_end: Callable[[str, int, int], None] | None = None,
+    on_run_start: Callable[[str], None] | None = None,
+) -> str:
+    """
+    Run the pipeline with the given config and publish the result as a new version.
+
+    `on_run_start(run_id)` is called before the pipeline writes to `output/<run_id>`,
+    and `on_workflow_end(workflow, completed, total)` after each workflow.
+    Returns the run id of the published version.
+    """
+    run_id = _new_run_id(root)
+    if on_run_start is not None:
+        on_run_start(run_id)
+    previous_run_id = current_run_id(root)
+    manifest = input_manifest(root)
 
     graphrag_config = create_graphrag_config_from_yaml(
         root, config_path, api_key, llm_model
     )
+    use_shared_prompts(graphrag_config)
     pipeline_config = create_pipeline_config(graphrag_config)
+    total = len(pipeline_config.workflows)
+    cache = get_indexing_cache()
+    profiler = IndexingProfiler(graphrag_config, cache)
 
     def _run_workflow_async() -> None:
         async def execute():
+            completed = 0
+            # LLM・embeddingの呼び出し結果は全GraphStoreで共有するキャッシュに保存する
             async for output in run_pipeline_with_config(
                 pipeline_config,
                 run_id=run_id,
+                cache=cache.pipeline_cache(),
             ):
+                profiler.workflow_end(output.workflow, output.result)
                 if output.errors and len(output.errors) > 0:
-                    return
+                    raise IndexingError(
+                        f"workflow {output.workflow} failed: {output.errors[0]}"
+                    )
+                completed += 1
+                if on_workflow_end is not None:
+                    on_workflow_end(output.workflow, completed, total)
 
         uvloop.install()
         asyncio.run(execute())
 
-    _run_workflow_async()
+    try:
+        with profiler:
+            _run_workflow_async()
+    except BaseException:
+        # 途中までのartifactは公開せずに削除する
+        shutil.rmtree(f"{root}/output/{run_id}", ignore_errors=True)
+        raise
+    finally:
+        cache.flush_stats()
+
+    previous_text_units = _text_unit_ids(root, previous_run_id)
+    text_units = _text_unit_ids(root, run_id)
+    with open(f"{root}/output/{run_id}/{MANIFEST_FILE}", "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "run_id": run_id,
+                "previous_run_id": previous_run_id if previous_text_units else None,
+                "files": manifest,
+                "changes": diff_manifest(load_manifest(root).get("files", {}), manifest),
+                "text_units": len(text_units),
+                "new_text_units": len(text_units - previous_text_units),
+            },
+            f,
+            ensure_ascii=False,
+            indent=2,
+        )
+    profiler.save(root, run_id)
+    publish_run(root, run_id)
+    # 同じcorpusがアップロードされた場合は、このGraphStoreを返す
+    get_corpus_index().register(corpus_key(manifest, llm_model, config_path), root)
+    return run_id
+
+
+def append(
+    root: str,
+    api_key: str,
+    llm_model: str,
+    config_path: str = "config/graphrag.yaml",
+    on_workflow_end: Callable[[str, int, int], None] | None = None,
+    on_run_start: Callable[[str], None] | None = None,
+) -> str | None:
+    """
+    Re-index a GraphStore after documents were added to or changed in its input directory.
+
+    The pipeline uses the shared indexing LLM cache, so chunks, entity descriptions
+    and communities whose content did not change are served from the cache and
+    only the new or affected ones are sent to the LLM.
+    Returns the new run id, or None if the input files are unchanged.
+    """
+    previous = load_manifest(root).get("files")
+    if previous is not None:
+        changes = diff_manifest(previous, input_manifest(root))
+        if not any(changes.values()):
+            return None
+    return create(root, api_key, llm_model, config_path, on_workflow_end, on_run_start)
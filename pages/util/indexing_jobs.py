@@ -0,0 +1,325 @@
+import json
+import multiprocessing
+import os
+import random
+import string
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from typing import Any
+
+from . import graph_store
+
+DEFAULT_JOBS_DIR = "data/graphrag/jobs"
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+TERMINAL_STATUSES = {SUCCEEDED, FAILED, CANCELLED}
+
+
+@dataclass
+class IndexingJob:
+    job_id: str
+    graph_store_id: str
+    root: str
+    llm_model: str
+    mode: str = "create"
+    status: str = QUEUED
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+    completed_workflows: int = 0
+    total_workflows: int = 0
+    current_workflow: str | None = None
+    run_id: str | None = None
+    error: str | None = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+    @property
+    def progress(self) -> float:
+        if self.status == SUCCEEDED:
+            return 1.0
+        if self.total_workflows == 0:
+            return 0.0
+        return self.completed_workflows / self.total_workflows
+
+
+class JobStore:
+    """
+    jobの状態を`{job_id}.json`に、進捗のイベントを`{job_id}.events.jsonl`に保存する。
+    indexingを行う子プロセスとStreamlitのプロセスの両方から読み書きされる。
+    """
+
+    def __init__(self, directory: str = DEFAULT_JOBS_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, job_id: str, suffix: str = ".json") -> str:
+        return os.path.join(self.directory, f"{job_id}{suffix}")
+
+    def save(self, job: IndexingJob) -> None:
+        # 読み込み側が書きかけのファイルを読まないように、一時ファイルから置き換える
+        path = self._path(job.job_id)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(asdict(job), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def load(self, job_id: str) -> IndexingJob | None:
+        try:
+            with open(self._path(job_id), encoding="utf-8") as f:
+                return IndexingJob(**json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def list_jobs(self) -> list[IndexingJob]:
+        jobs = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                job = self.load(name.removesuffix(".json"))
+                if job is not None:
+                    jobs.append(job)
+        return sorted(jobs, key=lambda job: job.created_at)
+
+    def append_event(self, job_id: str, event_type: str, **data: Any) -> None:
+        event = {"time": time.time(), "type": event_type, **data}
+        with open(self._path(job_id, ".events.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+    def events(self, job_id: str) -> list[dict[str, Any]]:
+        try:
+            with open(self._path(job_id, ".events.jsonl"), encoding="utf-8") as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def update(self, job_id: str, event_type: str, **changes: Any) -> IndexingJob:
+        job = self.load(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        for key, value in changes.items():
+            setattr(job, key, value)
+        self.save(job)
+        self.append_event(job_id, event_type, **changes)
+        return job
+
+
+def _run_job(job_id: str, directory: str, api_key: str, config_path: str) -> None:
+    """Entry point of the child process that runs the indexing pipeline."""
+    # chatのページの応答を妨げないように、indexingの優先度を下げる
+    try:
+        os.nice(5)
+    except OSError:
+        pass
+
+    store = JobStore(directory)
+    job = store.update(job_id, "status", status=RUNNING, started_at=time.time())
+
+    def on_workflow_end(workflow: str, completed: int, total: int) -> None:
+        store.update(
+            job_id,
+            "workflow_end",
+            current_workflow=workflow,
+            completed_workflows=completed,
+            total_workflows=total,
+        )
+
+    def on_run_start(run_id: str) -> None:
+        # terminateでキャンセルされると後始末が走らないため、
+        # 途中のrunを親プロセスが消せるようにrun idを記録しておく
+        store.update(job_id, "run_start", run_id=run_id)
+
+    # appendでは既存のLLMキャッシュを使って、変更のあったchunkだけをLLMに送る
+    run = graph_store.append if job.mode == "append" else graph_store.create
+    try:
+        run_id = run(
+            job.root,
+            api_key,
+            job.llm_model,
+            config_path,
+            on_workflow_end=on_workflow_end,
+            on_run_start=on_run_start,
+        )
+    except Exception as e:
+        store.update(
+            job_id,
+            "status",
+            status=FAILED,
+            error=f"{type(e).__name__}: {e}",
+            finished_at=time.time(),
+        )
+        return
+    store.update(
+        job_id, "status", status=SUCCEEDED, run_id=run_id, finished_at=time.time()
+    )
+
+
+class IndexingJobManager:
+    """
+    GraphStoreのindexingをバックグラウンドの子プロセスで実行するjob queue。
+    同時に実行するjobは`max_concurrent_jobs`までとし、残りは投入順に待たせる。
+    jobごとに専用のプロセスを使うため、実行中のjobもterminateで確実にキャンセルできる。
+    """
+
+    def __init__(
+        self,
+        max_concurrent_jobs: int = 2,
+        directory: str = DEFAULT_JOBS_DIR,
+        poll_interval: float = 1.0,
+    ):
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.poll_interval = poll_interval
+        self.store = JobStore(directory)
+        # Streamlitのスレッドを引き継がないようにspawnで子プロセスを作る
+        self._context = multiprocessing.get_context("spawn")
+        self._pending: deque[tuple[str, str, str, str]] = deque()
+        self._running: dict[str, multiprocessing.process.BaseProcess] = {}
+        self._running_roots: dict[str, str] = {}
+        self._cancelled: set[str] = set()
+        self._condition = threading.Condition()
+        self._recover_interrupted_jobs()
+        self._dispatcher = threading.Thread(
+            target=self._dispatch, name="indexing-job-dispatcher", daemon=True
+        )
+        self._dispatcher.start()
+
+    def _recover_interrupted_jobs(self) -> None:
+        """Mark jobs left unfinished by a previous server process as failed."""
+        for job in self.store.list_jobs():
+            if not job.done:
+                self.store.update(
+                    job.job_id,
+                    "status",
+                    status=FAILED,
+                    error="interrupted by server restart",
+                    finished_at=time.time(),
+                )
+
+    def submit(
+        self,
+        root: str,
+        graph_store_id: str,
+        api_key: str,
+        llm_model: str,
+        config_path: str = "config/graphrag.yaml",
+        mode: str = "create",
+    ) -> str:
+        """
+        Queue an indexing run for `root` and return its job id.
+
+        `mode="append"` re-indexes an existing GraphStore after documents were added.
+        """
+        job_id = "job_" + "".join(
+            random.choices(string.ascii_letters + string.digits, k=24)
+        )
+        job = IndexingJob(
+            job_id=job_id,
+            graph_store_id=graph_store_id,
+            root=root,
+            llm_model=llm_model,
+            mode=mode,
+        )
+        self.store.save(job)
+        self.store.append_event(job_id, "status", status=QUEUED)
+        # API keyはファイルに保存せず、子プロセスの引数としてのみ渡す
+        with self._condition:
+            self._pending.append((job_id, root, api_key, config_path))
+            self._condition.notify()
+        return job_id
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a queued or running job. Returns False if it had already finished."""
+        with self._condition:
+            for pending in self._pending:
+                if pending[0] == job_id:
+                    self._pending.remove(pending)
+                    self.store.update(
+                        job_id, "status", status=CANCELLED, finished_at=time.time()
+                    )
+                    return True
+            process = self._running.get(job_id)
+            if process is None:
+                return False
+            self._cancelled.add(job_id)
+            process.terminate()
+            self._condition.notify()
+            return True
+
+    def get(self, job_id: str) -> IndexingJob | None:
+        return self.store.load(job_id)
+
+    def events(self, job_id: str) -> list[dict[str, Any]]:
+        return self.store.events(job_id)
+
+    def list_jobs(self) -> list[IndexingJob]:
+        return self.store.list_jobs()
+
+    def _dispatch(self) -> None:
+        while True:
+            with self._condition:
+                self._reap()
+                for pending in list(self._pending):
+                    if len(self._running) >= self.max_concurrent_jobs:
+                        break
+                    job_id, root, api_key, config_path = pending
+                    # 同じGraphStoreのjobは、先に投入されたものが終わるまで待たせる
+                    if root in self._running_roots.values():
+                        continue
+                    self._pending.remove(pending)
+                    process = self._context.Process(
+                        target=_run_job,
+                        args=(job_id, self.store.directory, api_key, config_path),
+                        name=f"indexing-{job_id}",
+                        daemon=True,
+                    )
+                    process.start()
+                    self._running[job_id] = process
+                    self._running_roots[job_id] = root
+                self._condition.wait(self.poll_interval)
+
+    def _reap(self) -> None:
+        for job_id, process in list(self._running.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del self._running[job_id]
+            del self._running_roots[job_id]
+            job = self.store.load(job_id)
+            if job_id in self._cancelled:
+                self._cancelled.discard(job_id)
+                self.store.update(
+                    job_id, "status", status=CANCELLED, finished_at=time.time()
+                )
+            elif job is not None and not job.done:
+                # 子プロセスが状態を書き込む前に異常終了した場合
+                self.store.update(
+                    job_id,
+                    "status",
+                    status=FAILED,
+                    error=f"indexing process exited with code {process.exitcode}",
+                    finished_at=time.time(),
+                )
+            job = self.store.load(job_id)
+            if job is not None and job.status != SUCCEEDED and job.run_id is not None:
+                # SIGTERMで止めた子プロセスは途中までのoutputを残すため、ここで削除する
+                graph_store.discard_run(job.root, job.run_id)
+
+
+_job_manager: IndexingJobManager | None = None
+_job_manager_lock = threading.Lock()
+
+
+def get_job_manager() -> IndexingJobManager:
+    """Return the process-wide indexing job manager, creating it on first use."""
+    global _job_manager
+    with _job_manager_lock:
+        if _job_manager is None:
+            _job_manager = IndexingJobManager()
+        return _job_manager
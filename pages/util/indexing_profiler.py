@@ -0,0 +1,267 @@
+import json
+import logging
+import os
+import resource
+import shutil
+import threading
+import time
+from dataclasses import asdict, dataclass
+
+import pandas as pd
+import psutil
+from graphrag.config.models import GraphRagConfig
+
+from .llm_cache import IndexingLLMCache
+
+PROFILE_FILE = "profile.json"
+PROFILE_TABLE = "profile.parquet"
+# run dirは古いものから削除されるため、比較用のreportは`output/profiles/<run_id>.json`にも残す
+PROFILES_DIR = "profiles"
+
+# graphragはLLM呼び出しごとの所要時間・トークン数・リトライ回数をこのloggerに出力する
+_RATE_LIMITING_LOGGER = "graphrag.llm.base.rate_limiting_llm"
+
+
+@dataclass
+class WorkflowProfile:
+    workflow: str
+    started_at: float
+    wall_time: float
+    llm_calls: int = 0
+    llm_time: float = 0.0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    retries: int = 0
+    rate_limit_waits: int = 0
+    rate_limit_sleep: float = 0.0
+    cache_hits: int = 0
+    cache_misses: int = 0
+    peak_rss_mb: float = 0.0
+    rows: int | None = None
+
+
+class _LLMLogHandler(logging.Handler):
+    """Aggregate graphrag's per-invocation perf logs into counters."""
+
+    def __init__(self):
+        super().__init__(level=logging.INFO)
+        self.counters = _empty_counters()
+        self._counter_lock = threading.Lock()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        message = str(record.msg)
+        args = record.args if isinstance(record.args, tuple) else ()
+        with self._counter_lock:
+            if message.startswith("perf - llm.") and len(args) == 6:
+                _, _, retries, total_time, input_tokens, output_tokens = args
+                self.counters["llm_calls"] += 1
+                self.counters["llm_time"] += float(total_time)
+                self.counters["retries"] += int(retries)
+                self.counters["input_tokens"] += int(input_tokens)
+                self.counters["output_tokens"] += int(output_tokens)
+            elif "rate limit exceeded" in message and len(args) == 5:
+                _, _, _, sleep_time, follow_recommendation = args
+                self.counters["rate_limit_waits"] += 1
+                if follow_recommendation and sleep_time:
+                    self.counters["rate_limit_sleep"] += float(sleep_time)
+
+    def take(self) -> dict[str, float]:
+        with self._counter_lock:
+            counters = self.counters
+            self.counters = _empty_counters()
+            return counters
+
+
+def _empty_counters() -> dict[str, float]:
+    return {
+        "llm_calls": 0,
+        "llm_time": 0.0,
+        "retries": 0,
+        "input_tokens": 0,
+        "output_tokens": 0,
+        "rate_limit_waits": 0,
+        "rate_limit_sleep": 0.0,
+    }
+
+
+class IndexingProfiler:
+    """
+    indexingのworkflowごとに、所要時間・LLM呼び出し・トークン数・キャッシュヒット・メモリを記録する。
+    graphragのworkflowは順番に実行されるため、前のworkflowの終了から次の終了までを1区間として集計する。
+    """
+
+    def __init__(
+        self,
+        config: GraphRagConfig | None = None,
+        cache: IndexingLLMCache | None = None,
+        sample_interval: float = 0.5,
+    ):
+        self.config = config
+        self.cache = cache
+        self.sample_interval = sample_interval
+        self.workflows: list[WorkflowProfile] = []
+        self.started_at = 0.0
+        self.finished_at = 0.0
+        self._handler = _LLMLogHandler()
+        self._logger = logging.getLogger(_RATE_LIMITING_LOGGER)
+        self._logger_level = self._logger.level
+        self._process = psutil.Process()
+        self._peak_rss = 0
+        self._rss_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler: threading.Thread | None = None
+
+    def __enter__(self) -> "IndexingProfiler":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        self.started_at = time.time()
+        self._window_start = self.started_at
+        self._cache_counts = self._cache_snapshot()
+        self._logger.addHandler(self._handler)
+        if self._logger.getEffectiveLevel() > logging.INFO:
+            self._logger.setLevel(logging.INFO)
+        self._sampler = threading.Thread(
+            target=self._sample_rss, name="indexing-profiler", daemon=True
+        )
+        self._sampler.start()
+
+    def stop(self) -> None:
+        self.finished_at = time.time()
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        self._logger.removeHandler(self._handler)
+        self._logger.setLevel(self._logger_level)
+
+    def _sample_rss(self) -> None:
+        while not self._stop.wait(self.sample_interval):
+            self._record_rss()
+
+    def _record_rss(self) -> None:
+        rss = self._process.memory_info().rss
+        with self._rss_lock:
+            self._peak_rss = max(self._peak_rss, rss)
+
+    def _take_peak_rss(self) -> int:
+        self._record_rss()
+        with self._rss_lock:
+            peak = self._peak_rss
+            self._peak_rss = 0
+            return peak
+
+    def _cache_snapshot(self) -> tuple[int, int]:
+        if self.cache is None:
+            return 0, 0
+        return self.cache.session_hits, self.cache.session_misses
+
+    def workflow_end(self, workflow: str, result: pd.DataFrame | None = None) -> None:
+        """Close the current measurement window and attribute it to `workflow`."""
+        now = time.time()
+        hits, misses = self._cache_snapshot()
+        self.workflows.append(
+            WorkflowProfile(
+                workflow=workflow,
+                started_at=self._window_start,
+                wall_time=now - self._window_start,
+                cache_hits=hits - self._cache_counts[0],
+                cache_misses=misses - self._cache_counts[1],
+                peak_rss_mb=self._take_peak_rss() / 1024**2,
+                rows=None if result is None else len(result),
+                **self._handler.take(),
+            )
+        )
+        self._window_start = now
+        self._cache_counts = (hits, misses)
+
+    def settings(self) -> dict:
+        """Return the config values that are usually tuned for indexing throughput."""
+        if self.config is None:
+            return {}
+        return {
+            "llm_model": self.config.llm.model,
+            "concurrent_requests": self.config.llm.concurrent_requests,
+            "tokens_per_minute": self.config.llm.tokens_per_minute,
+            "requests_per_minute": self.config.llm.requests_per_minute,
+            "stagger": self.config.parallelization.stagger,
+            "num_threads": self.config.parallelization.num_threads,
+            "async_mode": str(self.config.async_mode),
+            "chunk_size": self.config.chunks.size,
+            "chunk_overlap": self.config.chunks.overlap,
+            "max_gleanings": self.config.entity_extraction.max_gleanings,
+        }
+
+    def report(self) -> dict:
+        df = self.to_dataframe()
+        totals = {
+            column: df[column].sum().item() if len(df) else 0
+            for column in [
+                "llm_calls",
+                "input_tokens",
+                "output_tokens",
+                "retries",
+                "rate_limit_waits",
+                "rate_limit_sleep",
+                "cache_hits",
+                "cache_misses",
+            ]
+        }
+        return {
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "wall_time": self.finished_at - self.started_at,
+            # ru_maxrssはLinuxではKB単位
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "settings": self.settings(),
+            "totals": totals,
+            "workflows": [asdict(workflow) for workflow in self.workflows],
+        }
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(
+            [asdict(workflow) for workflow in self.workflows],
+            columns=list(WorkflowProfile.__dataclass_fields__),
+        )
+
+    def write(self, directory: str) -> None:
+        """Write `profile.json` and `profile.parquet` into `directory`."""
+        os.makedirs(directory, exist_ok=True)
+        with open(f"{directory}/{PROFILE_FILE}", "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2)
+        self.to_dataframe().to_parquet(f"{directory}/{PROFILE_TABLE}")
+
+    def save(self, root: str, run_id: str) -> None:
+        """Write the profile into the run dir and keep a copy that outlives the run dir."""
+        self.write(f"{root}/output/{run_id}")
+        profiles_dir = f"{root}/output/{PROFILES_DIR}"
+        os.makedirs(profiles_dir, exist_ok=True)
+        shutil.copyfile(
+            f"{root}/output/{run_id}/{PROFILE_FILE}", f"{profiles_dir}/{run_id}.json"
+        )
+
+
+def load_profiles(root: str) -> dict[str, dict]:
+    """Return the profile reports of every indexing run of a GraphStore, keyed by run id."""
+    output_dir = f"{root}/output"
+    if not os.path.isdir(output_dir):
+        return {}
+    paths = {}
+    # profilesに残す前のrunは、run dirのprofile.jsonだけがある
+    for run_id in os.listdir(output_dir):
+        path = f"{output_dir}/{run_id}/{PROFILE_FILE}"
+        if os.path.exists(path):
+            paths[run_id] = path
+    profiles_dir = f"{output_dir}/{PROFILES_DIR}"
+    if os.path.isdir(profiles_dir):
+        for name in os.listdir(profiles_dir):
+            if name.endswith(".json"):
+                paths[name.removesuffix(".json")] = f"{profiles_dir}/{name}"
+    profiles = {}
+    for run_id in sorted(paths):
+        with open(paths[run_id], encoding="utf-8") as f:
+            profiles[run_id] = json.load(f)
+    return profiles
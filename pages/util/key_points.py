@@ -0,0 +1,128 @@
+import heapq
+from array import array
+from collections.abc import Iterator
+
+import tiktoken
+from graphrag.query.llm.text_utils import num_tokens
+from graphrag.query.structured_search.base import SearchResult
+
+
+def format_key_point(analyst: int, score: float, answer: str) -> str:
+    return f"----Analyst {analyst + 1}----\nImportance Score: {score}\n{answer}"
+
+
+class KeyPointHeap:
+    """
+    map結果のkey pointを、届いた順に積みながらスコアの高い順に取り出せるように保持する。
+    同じスコアの場合はanalyst(batch)の番号順となり、一括でsortした場合と同じ並びになる。
+
+    key pointは配列に格納し、heapにはその添字だけを積む。
+    トークン数は必要になった時点でまとめてencodeし、以降は再利用する。
+    """
+
+    def __init__(self):
+        self.analysts = array("i")
+        self.token_counts = array("i")
+        # スコアはmap結果の値(通常はint)をそのまま表示に使うためlistで持つ
+        self.scores: list[float] = []
+        self.answers: list[str] = []
+        self._heap: list[tuple[float, int, int]] = []
+        self._heapified = True
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def push(self, analyst: int, response: SearchResult) -> int:
+        """Add the key points with a positive score and return how many were added."""
+        if not isinstance(response.response, list):
+            return 0
+        start = len(self.answers)
+        for element in response.response:
+            if not isinstance(element, dict):
+                continue
+            if "answer" not in element or "score" not in element:
+                continue
+            score = element["score"]
+            if score <= 0:
+                continue
+            # heapの再構築はまとめて取り出す直前に一度だけ行う
+            self._heap.append((-score, analyst, len(self.answers)))
+            self.scores.append(score)
+            self.answers.append(element["answer"])
+        added = len(self.answers) - start
+        if added == 0:
+            return 0
+        self.analysts.extend([analyst] * added)
+        self.token_counts.extend([-1] * added)
+        self._heapified = False
+        return added
+
+    def iter_sorted(self, batch_size: int = 64) -> Iterator[int]:
+        """Yield key point indices by descending score without consuming the heap."""
+        if not self._heapified:
+            heapq.heapify(self._heap)
+            self._heapified = True
+        # 上位だけで足りることが多いので、必要な分だけ倍々に取り出す
+        n = batch_size
+        done = 0
+        while done < len(self._heap):
+            top = heapq.nsmallest(n, self._heap)
+            for _, _, index in top[done:]:
+                yield index
+            done = len(top)
+            n *= 2
+
+    def format(self, index: int) -> str:
+        return format_key_point(
+            self.analysts[index], self.scores[index], self.answers[index]
+        )
+
+    def count_tokens(
+        self,
+        indices: list[int],
+        token_encoder: tiktoken.Encoding | None,
+        min_batch_size: int = 256,
+    ) -> None:
+        """Fill in the token counts of the given key points that are not known yet."""
+        missing = [index for index in indices if self.token_counts[index] < 0]
+        if not missing:
+            return
+        texts = [self.format(index) for index in missing]
+        if token_encoder is None:
+            counts = [num_tokens(text) for text in texts]
+        elif len(texts) >= min_batch_size:
+            counts = [
+                len(tokens)
+                for tokens in token_encoder.encode_batch(texts, disallowed_special=())
+            ]
+        else:
+            # encode_batchはスレッドプールを作るため、少量なら1件ずつの方が速い
+            counts = [len(token_encoder.encode_ordinary(text)) for text in texts]
+        for index, count in zip(missing, counts):
+            self.token_counts[index] = count
+
+    def select(
+        self,
+        max_tokens: int,
+        token_encoder: tiktoken.Encoding | None = None,
+        batch_size: int = 64,
+    ) -> tuple[list[int], int]:
+        """
+        Pick key points by descending score until `max_tokens` would be exceeded.
+
+        Returns the selected indices and their total token count.
+        """
+        selected: list[int] = []
+        total_tokens = 0
+        ordered = self.iter_sorted(batch_size)
+        while True:
+            batch = [index for _, index in zip(range(batch_size), ordered)]
+            if not batch:
+                break
+            self.count_tokens(batch, token_encoder)
+            for index in batch:
+                if total_tokens + self.token_counts[index] > max_tokens:
+                    return selected, total_tokens
+                selected.append(index)
+                total_tokens += self.token_counts[index]
+        return selected, total_tokens
@@ -0,0 +1,224 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any
+
+from graphrag.index.cache import PipelineCache
+
+DEFAULT_INDEXING_CACHE_PATH = "data/graphrag/cache/indexing_llm.sqlite"
+
+
+class IndexingLLMCache:
+    """
+    indexing時のLLM・embeddingの呼び出し結果を、全GraphStoreで共有するSQLiteのキャッシュ。
+    キーはgraphragが作成する (operation, prompt, model・パラメータ) のハッシュなので、
+    同じ文書を別のGraphStoreとしてindexingした場合もLLMを呼ばずに結果を再利用できる。
+
+    indexingのjobは別プロセスで並行して動くため、WALモードで開き、
+    ヒット数などの統計もDBに保存してプロセス間で共有する。
+    ヒット数はメモリに貯めておき、`stats_flush_every`回の参照ごとにまとめて書き込む。
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_INDEXING_CACHE_PATH,
+        size_limit: int = 2 * 1024**3,
+        evict_every: int = 100,
+        stats_flush_every: int = 100,
+    ):
+        self.path = path
+        self.size_limit = size_limit
+        self.evict_every = evict_every
+        self.stats_flush_every = stats_flush_every
+        self._sets_since_eviction = 0
+        # このプロセス内でのヒット数(profilerがworkflowごとの差分を取るのに使う)
+        self.session_hits = 0
+        self.session_misses = 0
+        # まだDBに書き込んでいないヒット数
+        self._pending_hits = 0
+        self._pending_misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._connection.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at);
+            CREATE TABLE IF NOT EXISTS stats (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            """)
+
+    def _execute(self, sql: str, parameters: tuple = ()) -> list[tuple]:
+        # 他のjobのプロセスの書き込みでlockを待つことがあるため、
+        # event loopからはSharedPipelineCacheを通して別スレッドで呼び出す
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def get(self, key: str) -> Any | None:
+        # 参照時刻の更新と値の読み出しを1つの文で行う
+        rows = self._execute(
+            "UPDATE entries SET accessed_at = ? WHERE key = ? RETURNING value",
+            (time.time(), key),
+        )
+        with self._lock:
+            if rows:
+                self.session_hits += 1
+                self._pending_hits += 1
+            else:
+                self.session_misses += 1
+                self._pending_misses += 1
+            pending = self._pending_hits + self._pending_misses
+        if pending >= self.stats_flush_every:
+            self.flush_stats()
+        return json.loads(rows[0][0]) if rows else None
+
+    def flush_stats(self) -> None:
+        """Write the hits and misses counted since the last flush to the database."""
+        with self._lock:
+            counts = [("hits", self._pending_hits), ("misses", self._pending_misses)]
+            self._pending_hits = 0
+            self._pending_misses = 0
+            self._connection.executemany(
+                "INSERT INTO stats (name, value) VALUES (?, ?)"
+                " ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+                [(name, count) for name, count in counts if count],
+            )
+
+    def has(self, key: str) -> bool:
+        return bool(self._execute("SELECT 1 FROM entries WHERE key = ?", (key,)))
+
+    def set(self, key: str, value: Any) -> None:
+        data = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        self._execute(
+            "INSERT OR REPLACE INTO entries (key, value, size, created_at, accessed_at)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (key, data, len(data.encode("utf-8")), now, now),
+        )
+        self._sets_since_eviction += 1
+        if self._sets_since_eviction >= self.evict_every:
+            self.evict()
+
+    def delete(self, key: str) -> None:
+        self._execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def delete_prefix(self, prefix: str) -> None:
+        self._execute(
+            "DELETE FROM entries WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)
+        )
+
+    def evict(self) -> int:
+        """Delete least recently used entries until the cache fits in `size_limit`."""
+        self._sets_since_eviction = 0
+        total = self._execute("SELECT COALESCE(SUM(size), 0) FROM entries")[0][0]
+        if total <= self.size_limit:
+            return 0
+        # 毎回の追い出しを避けるため、上限の9割まで減らす
+        excess = total - int(self.size_limit * 0.9)
+        evicted = 0
+        freed = 0
+        for key, size in self._execute(
+            "SELECT key, size FROM entries ORDER BY accessed_at"
+        ):
+            if freed >= excess:
+                break
+            self.delete(key)
+            freed += size
+            evicted += 1
+        self._execute(
+            "INSERT INTO stats (name, value) VALUES ('evictions', ?)"
+            " ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+            (evicted,),
+        )
+        return evicted
+
+    def stats(self) -> dict[str, Any]:
+        self.flush_stats()
+        counters = dict(self._execute("SELECT name, value FROM stats"))
+        entries, size = self._execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+        )[0]
+        hits = counters.get("hits", 0)
+        misses = counters.get("misses", 0)
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "evictions": counters.get("evictions", 0),
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._pending_hits = 0
+            self._pending_misses = 0
+        self._execute("DELETE FROM entries")
+        self._execute("DELETE FROM stats")
+
+    def pipeline_cache(self, namespace: str = "") -> "SharedPipelineCache":
+        return SharedPipelineCache(self, namespace)
+
+
+class SharedPipelineCache(PipelineCache):
+    """
+    PipelineCache adapter that stores graphrag's cache entries in an IndexingLLMCache.
+
+    The SQLite calls run in worker threads so that lock waits do not stall the pipeline.
+    """
+
+    def __init__(self, cache: IndexingLLMCache, namespace: str = ""):
+        self._cache = cache
+        self._namespace = namespace
+
+    def _key(self, key: str) -> str:
+        return f"{self._namespace}/{key}" if self._namespace else key
+
+    async def get(self, key: str) -> Any:
+        return await asyncio.to_thread(self._cache.get, self._key(key))
+
+    async def set(self, key: str, value: Any, debug_data: dict | None = None) -> None:
+        # graphragのファイルキャッシュと異なり、容量を抑えるためdebug_data(prompt)は保存しない
+        if value is None:
+            return
+        await asyncio.to_thread(self._cache.set, self._key(key), value)
+
+    async def has(self, key: str) -> bool:
+        return await asyncio.to_thread(self._cache.has, self._key(key))
+
+    async def delete(self, key: str) -> None:
+        await asyncio.to_thread(self._cache.delete, self._key(key))
+
+    async def clear(self) -> None:
+        if self._namespace:
+            await asyncio.to_thread(self._cache.delete_prefix, f"{self._namespace}/")
+        else:
+            await asyncio.to_thread(self._cache.clear)
+
+    def child(self, name: str) -> "SharedPipelineCache":
+        return SharedPipelineCache(self._cache, self._key(name))
+
+
+_indexing_cache: IndexingLLMCache | None = None
+
+
+def get_indexing_cache() -> IndexingLLMCache:
+    """Return the process-wide indexing LLM cache, creating it on first use."""
+    global _indexing_cache
+    if _indexing_cache is None:
+        _indexing_cache = IndexingLLMCache()
+    return _indexing_cache
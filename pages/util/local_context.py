@@ -0,0 +1,313 @@
+import copy
+import threading
+from typing import Any
+
+import numpy as np
+import pandas as pd
+import tiktoken
+from graphrag.model import CommunityReport, Covariate, Entity, Relationship, TextUnit
+from graphrag.model.types import TextEmbedder
+from graphrag.query.context_builder.conversation_history import (
+    ConversationHistory,
+)
+from graphrag.query.context_builder.entity_extraction import EntityVectorStoreKey
+from graphrag.query.llm.base import BaseTextEmbedding
+from graphrag.query.structured_search.local_search.mixed_context import (
+    LocalSearchMixedContext,
+)
+from graphrag.vector_stores import (
+    BaseVectorStore,
+    VectorStoreDocument,
+    VectorStoreSearchResult,
+)
+
+
+class NumpyVectorStore(BaseVectorStore):
+    """
+    entityのdescription embeddingを1つのNumPy行列に載せて、総当たりでtop-kを求めるvector store。
+    LanceDBのようにクエリごとにファイルを開く必要がない。
+    """
+
+    def __init__(self, collection_name: str = "entity_description_embeddings"):
+        super().__init__(collection_name=collection_name)
+        self.ids = np.array([], dtype=object)
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self._mask: np.ndarray | None = None
+
+    def connect(self, **kwargs: Any) -> None:
+        pass
+
+    def load_documents(
+        self, documents: list[VectorStoreDocument], overwrite: bool = True
+    ) -> None:
+        documents = [doc for doc in documents if doc.vector is not None]
+        ids = np.array([doc.id for doc in documents], dtype=object)
+        matrix = np.array([doc.vector for doc in documents], dtype=np.float32)
+        if not overwrite and len(self.ids) > 0:
+            ids = np.concatenate([self.ids, ids])
+            matrix = np.vstack([self.matrix, matrix])
+        self.ids = ids
+        self.matrix = _normalize(matrix)
+        self._mask = None
+
+    def filter_by_id(self, include_ids: list[str] | list[int]) -> Any:
+        if len(include_ids) == 0:
+            self._mask = None
+        else:
+            self._mask = np.isin(self.ids, np.array(include_ids, dtype=object))
+        return self._mask
+
+    def top_k(
+        self, query_embedding: list[float], k: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Return the row positions and cosine similarities of the `k` nearest rows."""
+        if len(self.ids) == 0 or k <= 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+        query = _normalize(np.asarray(query_embedding, dtype=np.float32)[None, :])[0]
+        scores = self.matrix @ query
+        if self._mask is not None:
+            scores = np.where(self._mask, scores, -np.inf)
+        k = min(k, len(scores))
+        positions = np.argpartition(-scores, k - 1)[:k]
+        positions = positions[np.argsort(-scores[positions], kind="stable")]
+        positions = positions[np.isfinite(scores[positions])]
+        return positions, scores[positions]
+
+    def similarity_search_by_vector(
+        self, query_embedding: list[float], k: int = 10, **kwargs: Any
+    ) -> list[VectorStoreSearchResult]:
+        positions, scores = self.top_k(query_embedding, k)
+        return [
+            VectorStoreSearchResult(
+                document=VectorStoreDocument(
+                    id=self.ids[position],
+                    text=None,
+                    vector=None,
+                ),
+                score=float(score),
+            )
+            for position, score in zip(positions, scores)
+        ]
+
+    def similarity_search_by_text(
+        self, text: str, text_embedder: TextEmbedder, k: int = 10, **kwargs: Any
+    ) -> list[VectorStoreSearchResult]:
+        query_embedding = text_embedder(text)
+        if not query_embedding:
+            return []
+        return self.similarity_search_by_vector(query_embedding, k)
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    if matrix.size == 0:
+        return matrix
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def _csr(
+    n_rows: int, rows: np.ndarray, values: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Group `values` by `rows` into (offsets, values) adjacency arrays."""
+    valid = rows >= 0
+    rows, values = rows[valid], values[valid]
+    order = np.argsort(rows, kind="stable")
+    offsets = np.zeros(n_rows + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(rows, minlength=n_rows))
+    return offsets, values[order]
+
+
+def _gather(offsets: np.ndarray, values: np.ndarray, rows: list[int]) -> np.ndarray:
+    if not rows:
+        return np.array([], dtype=values.dtype)
+    return np.unique(
+        np.concatenate([values[offsets[row] : offsets[row + 1]] for row in rows])
+    )
+
+
+class EntityGraphIndex:
+    """
+    entityの位置をキーに、関係するrelationshipとcovariateの位置を隣接配列(CSR)で持つ。
+    クエリごとに全relationshipを走査せずに、候補entityの周辺だけを取り出せる。
+    """
+
+    def __init__(
+        self,
+        entities: list[Entity],
+        relationships: list[Relationship],
+        covariates: dict[str, list[Covariate]],
+    ):
+        self.title_to_position = {
+            entity.title: position for position, entity in enumerate(entities)
+        }
+        n_entities = len(entities)
+
+        sources = np.array(
+            [self.title_to_position.get(rel.source, -1) for rel in relationships],
+            dtype=np.int64,
+        )
+        targets = np.array(
+            [self.title_to_position.get(rel.target, -1) for rel in relationships],
+            dtype=np.int64,
+        )
+        rel_positions = np.arange(len(relationships), dtype=np.int64)
+        self.relationship_offsets, self.relationship_values = _csr(
+            n_entities,
+            np.concatenate([sources, targets]),
+            np.concatenate([rel_positions, rel_positions]),
+        )
+
+        self.covariate_index = {}
+        for name, items in covariates.items():
+            subjects = np.array(
+                [self.title_to_position.get(cov.subject_id, -1) for cov in items],
+                dtype=np.int64,
+            )
+            self.covariate_index[name] = _csr(
+                n_entities, subjects, np.arange(len(items), dtype=np.int64)
+            )
+
+    def relationships_for(self, positions: list[int]) -> np.ndarray:
+        return _gather(self.relationship_offsets, self.relationship_values, positions)
+
+    def covariates_for(self, name: str, positions: list[int]) -> np.ndarray:
+        offsets, values = self.covariate_index[name]
+        return _gather(offsets, values, positions)
+
+
+class _QueryEmbedding:
+    """Return a precomputed embedding for the query so it is only embedded once."""
+
+    def __init__(self, text: str, embedding: list[float], text_embedder):
+        self.text = text
+        self.embedding = embedding
+        self.text_embedder = text_embedder
+
+    def embed(self, text: str, **kwargs: Any) -> list[float]:
+        if text == self.text:
+            return self.embedding
+        return self.text_embedder.embed(text, **kwargs)
+
+
+class IndexedLocalSearchMixedContext(LocalSearchMixedContext):
+    """
+    NumpyVectorStoreとEntityGraphIndexで候補を絞ってからcontextを作るLocalSearchMixedContext
+    """
+
+    def __init__(
+        self,
+        entities: list[Entity],
+        entity_text_embeddings: NumpyVectorStore,
+        text_embedder: BaseTextEmbedding | None = None,
+        text_units: list[TextUnit] | None = None,
+        community_reports: list[CommunityReport] | None = None,
+        relationships: list[Relationship] | None = None,
+        covariates: dict[str, list[Covariate]] | None = None,
+        token_encoder: tiktoken.Encoding | None = None,
+    ):
+        super().__init__(
+            entities=entities,
+            entity_text_embeddings=entity_text_embeddings,
+            text_embedder=text_embedder,  # type: ignore
+            text_units=text_units,
+            community_reports=community_reports,
+            relationships=relationships,
+            covariates=covariates,
+            token_encoder=token_encoder,
+            embedding_vectorstore_key=EntityVectorStoreKey.ID,
+        )
+        self.entity_list = entities
+        self.relationship_list = relationships or []
+        self.covariate_lists = covariates or {}
+        self.entity_positions = {
+            entity.id: position for position, entity in enumerate(entities)
+        }
+        self.graph_index = EntityGraphIndex(
+            entities, self.relationship_list, self.covariate_lists
+        )
+        # 親クラスはcommunity reportやtext unitのattributesを一時的に書き換えるため、
+        # 同じデータを共有するsession間でcontextの作成を直列化する
+        self._lock = threading.Lock()
+
+    def with_text_embedder(
+        self, text_embedder: BaseTextEmbedding
+    ) -> "IndexedLocalSearchMixedContext":
+        """Return a shallow copy that shares the loaded data but uses `text_embedder`."""
+        builder = copy.copy(self)
+        builder.text_embedder = text_embedder
+        return builder
+
+    def build_context(
+        self,
+        query: str,
+        conversation_history: ConversationHistory | None = None,
+        include_entity_names: list[str] | None = None,
+        conversation_history_max_turns: int | None = 5,
+        top_k_mapped_entities: int = 10,
+        **kwargs: Any,
+    ) -> tuple[str | list[str], dict[str, pd.DataFrame]]:
+        params = {
+            "include_entity_names": include_entity_names,
+            "conversation_history_max_turns": conversation_history_max_turns,
+            "top_k_mapped_entities": top_k_mapped_entities,
+            **kwargs,
+        }
+        if query == "":
+            with self._lock:
+                return super().build_context(
+                    query=query, conversation_history=conversation_history, **params
+                )
+
+        # 親クラスと同じく、会話履歴のユーザーの質問もentityの検索に使う
+        entity_query = query
+        if conversation_history:
+            pre_user_questions = "\n".join(
+                conversation_history.get_user_turns(conversation_history_max_turns)
+            )
+            entity_query = f"{query}\n{pre_user_questions}"
+        query_embedding = self.text_embedder.embed(entity_query)
+
+        # 親クラスが検索するのと同じ数(oversample_scaler=2)の候補entityを先に求める
+        store: NumpyVectorStore = self.entity_text_embeddings  # type: ignore
+        rows, _ = store.top_k(query_embedding, top_k_mapped_entities * 2)
+        positions = [
+            self.entity_positions[store.ids[row]]
+            for row in rows
+            if store.ids[row] in self.entity_positions
+        ]
+        positions.extend(
+            self.graph_index.title_to_position[name]
+            for name in include_entity_names or []
+            if name in self.graph_index.title_to_position
+        )
+
+        # 候補entityの周辺だけを持つviewで親クラスのcontext作成を行う
+        view = copy.copy(self)
+        view.text_embedder = _QueryEmbedding(
+            entity_query, query_embedding, self.text_embedder
+        )
+        view.entities = {
+            self.entity_list[position].id: self.entity_list[position]
+            for position in positions
+        }
+        view.relationships = {
+            rel.id: rel
+            for rel in (
+                self.relationship_list[position]
+                for position in self.graph_index.relationships_for(positions)
+            )
+        }
+        view.covariates = {
+            name: [
+                items[position]
+                for position in self.graph_index.covariates_for(name, positions)
+            ]
+            for name, items in self.covariate_lists.items()
+        }
+        with self._lock:
+            return LocalSearchMixedContext.build_context(
+                view,
+                query=query,
+                conversation_history=conversation_history,
+                **params,
+            )
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import re
+import unicodedata
+from typing import Any
+
+import diskcache
+from graphrag.query.structured_search.base import SearchResult
+
+DEFAULT_MAP_CACHE_DIR = "data/graphrag/cache/map_responses"
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a query so that trivially different inputs share a cache entry."""
+    query = unicodedata.normalize("NFKC", query)
+    query = re.sub(r"\s+", " ", query).strip().lower()
+    return query.rstrip("?？!！。.")
+
+
+def _sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class MapResponseCache:
+    """
+    global searchのmap処理の結果をディスクに保存するキャッシュ。
+    (正規化したクエリ, chunkの内容, mapのLLMパラメータ) が同じであればLLMを呼ばずに結果を返す。
+    """
+
+    def __init__(
+        self,
+        directory: str = DEFAULT_MAP_CACHE_DIR,
+        ttl: float | None = 7 * 24 * 60 * 60,
+        size_limit: int = 512 * 1024**2,
+    ):
+        self.ttl = ttl
+        self._cache = diskcache.Cache(
+            directory,
+            size_limit=size_limit,
+            eviction_policy="least-recently-used",
+        )
+        self._cache.stats(enable=True)
+
+    @staticmethod
+    def make_key(
+        query: str,
+        context_data: str,
+        llm_params: dict[str, Any],
+        prompt: str = "",
+    ) -> str:
+        params = json.dumps(llm_params, sort_keys=True, default=str)
+        return ":".join(
+            [
+                _sha256(normalize_query(query)),
+                _sha256(context_data),
+                _sha256(params + prompt),
+            ]
+        )
+
+    def get(self, key: str, context_data: str) -> SearchResult | None:
+        response = self._cache.get(key)
+        if response is None:
+            return None
+        return SearchResult(
+            response=response,
+            context_data=context_data,
+            context_text=context_data,
+            completion_time=0,
+            llm_calls=0,
+            prompt_tokens=0,
+        )
+
+    def set(self, key: str, result: SearchResult) -> None:
+        # LLM呼び出しに失敗した場合の結果はキャッシュしない
+        if result.response == [{"answer": "", "score": 0}]:
+            return
+        self._cache.set(key, result.response, expire=self.ttl)
+
+    def stats(self) -> dict[str, int]:
+        hits, misses = self._cache.stats()
+        return {
+            "hits": hits,
+            "misses": misses,
+            "entries": len(self._cache),
+            "bytes": self._cache.volume(),
+        }
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+
+_map_cache: MapResponseCache | None = None
+
+
+def get_map_cache() -> MapResponseCache:
+    """Return the process-wide map response cache, creating it on first use."""
+    global _map_cache
+    if _map_cache is None:
+        _map_cache = MapResponseCache()
+    return _map_cache
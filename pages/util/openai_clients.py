@@ -0,0 +1,300 @@
+import asyncio
+import hashlib
+import importlib.util
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any
+
+import httpx
+from graphrag.query.llm.oai.chat_openai import ChatOpenAI
+from graphrag.query.llm.oai.embedding import OpenAIEmbedding
+from graphrag.query.llm.oai.typing import OpenaiApiType
+from openai import AsyncOpenAI, OpenAI
+
+from . import tracing
+from .rate_limiter import estimate_request_tokens, get_rate_limiter
+
+# h2がinstallされている場合だけHTTP/2で接続する
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def api_key_hash(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+
+class ConnectionStats:
+    """Count the requests and the newly opened connections of the pooled transports."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+
+    def trace(self, event: str, info: dict) -> None:
+        # httpcoreのtrace extensionから呼ばれる
+        if event == "connection.connect_tcp.complete":
+            with self._lock:
+                self.connections += 1
+        elif event.endswith(".send_request_headers.started"):
+            with self._lock:
+                self.requests += 1
+
+    async def atrace(self, event: str, info: dict) -> None:
+        self.trace(event, info)
+
+
+def _request_attributes(request: httpx.Request) -> dict:
+    # streamingのrequestは、responseのheaderが届いた時点までを計る
+    return {"http.method": request.method, "url.path": request.url.path}
+
+
+class _TracingTransport(httpx.HTTPTransport):
+    """Transport counting connections and waiting for the shared rate limiter."""
+
+    def __init__(self, stats: ConnectionStats, **kwargs):
+        super().__init__(**kwargs)
+        self._stats = stats
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.extensions["trace"] = self._stats.trace
+        rate_limiter = get_rate_limiter()
+        with tracing.span("openai.request", _request_attributes(request)) as span:
+            start = time.perf_counter()
+            rate_limiter.acquire(estimate_request_tokens(request))
+            span.set_attribute(
+                "rate_limit.wait_ms", (time.perf_counter() - start) * 1000
+            )
+            response = super().handle_request(request)
+            span.set_attribute("http.status_code", response.status_code)
+        rate_limiter.observe(response)
+        return response
+
+
+class _AsyncTracingTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, stats: ConnectionStats, **kwargs):
+        super().__init__(**kwargs)
+        self._stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        request.extensions["trace"] = self._stats.atrace
+        rate_limiter = get_rate_limiter()
+        with tracing.span("openai.request", _request_attributes(request)) as span:
+            start = time.perf_counter()
+            await rate_limiter.acquire_async(estimate_request_tokens(request))
+            span.set_attribute(
+                "rate_limit.wait_ms", (time.perf_counter() - start) * 1000
+            )
+            response = await super().handle_async_request(request)
+            span.set_attribute("http.status_code", response.status_code)
+        rate_limiter.observe(response)
+        return response
+
+
+@dataclass
+class _PooledClient:
+    client: OpenAI | AsyncOpenAI
+    last_used: float
+    loop: asyncio.AbstractEventLoop | None = None
+    variants: dict[str, OpenAI | AsyncOpenAI] = field(default_factory=dict)
+
+    def with_options(self, options: dict[str, Any]) -> OpenAI | AsyncOpenAI:
+        """Return a client with other retry/timeout options sharing the same pool."""
+        if not options:
+            return self.client
+        key = repr(sorted(options.items()))
+        if key not in self.variants:
+            self.variants[key] = self.client.with_options(**options)
+        return self.variants[key]
+
+
+class OpenAIClientRegistry:
+    """
+    API keyのhashごとにOpenAI clientを共有し、rerunをまたいでHTTP接続を使い回す。
+    - 同期clientはprocess全体で1つの接続poolを共有する
+    - 非同期clientの接続poolはevent loopに結びつくため、event loopごとに作る。
+      同じloopの中ではAssistants APIとgraphragのquery LLMが同じpoolを使う
+    - idle_timeoutの間使われなかったclientは登録から外す(閉じるのはGCに任せる)
+    - すべてのrequestはrate_limiterの共有のrate limiterを通る
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        keepalive_expiry: float = 60.0,
+        idle_timeout: float = 600.0,
+        http2: bool = HTTP2_AVAILABLE,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.idle_timeout = idle_timeout
+        self.http2 = http2
+        self.connection_stats = ConnectionStats()
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._clients: dict[str, _PooledClient] = {}
+        self._async_clients: dict[tuple[str, int], _PooledClient] = {}
+
+    def openai(self, api_key: str, **options) -> OpenAI:
+        """Return the shared OpenAI client of `api_key`, with `options` applied."""
+        key = api_key_hash(api_key)
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._clients.get(key)
+            if entry is None:
+                http_client = httpx.Client(
+                    transport=_TracingTransport(
+                        self.connection_stats, limits=self.limits, http2=self.http2
+                    )
+                )
+                entry = _PooledClient(
+                    OpenAI(api_key=api_key, http_client=http_client), now
+                )
+                self._clients[key] = entry
+            entry.last_used = now
+            return entry.with_options(options)
+
+    def async_openai(self, api_key: str, **options) -> AsyncOpenAI:
+        """Return the AsyncOpenAI client of `api_key` for the running event loop."""
+        loop = asyncio.get_running_loop()
+        key = (api_key_hash(api_key), id(loop))
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._async_clients.get(key)
+            if entry is None or entry.loop is not loop:
+                http_client = httpx.AsyncClient(
+                    transport=_AsyncTracingTransport(
+                        self.connection_stats, limits=self.limits, http2=self.http2
+                    )
+                )
+                entry = _PooledClient(
+                    AsyncOpenAI(api_key=api_key, http_client=http_client), now, loop
+                )
+                self._async_clients[key] = entry
+            entry.last_used = now
+            return entry.with_options(options)
+
+    async def aclose_loop(self) -> None:
+        """Close the async clients of the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            keys = [
+                key for key, entry in self._async_clients.items() if entry.loop is loop
+            ]
+            entries = [self._async_clients.pop(key) for key in keys]
+        for entry in entries:
+            await entry.client.close()
+
+    def _evict_idle(self, now: float) -> None:
+        # キャッシュしたengineやPooledChatOpenAIがまだclientを持っている場合があるため、
+        # 閉じずに参照だけを外す。どこからも参照されなくなればGCで接続も閉じられる
+        for key, entry in list(self._clients.items()):
+            if now - entry.last_used > self.idle_timeout:
+                del self._clients[key]
+                self.evictions += 1
+        # 閉じたevent loopのclientは閉じられないため、参照だけを外す
+        for key, entry in list(self._async_clients.items()):
+            if entry.loop.is_closed():
+                del self._async_clients[key]
+                self.evictions += 1
+
+    def evict_idle(self) -> None:
+        with self._lock:
+            self._evict_idle(time.monotonic())
+
+    def stats(self) -> dict:
+        requests = self.connection_stats.requests
+        connections = self.connection_stats.connections
+        reused = max(requests - connections, 0)
+        return {
+            "clients": len(self._clients),
+            "async_clients": len(self._async_clients),
+            "requests": requests,
+            "connections": connections,
+            "reused": reused,
+            "reuse_rate": reused / requests if requests else 0.0,
+            "evictions": self.evictions,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            for entry in self._clients.values():
+                entry.client.close()
+            self._clients.clear()
+            self._async_clients.clear()
+
+
+class LoopBoundAsyncOpenAI:
+    """
+    AsyncOpenAIの代わりに渡すproxy。
+    属性を参照した時点で動いているevent loopのclientを取り出すため、
+    event loopの外で作ったsearch engineなどにも渡せる。
+    """
+
+    def __init__(self, registry: OpenAIClientRegistry, api_key: str, **options):
+        self._registry = registry
+        self._api_key = api_key
+        self._options = options
+
+    def __getattr__(self, name: str):
+        client = self._registry.async_openai(self._api_key, **self._options)
+        return getattr(client, name)
+
+
+_registry: OpenAIClientRegistry | None = None
+_registry_lock = threading.Lock()
+
+
+def get_client_registry() -> OpenAIClientRegistry:
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = OpenAIClientRegistry()
+        return _registry
+
+
+def get_openai_client(api_key: str, **options) -> OpenAI:
+    return get_client_registry().openai(api_key, **options)
+
+
+def get_async_openai_client(api_key: str, **options) -> LoopBoundAsyncOpenAI:
+    return LoopBoundAsyncOpenAI(get_client_registry(), api_key, **options)
+
+
+def run(coro):
+    """Run `coro` like asyncio.run, closing the async clients of its loop at the end."""
+
+    async def _main():
+        try:
+            return await coro
+        finally:
+            await get_client_registry().aclose_loop()
+
+    return asyncio.run(_main())
+
+
+class _PooledClientsMixin:
+    """graphragのquery LLMで、clientを作らずにregistryのclientを使う"""
+
+    def _create_openai_client(self):
+        if self.api_type != OpenaiApiType.OpenAI or self.api_base is not None:
+            return super()._create_openai_client()
+        options = {"max_retries": self.max_retries, "timeout": self.request_timeout}
+        self.set_clients(
+            sync_client=get_openai_client(self.api_key, **options),
+            async_client=get_async_openai_client(self.api_key, **options),
+        )
+
+
+class PooledChatOpenAI(_PooledClientsMixin, ChatOpenAI):
+    pass
+
+
+class PooledOpenAIEmbedding(_PooledClientsMixin, OpenAIEmbedding):
+    pass
@@ -0,0 +1,317 @@
+import asyncio
+import contextvars
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from collections.abc import Callable
+from dataclasses import dataclass, field
+
+import httpx
+import numpy as np
+import yaml
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONFIG_PATH = "config/graphrag.yaml"
+QUERY_RATE_LIMITS_KEY = "query_rate_limits"
+DEFAULT_SESSION = "default"
+# tokenを数えるAPI。それ以外のrequestはrequests per minuteだけを消費する
+TOKEN_COUNTED_PATHS = ("/chat/completions", "/embeddings")
+
+# requestを出しているsession。公平に順番を回す単位になる
+current_session: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "rate_limit_session", default=DEFAULT_SESSION
+)
+
+
+def set_session(session_id: str) -> None:
+    """Attribute the OpenAI requests of the current context to `session_id`."""
+    current_session.set(session_id)
+
+
+def estimate_request_tokens(request: httpx.Request) -> int:
+    """
+    Estimate the tokens a request consumes: about 4 bytes per prompt token,
+    plus the completion tokens it may generate.
+    """
+    if not request.url.path.endswith(TOKEN_COUNTED_PATHS):
+        return 0
+    if not request.headers.get("content-type", "").startswith("application/json"):
+        return 0
+    try:
+        body = request.content
+        data = json.loads(body)
+    except (httpx.RequestNotRead, ValueError):
+        return 0
+    max_tokens = data.get("max_completion_tokens") or data.get("max_tokens") or 0
+    return len(body) // 4 + int(max_tokens) * int(data.get("n") or 1)
+
+
+def _retry_after(response: httpx.Response) -> float | None:
+    value = response.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class _Bucket:
+    """A token bucket refilled at `per_minute / 60` per second."""
+
+    def __init__(self, per_minute: float, burst_seconds: float):
+        self.rate = per_minute / 60.0
+        self.capacity = max(self.rate * burst_seconds, 1.0)
+        self.level = self.capacity
+
+    def refill(self, elapsed: float) -> None:
+        self.level = min(self.capacity, self.level + self.rate * elapsed)
+
+    def wait_time(self, cost: float) -> float:
+        # 容量より大きいrequestは、bucketが満ちていれば通す
+        cost = min(cost, self.capacity)
+        if self.level >= cost:
+            return 0.0
+        return (cost - self.level) / self.rate
+
+
+@dataclass
+class _Waiter:
+    session: str
+    tokens: int
+    grant: Callable[[], None]
+    enqueued_at: float = field(default_factory=time.monotonic)
+    granted: bool = False
+
+
+class RateLimiter:
+    """
+    process全体で共有するOpenAI APIのrate limiter。
+    - requests per minuteとtokens per minuteのtoken bucketで、requestを送る前に待たせる
+    - 待っているrequestはsessionごとのキューに入れ、sessionを順番に回して公平に通す
+    - 429が返った場合は、retry-afterの間すべてのrequestを止めて再試行の嵐を防ぐ
+    - OpenAIと同じく、1分ぶんの上限まではまとめて通す(global searchのmapを一度に送れるように)
+    - 0を指定した上限は制限しない
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = 0,
+        tokens_per_minute: float = 0,
+        burst_seconds: float = 60.0,
+        max_wait_samples: int = 1000,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = (
+            _Bucket(requests_per_minute, burst_seconds) if requests_per_minute else None
+        )
+        self._tokens = (
+            _Bucket(tokens_per_minute, burst_seconds) if tokens_per_minute else None
+        )
+        self._condition = threading.Condition()
+        self._queues: OrderedDict[str, deque[_Waiter]] = OrderedDict()
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._dispatcher: threading.Thread | None = None
+        self.granted = 0
+        self.waited = 0
+        self.throttled = 0
+        self._wait_times: deque[float] = deque(maxlen=max_wait_samples)
+
+    @property
+    def enabled(self) -> bool:
+        return self._requests is not None or self._tokens is not None
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        for bucket in (self._requests, self._tokens):
+            if bucket is not None:
+                bucket.refill(elapsed)
+
+    def _wait_time(self, tokens: int, now: float) -> float:
+        wait = max(self._paused_until - now, 0.0)
+        if self._requests is not None:
+            wait = max(wait, self._requests.wait_time(1))
+        if self._tokens is not None and tokens:
+            wait = max(wait, self._tokens.wait_time(tokens))
+        return wait
+
+    def _consume(self, waiter: _Waiter, now: float) -> None:
+        try:
+            waiter.grant()
+        except Exception:
+            # 待っていたevent loopが閉じた場合(Streamlitのrerunで中断されたqueryなど)は、
+            # そのrequestを捨てて他のrequestを通し続ける
+            log.warning("dropped a rate limiter waiter", exc_info=True)
+            return
+        if self._requests is not None:
+            self._requests.level -= 1
+        if self._tokens is not None:
+            self._tokens.level -= waiter.tokens
+        waiter.granted = True
+        wait = now - waiter.enqueued_at
+        self.granted += 1
+        if wait > 0.001:
+            self.waited += 1
+        self._wait_times.append(wait)
+
+    def _enqueue(self, waiter: _Waiter) -> None:
+        with self._condition:
+            now = time.monotonic()
+            self._refill(now)
+            # 誰も待っておらず余裕があれば、dispatcherを介さずにすぐ通す
+            if not self._queues and self._wait_time(waiter.tokens, now) == 0:
+                self._consume(waiter, now)
+                return
+            self._queues.setdefault(waiter.session, deque()).append(waiter)
+            # dispatcherが予期しない例外で止まっていれば起動し直す
+            if self._dispatcher is None or not self._dispatcher.is_alive():
+                self._dispatcher = threading.Thread(
+                    target=self._dispatch, name="openai-rate-limiter", daemon=True
+                )
+                self._dispatcher.start()
+            self._condition.notify()
+
+    def _dispatch(self) -> None:
+        with self._condition:
+            while True:
+                if not self._queues:
+                    self._condition.wait()
+                    continue
+                now = time.monotonic()
+                self._refill(now)
+                session, queue = next(iter(self._queues.items()))
+                waiter = queue[0]
+                wait = self._wait_time(waiter.tokens, now)
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+                queue.popleft()
+                # 通したsessionは最後に回す
+                del self._queues[session]
+                if queue:
+                    self._queues[session] = queue
+                self._consume(waiter, now)
+
+    def _cancel(self, waiter: _Waiter) -> None:
+        with self._condition:
+            if waiter.granted:
+                # 使われなかった分を返す
+                if self._requests is not None:
+                    self._requests.level += 1
+                if self._tokens is not None:
+                    self._tokens.level += waiter.tokens
+                return
+            queue = self._queues.get(waiter.session)
+            if queue is not None and waiter in queue:
+                queue.remove(waiter)
+                if not queue:
+                    del self._queues[waiter.session]
+            self._condition.notify()
+
+    def acquire(self, tokens: int = 0, session: str | None = None) -> None:
+        """Block until a request of `tokens` tokens may be sent."""
+        if not self.enabled and self._paused_until <= time.monotonic():
+            return
+        event = threading.Event()
+        waiter = _Waiter(session or current_session.get(), tokens, event.set)
+        self._enqueue(waiter)
+        event.wait()
+
+    async def acquire_async(self, tokens: int = 0, session: str | None = None) -> None:
+        """Wait without blocking the event loop until the request may be sent."""
+        if not self.enabled and self._paused_until <= time.monotonic():
+            return
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def _grant() -> None:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = _Waiter(session or current_session.get(), tokens, _grant)
+        self._enqueue(waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            self._cancel(waiter)
+            raise
+
+    def observe(self, response: httpx.Response) -> None:
+        """Pause on 429 and follow the remaining quota reported by the API."""
+        with self._condition:
+            if response.status_code == 429:
+                self.throttled += 1
+                retry_after = _retry_after(response) or 1.0
+                self._paused_until = max(
+                    self._paused_until, time.monotonic() + retry_after
+                )
+                self._condition.notify()
+            # 他のprocessも同じ上限を使っていれば、APIの残量に合わせる
+            for bucket, header in [
+                (self._requests, "x-ratelimit-remaining-requests"),
+                (self._tokens, "x-ratelimit-remaining-tokens"),
+            ]:
+                value = response.headers.get(header)
+                if bucket is not None and value is not None and value.isdigit():
+                    bucket.level = min(bucket.level, float(value))
+
+    def stats(self) -> dict:
+        with self._condition:
+            wait_times = np.array(self._wait_times, dtype=np.float64)
+            return {
+                "requests_per_minute": self.requests_per_minute,
+                "tokens_per_minute": self.tokens_per_minute,
+                "queue_depth": sum(len(queue) for queue in self._queues.values()),
+                "waiting_sessions": len(self._queues),
+                "granted": self.granted,
+                "waited": self.waited,
+                "throttled": self.throttled,
+                "mean_wait": float(wait_times.mean()) if len(wait_times) else 0.0,
+                "p95_wait": (
+                    float(np.percentile(wait_times, 95)) if len(wait_times) else 0.0
+                ),
+                "max_wait": float(wait_times.max()) if len(wait_times) else 0.0,
+            }
+
+
+def read_rate_limits(config_path: str = DEFAULT_CONFIG_PATH) -> tuple[int, int]:
+    """Return query_rate_limits.requests_per_minute and tokens_per_minute of the config."""
+    try:
+        with open(config_path, encoding="utf-8") as f:
+            data = yaml.safe_load(f) or {}
+    except FileNotFoundError:
+        return 0, 0
+    # indexingが使うllmの上限とは別に、query時の上限だけを読む
+    limits = data.get(QUERY_RATE_LIMITS_KEY) or {}
+    return (
+        int(limits.get("requests_per_minute") or 0),
+        int(limits.get("tokens_per_minute") or 0),
+    )
+
+
+_rate_limiter: RateLimiter | None = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            requests_per_minute, tokens_per_minute = read_rate_limits()
+            _rate_limiter = RateLimiter(
+                requests_per_minute=requests_per_minute,
+                tokens_per_minute=tokens_per_minute,
+            )
+        return _rate_limiter
+
+
+def set_rate_limiter(limiter: RateLimiter) -> None:
+    """Replace the shared rate limiter, e.g. to run a benchmark without limits."""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        _rate_limiter = limiter
@@ -0,0 +1,319 @@
+import csv
+import hashlib
+import io
+import json
+import os
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import tiktoken
+from graphrag.model import CommunityReport
+from graphrag.query.llm.text_utils import num_tokens
+
+from .columnar_artifacts import columnar_path, map_arrow_file, write_arrow_file
+
+# 行の作り方を変えた場合は上げて、ディスク上の古い行を使わないようにする
+ROW_FORMAT_VERSION = 2
+
+
+@dataclass(frozen=True)
+class ReportContextFormat:
+    """build_community_contextのうち、reportの行の内容を決めるパラメータ"""
+
+    # 既定値はGlobalCommunityContext.build_contextと同じ
+    use_community_summary: bool = True
+    column_delimiter: str = "|"
+    include_community_rank: bool = False
+    community_rank_name: str = "rank"
+    include_community_weight: bool = True
+    community_weight_name: str = "occurrence"
+    context_name: str = "Reports"
+
+    @classmethod
+    def from_params(cls, params: dict) -> "ReportContextFormat":
+        return cls(
+            **{
+                name: params[name]
+                for name in cls.__dataclass_fields__
+                if name in params
+            }
+        )
+
+    def digest(self, encoding_name: str) -> str:
+        data = json.dumps(
+            {
+                "version": ROW_FORMAT_VERSION,
+                "encoding": encoding_name,
+                **self.__dict__,
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(data.encode()).hexdigest()[:8]
+
+
+class ReportContextRows:
+    """
+    community reportをglobal searchのcontextの行にしたものと、その行のtoken数。
+    クエリごとのbatch分けは、token数の配列を順に詰めるだけで済む。
+    """
+
+    def __init__(
+        self,
+        table: pa.Table,
+        context_format: ReportContextFormat,
+        header: list[str],
+        header_tokens: int,
+    ):
+        self.table = table
+        self.format = context_format
+        self.header = header
+        self.header_tokens = header_tokens
+        self.tokens = table.column("_tokens").to_numpy()
+        self.ranks = table.column("_rank_value").to_numpy()
+        self.weights = table.column("_weight_value").to_numpy()
+        self.weight_column = (
+            context_format.community_weight_name
+            if context_format.community_weight_name in header
+            else None
+        )
+        self.rank_column = (
+            context_format.community_rank_name
+            if context_format.include_community_rank
+            else None
+        )
+
+    @property
+    def nbytes(self) -> int:
+        """Heap memory held by the rows; the text columns are memory-mapped."""
+        return int(self.tokens.nbytes + self.ranks.nbytes + self.weights.nbytes)
+
+    def __len__(self) -> int:
+        return self.table.num_rows
+
+    def pack(
+        self,
+        order: np.ndarray,
+        max_tokens: int,
+        min_community_rank: float = 0,
+    ) -> list[np.ndarray]:
+        """
+        Split the rows `order` into batches of at most `max_tokens` tokens, keeping the order.
+
+        A row that does not fit in the current batch starts the next one.
+        Reports without a rank are skipped; a rank of 0 is kept.
+        """
+        ranks = self.ranks[order]
+        # rankがないreport(NaN)だけを除き、rankが0のreportは残す
+        order = order[~np.isnan(ranks) & (ranks >= min_community_rank)]
+        batches = []
+        start = 0
+        current_tokens = self.header_tokens
+        for position, tokens in enumerate(self.tokens[order].tolist()):
+            if current_tokens + tokens > max_tokens and position > start:
+                batches.append(order[start:position])
+                start = position
+                current_tokens = self.header_tokens
+            current_tokens += tokens
+        if start < len(order):
+            batches.append(order[start:])
+        return batches
+
+    def sort_batch(self, rows: np.ndarray) -> np.ndarray:
+        """Sort the rows of a batch by weight and rank, descending, as graphrag does."""
+        keys = []
+        if self.rank_column is not None:
+            keys.append(-self.ranks[rows])
+        if self.weight_column is not None:
+            keys.append(-self.weights[rows])
+        if not keys:
+            return rows
+        return rows[np.lexsort(keys)]
+
+    def records(self, rows: np.ndarray) -> pd.DataFrame:
+        """Return the context records of `rows` as a DataFrame."""
+        records = pd.DataFrame(
+            {
+                column: self.table.column(column).take(pa.array(rows)).to_pylist()
+                for column in self.header
+            },
+            columns=self.header,
+        )
+        for column in [self.weight_column, self.rank_column]:
+            if column is not None:
+                records[column] = records[column].astype(float)
+        return records
+
+    def build_batches(
+        self,
+        order: np.ndarray,
+        max_tokens: int,
+        min_community_rank: float = 0,
+    ) -> tuple[list[str], dict[str, pd.DataFrame]]:
+        """Build the context batches of the rows `order`, in the format of build_community_context."""
+        batches = [
+            self.sort_batch(rows)
+            for rows in self.pack(order, max_tokens, min_community_rank)
+        ]
+        if not batches:
+            return [], {}
+        csv_lines = self.table.column("_csv")
+        header = _csv_line(self.header, self.format.column_delimiter)
+        all_context_text = [
+            header + "".join(csv_lines.take(pa.array(rows)).to_pylist())
+            for rows in batches
+        ]
+        return all_context_text, {
+            self.format.context_name.lower(): self.records(np.concatenate(batches))
+        }
+
+
+def _csv_line(cells: list[str], delimiter: str) -> str:
+    # DataFrame.to_csvと同じ書式の1行
+    buffer = io.StringIO()
+    csv.writer(buffer, delimiter=delimiter, lineterminator="\n").writerow(cells)
+    return buffer.getvalue()
+
+
+def _context_header(
+    context_format: ReportContextFormat, first_report: CommunityReport | None
+) -> list[str]:
+    header = ["id", "title"]
+    attribute_cols = (
+        list(first_report.attributes.keys())
+        if first_report is not None and first_report.attributes
+        else []
+    )
+    attribute_cols = [col for col in attribute_cols if col not in header]
+    if not context_format.include_community_weight:
+        attribute_cols = [
+            col for col in attribute_cols if col != context_format.community_weight_name
+        ]
+    header.extend(attribute_cols)
+    header.append("summary" if context_format.use_community_summary else "content")
+    if context_format.include_community_rank:
+        header.append(context_format.community_rank_name)
+    return header
+
+
+def _header_tokens(
+    context_format: ReportContextFormat,
+    header: list[str],
+    token_encoder: tiktoken.Encoding | None,
+) -> int:
+    return num_tokens(
+        f"-----{context_format.context_name}-----\n"
+        + context_format.column_delimiter.join(header)
+        + "\n",
+        token_encoder,
+    )
+
+
+def _report_rows_table(
+    community_reports,
+    context_format: ReportContextFormat,
+    header: list[str],
+    token_encoder: tiktoken.Encoding | None,
+) -> pa.Table:
+    attribute_cols = (
+        header[2:-2] if context_format.include_community_rank else header[2:-1]
+    )
+    weight_column = context_format.community_weight_name
+    float_columns = {weight_column} & set(attribute_cols)
+    if context_format.include_community_rank:
+        float_columns.add(context_format.community_rank_name)
+    columns: dict[str, list] = {column: [] for column in header}
+    csv_lines = []
+    tokens = []
+    rank_values = []
+    weight_values = []
+    for report in community_reports:
+        # build_community_contextと同じ行を作る
+        row = [
+            report.short_id,
+            report.title,
+            *[
+                str(report.attributes.get(field, "")) if report.attributes else ""
+                for field in attribute_cols
+            ],
+            (
+                report.summary
+                if context_format.use_community_summary
+                else report.full_content
+            ),
+        ]
+        if context_format.include_community_rank:
+            row.append(str(report.rank))
+        for column, value in zip(header, row):
+            columns[column].append(value)
+        tokens.append(
+            num_tokens(context_format.column_delimiter.join(row) + "\n", token_encoder)
+        )
+        # rankがないreportは、rankが0のreportと区別するためNaNにする
+        rank_values.append(float(report.rank) if report.rank is not None else np.nan)
+        weight_values.append(
+            float(report.attributes[weight_column])
+            if weight_column in float_columns
+            else 0.0
+        )
+        # batchのtextでは、graphragと同じくweightとrankをfloatにしてcsvに書く
+        # (rankがないreportはcontextに入らないため、"None"のまま残す)
+        csv_lines.append(
+            _csv_line(
+                [
+                    (
+                        str(float(value))
+                        if column in float_columns and value != "None"
+                        else value
+                    )
+                    for column, value in zip(header, row)
+                ],
+                context_format.column_delimiter,
+            )
+        )
+    return pa.table(
+        {
+            **{
+                column: pa.array(values, pa.string())
+                for column, values in columns.items()
+            },
+            "_csv": pa.array(csv_lines, pa.string()),
+            "_tokens": pa.array(tokens, pa.int32()),
+            "_rank_value": pa.array(rank_values, pa.float64()),
+            "_weight_value": pa.array(weight_values, pa.float64()),
+        }
+    )
+
+
+def load_report_context_rows(
+    root: str,
+    community_reports,
+    token_encoder: tiktoken.Encoding | None,
+    context_format: ReportContextFormat,
+) -> ReportContextRows:
+    """
+    Return the context rows of `community_reports`, in the same order.
+
+    The rows are formatted and tokenized once per indexing run and format, and
+    saved as an Arrow IPC file next to the columnar artifacts.
+    """
+    encoding_name = token_encoder.name if token_encoder is not None else "cl100k_base"
+    path = columnar_path(
+        root, f"report_context.{context_format.digest(encoding_name)}.arrow"
+    )
+    first_report = community_reports[0] if len(community_reports) > 0 else None
+    header = _context_header(context_format, first_report)
+    table = map_arrow_file(path) if os.path.exists(path) else None
+    if table is None or table.num_rows != len(community_reports):
+        table = _report_rows_table(
+            community_reports, context_format, header, token_encoder
+        )
+        write_arrow_file(path, table)
+        table = map_arrow_file(path)
+    return ReportContextRows(
+        table,
+        context_format,
+        header,
+        _header_tokens(context_format, header, token_encoder),
+    )
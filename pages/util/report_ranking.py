@@ -0,0 +1,159 @@
+import math
+import re
+import unicodedata
+from collections import Counter
+
+import numpy as np
+import tiktoken
+from graphrag.model import CommunityReport, Entity
+from graphrag.query.context_builder.community_context import (
+    _compute_community_weights,
+)
+from graphrag.query.llm.text_utils import num_tokens
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+|[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff]+")
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    英数字は単語単位、日本語(かな・漢字)は文字bigramに分割する。
+    形態素解析器なしでも日本語のレポートをBM25で検索できるようにするため。
+    """
+    tokens = []
+    for word in _TOKEN_PATTERN.findall(unicodedata.normalize("NFKC", text).lower()):
+        if word.isascii() or len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i : i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+class ReportRanker:
+    """
+    community reportをクエリとの関連度で順位付けする。
+    BM25のスコアに、communityのrankとoccurrence weightを加味して並べる。
+    """
+
+    def __init__(
+        self,
+        community_reports: list[CommunityReport],
+        entities: list[Entity] | None = None,
+        token_encoder: tiktoken.Encoding | None = None,
+        community_weight_name: str = "occurrence weight",
+        rank_weight: float = 0.1,
+        occurrence_weight: float = 0.1,
+        k1: float = 1.5,
+        b: float = 0.75,
+        token_counts: np.ndarray | None = None,
+    ):
+        self.community_reports = community_reports
+        self.rank_weight = rank_weight
+        self.occurrence_weight = occurrence_weight
+        self.k1 = k1
+        self.b = b
+
+        # build_community_contextと同じ重みを全reportに対して一度だけ計算しておく
+        if entities and community_reports:
+            _compute_community_weights(
+                community_reports=community_reports,
+                entities=entities,
+                weight_attribute=community_weight_name,
+                normalize=True,
+            )
+
+        n_reports = len(community_reports)
+        self.ranks = np.array(
+            [report.rank or 0.0 for report in community_reports], dtype=np.float32
+        )
+        self.weights = np.array(
+            [
+                float((report.attributes or {}).get(community_weight_name, 0.0))
+                for report in community_reports
+            ],
+            dtype=np.float32,
+        )
+        # 事前に数えたcontextの行のtoken数があれば、それを使う
+        self.token_counts = (
+            np.asarray(token_counts, dtype=np.int64)
+            if token_counts is not None
+            else np.array(
+                [
+                    num_tokens(report.full_content, token_encoder)
+                    for report in community_reports
+                ],
+                dtype=np.int64,
+            )
+        )
+
+        # 転置インデックス: term -> (report index, term frequency)
+        postings: dict[str, tuple[list[int], list[int]]] = {}
+        self.doc_lengths = np.zeros(n_reports, dtype=np.float32)
+        for index, report in enumerate(community_reports):
+            tokens = tokenize(f"{report.title}\n{report.full_content}")
+            self.doc_lengths[index] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                doc_ids, tfs = postings.setdefault(term, ([], []))
+                doc_ids.append(index)
+                tfs.append(tf)
+        self.postings = {
+            term: (np.array(doc_ids), np.array(tfs, dtype=np.float32))
+            for term, (doc_ids, tfs) in postings.items()
+        }
+        self.avg_doc_length = float(self.doc_lengths.mean()) if n_reports else 0.0
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [self.ranks, self.weights, self.token_counts, self.doc_lengths]
+        for doc_ids, tfs in self.postings.values():
+            arrays.extend([doc_ids, tfs])
+        return int(sum(array.nbytes for array in arrays))
+
+    def bm25(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.community_reports), dtype=np.float32)
+        if len(scores) == 0:
+            return scores
+        n_reports = len(scores)
+        norm = self.k1 * (
+            1 - self.b + self.b * self.doc_lengths / max(self.avg_doc_length, 1.0)
+        )
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            doc_ids, tfs = self.postings[term]
+            idf = math.log(1 + (n_reports - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+            scores[doc_ids] += idf * tfs * (self.k1 + 1) / (tfs + norm[doc_ids])
+        return scores
+
+    def score(self, query: str) -> np.ndarray:
+        bm25 = self.bm25(query)
+        if bm25.max(initial=0) > 0:
+            bm25 = bm25 / bm25.max()
+        ranks = self.ranks / max(float(self.ranks.max(initial=0)), 1.0)
+        return bm25 + self.rank_weight * ranks + self.occurrence_weight * self.weights
+
+    def select_indices(
+        self,
+        query: str,
+        top_k: int | None = None,
+        token_budget: int | None = None,
+    ) -> np.ndarray:
+        """Return the indices of the most relevant reports, best first."""
+        order = np.argsort(-self.score(query), kind="stable")
+        if top_k is not None:
+            order = order[:top_k]
+        if token_budget is not None:
+            within_budget = np.cumsum(self.token_counts[order]) <= token_budget
+            # 最も関連度の高いreportは予算を超えていても残す
+            within_budget[:1] = True
+            order = order[within_budget]
+        return order
+
+    def select(
+        self,
+        query: str,
+        top_k: int | None = None,
+        token_budget: int | None = None,
+    ) -> list[CommunityReport]:
+        """Return the most relevant reports, best first, within `top_k` and `token_budget`."""
+        order = self.select_indices(query, top_k=top_k, token_budget=token_budget)
+        return [self.community_reports[index] for index in order]
@@ -1,15 +1,38 @@
-import asyncio
+import io
 import random
-from functools import partial
+import time
 
+import altair as alt
+import httpx
+import pandas as pd
 import streamlit as st
 from openai.types.beta.assistant_stream_event import ThreadMessageDelta
 from openai.types.beta.threads.text_delta_block import TextDeltaBlock
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from . import openai_clients, rate_limiter, tracing
+from .answer_cache import get_answer_cache
+
+# messageの作成などの通常のAPI呼び出し
+REQUEST_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+# streamingではreadのtimeoutがevent間の待ち時間の上限になる
+STREAM_TIMEOUT = httpx.Timeout(30.0, connect=5.0, read=120.0)
+# streaming中に回答を描画し直す間隔(秒)と、間隔を待たずに描画するたまった文字数
+RENDER_INTERVAL = 0.1
+RENDER_MAX_PENDING_CHARS = 2000
 
 
 def init_state():
     if "api_key" not in st.session_state:
         st.session_state["api_key"] = None
+    if "indexing_jobs" not in st.session_state:
+        st.session_state["indexing_jobs"] = []
+    if "vector_store_uploads" not in st.session_state:
+        st.session_state["vector_store_uploads"] = []
+    # このsessionのOpenAI APIのrequestを、rate limiterで他のsessionと公平に扱う
+    ctx = get_script_run_ctx()
+    if ctx is not None:
+        rate_limiter.set_session(ctx.session_id)
 
 
 def sidebar():
@@ -22,6 +45,29 @@ def sidebar():
 
     st.session_state["api_key"] = api_key
 
+    stats = openai_clients.get_client_registry().stats()
+    if stats["requests"]:
+        st.sidebar.caption(
+            f"OpenAI接続の再利用率: {stats['reuse_rate']:.0%} "
+            f"({stats['requests']} requests / {stats['connections']} connections)"
+        )
+    limiter_stats = rate_limiter.get_rate_limiter().stats()
+    if limiter_stats["waited"] or limiter_stats["throttled"]:
+        st.sidebar.caption(
+            f"LLMの待ち行列: {limiter_stats['queue_depth']}件 "
+            f"({limiter_stats['waiting_sessions']} sessions), "
+            f"待ち時間 平均{limiter_stats['mean_wait']:.1f}s"
+            f" / p95 {limiter_stats['p95_wait']:.1f}s, "
+            f"429: {limiter_stats['throttled']}回"
+        )
+    cache_stats = get_answer_cache().stats()
+    if cache_stats["context_hits"] + cache_stats["answer_hits"] + cache_stats["misses"]:
+        st.sidebar.caption(
+            f"回答キャッシュのヒット率: {cache_stats['hit_rate']:.0%} "
+            f"(回答 {cache_stats['answer_hits']} / context {cache_stats['context_hits']}"
+            f" / miss {cache_stats['misses']}, {cache_stats['entries']}件)"
+        )
+
 
 def setting_assistant(client):
     with st.container(border=True):
@@ -99,57 +145,178 @@ def update_assistant(client, assistant_id, vector_store_id):
         )
 
 
-def creat_assistant_reply(client, assistant_id, thread_id, user_query):
-    client.beta.threads.messages.create(
-        thread_id=thread_id, role="user", content=user_query
-    )
-    stream = client.beta.threads.runs.create(
-        thread_id=thread_id,
-        assistant_id=assistant_id,
-        stream=True,
-    )
+class ReplyRenderer:
+    """
+    streamingされる回答のdeltaをためて、一定の間隔ごとにまとめて描画する。
+    - deltaはcontent blockごとのStringIOに追記し、文字列の連結を繰り返さない
+    - 描画はRENDER_INTERVALごと、またはRENDER_MAX_PENDING_CHARSがたまったときだけ行う
+    - 最初のdeltaまでの時間(TTFT)と、1秒あたりのdelta数(≒token数)を表示する
+    """
 
-    assistant_reply_box = st.empty()
-    assistant_reply = ""
+    def __init__(
+        self,
+        interval: float = RENDER_INTERVAL,
+        max_pending_chars: int = RENDER_MAX_PENDING_CHARS,
+    ):
+        self.interval = interval
+        self.max_pending_chars = max_pending_chars
+        self._box = st.empty()
+        self._stats_box = st.empty()
+        self._blocks: dict[int, io.StringIO] = {}
+        self._pending_chars = 0
+        self._last_render = 0.0
+        self.started_at = time.perf_counter()
+        self.first_token_at: float | None = None
+        self.finished_at: float | None = None
+        self.tokens = 0
 
-    for event in stream:
-        if isinstance(event, ThreadMessageDelta):
-            if isinstance(event.data.delta.content[0], TextDeltaBlock):
-                assistant_reply += event.data.delta.content[0].text.value
-                assistant_reply_box.markdown(assistant_reply)
-    return assistant_reply
+    def add_event(self, event) -> None:
+        if not isinstance(event, ThreadMessageDelta):
+            return
+        for block in event.data.delta.content or []:
+            if isinstance(block, TextDeltaBlock) and block.text and block.text.value:
+                self.add(block.index, block.text.value)
 
+    def add(self, index: int, text: str) -> None:
+        """Append a text delta of the content block at `index`."""
+        now = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        self._blocks.setdefault(index, io.StringIO()).write(text)
+        self.tokens += 1
+        self._pending_chars += len(text)
+        if (
+            now - self._last_render >= self.interval
+            or self._pending_chars >= self.max_pending_chars
+        ):
+            self.flush(now)
+
+    @property
+    def text(self) -> str:
+        return "\n\n".join(
+            self._blocks[index].getvalue() for index in sorted(self._blocks)
+        )
+
+    def flush(self, now: float | None = None) -> None:
+        self._box.markdown(self.text)
+        self._pending_chars = 0
+        self._last_render = now if now is not None else time.perf_counter()
+
+    @property
+    def time_to_first_token(self) -> float | None:
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started_at
+
+    @property
+    def tokens_per_second(self) -> float | None:
+        end = self.finished_at or time.perf_counter()
+        if self.first_token_at is None or end <= self.first_token_at:
+            return None
+        return self.tokens / (end - self.first_token_at)
+
+    def trace_attributes(self) -> dict:
+        attributes = {"stream.deltas": self.tokens, "reply.chars": len(self.text)}
+        if self.time_to_first_token is not None:
+            attributes["stream.ttft_ms"] = self.time_to_first_token * 1000
+        return attributes
+
+    def finish(self) -> str:
+        """Render the remaining deltas and the stats, and return the whole reply."""
+        self.finished_at = time.perf_counter()
+        self.flush(self.finished_at)
+        if self.time_to_first_token is not None:
+            tokens_per_second = self.tokens_per_second
+            self._stats_box.caption(
+                f"TTFT {self.time_to_first_token:.2f}s"
+                + (
+                    f" · {tokens_per_second:.1f} tokens/s"
+                    if tokens_per_second is not None
+                    else ""
+                )
+            )
+        return self.text
 
-async def create_assistant_reply_async(client, assistant_id, thread_id, user_query):
-    loop = asyncio.get_event_loop()
 
-    await loop.run_in_executor(
-        None,
-        partial(
-            client.beta.threads.messages.create,
+def creat_assistant_reply(client, assistant_id, thread_id, user_query):
+    with tracing.span("assistant.create_message", {"message.chars": len(user_query)}):
+        client.beta.threads.messages.create(
+            thread_id=thread_id, role="user", content=user_query
+        )
+    # TTFTはrunの作成を始めた時点から計る
+    with tracing.span("assistant.stream") as span:
+        renderer = ReplyRenderer()
+        stream = client.beta.threads.runs.create(
+            thread_id=thread_id,
+            assistant_id=assistant_id,
+            stream=True,
+        )
+        with stream:
+            for event in stream:
+                renderer.add_event(event)
+        reply = renderer.finish()
+        span.set_attributes(renderer.trace_attributes())
+    return reply
+
+
+async def create_assistant_reply_async(client, assistant_id, thread_id, user_query):
+    with tracing.span("assistant.create_message", {"message.chars": len(user_query)}):
+        await client.beta.threads.messages.create(
             thread_id=thread_id,
             role="user",
             content=user_query,
-        ),
-    )
+            timeout=REQUEST_TIMEOUT,
+        )
 
-    stream = await loop.run_in_executor(
-        None,
-        partial(
-            client.beta.threads.runs.create,
+    with tracing.span("assistant.stream") as span:
+        renderer = ReplyRenderer()
+        stream = await client.beta.threads.runs.create(
             thread_id=thread_id,
             assistant_id=assistant_id,
             stream=True,
-        ),
-    )
+            timeout=STREAM_TIMEOUT,
+        )
 
-    assistant_reply_box = st.empty()
-    assistant_reply = ""
+        # eventを待つ間は他のcoroutineに処理を譲る
+        async with stream:
+            async for event in stream:
+                renderer.add_event(event)
+        reply = renderer.finish()
+        span.set_attributes(renderer.trace_attributes())
+    return reply
 
-    for event in stream:
-        if isinstance(event, ThreadMessageDelta):
-            if isinstance(event.data.delta.content[0], TextDeltaBlock):
-                assistant_reply += event.data.delta.content[0].text.value
-                assistant_reply_box.markdown(assistant_reply)
 
-    return assistant_reply
+def trace_panel():
+    """Show the waterfall of this session's last traced query, when enabled in the sidebar."""
+    if not st.sidebar.toggle("処理時間の内訳を表示 (デバッグ)", key="show_trace_panel"):
+        return
+    trace = tracing.get_tracer().last_trace()
+    if trace is None:
+        return
+    rows = pd.DataFrame(trace.waterfall())
+    rows["attributes"] = rows["attributes"].map(
+        lambda attributes: ", ".join(f"{k}={v}" for k, v in attributes.items())
+    )
+    with st.expander(f"直前の質問の処理時間: {trace.duration_ms / 1000:.2f}s"):
+        chart = (
+            alt.Chart(rows)
+            .mark_bar()
+            .encode(
+                x=alt.X("start_ms:Q", title="ms"),
+                x2="end_ms:Q",
+                y=alt.Y("label:N", sort=None, title=None),
+                color=alt.Color("depth:O", legend=None),
+                tooltip=[
+                    "label",
+                    alt.Tooltip("duration_ms:Q", format=".1f"),
+                    "attributes",
+                ],
+            )
+            .properties(height=22 * len(rows) + 40)
+        )
+        st.altair_chart(chart, use_container_width=True)
+        st.dataframe(
+            rows[["label", "duration_ms", "attributes", "error"]],
+            hide_index=True,
+            use_container_width=True,
+        )
@@ -0,0 +1,340 @@
+import contextvars
+import json
+import logging
+import numbers
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Any
+
+from .rate_limiter import current_session
+
+log = logging.getLogger(__name__)
+
+DEFAULT_EXPORT_PATH = "./data/traces/traces.jsonl"
+SERVICE_NAME = "rag-demo-on-streamlit"
+SCOPE_NAME = __name__
+# OTLPのSpan.SpanKind.SPAN_KIND_INTERNALとStatus.StatusCode.STATUS_CODE_ERROR
+SPAN_KIND_INTERNAL = 1
+STATUS_CODE_ERROR = 2
+
+
+class Span:
+    """traceの中の1つの処理区間。開始・終了時刻と属性を持つ"""
+
+    recording = True
+
+    def __init__(
+        self,
+        trace: "Trace",
+        name: str,
+        parent_id: str | None,
+        attributes: dict[str, Any] | None = None,
+    ):
+        self.trace = trace
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes: dict[str, Any] = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns: int | None = None
+        self.error: str | None = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def set_attributes(self, attributes: dict[str, Any]) -> None:
+        self.attributes.update(attributes)
+
+    def record_error(self, error: BaseException) -> None:
+        self.error = f"{type(error).__name__}: {error}"
+
+    def end(self) -> None:
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+
+    @property
+    def duration_ms(self) -> float:
+        end_ns = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end_ns - self.start_ns) / 1e6
+
+
+class _NonRecordingSpan:
+    """traceの外で呼ばれたときのspan。何も記録しない"""
+
+    recording = False
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def set_attributes(self, attributes: dict[str, Any]) -> None:
+        pass
+
+    def record_error(self, error: BaseException) -> None:
+        pass
+
+    def end(self) -> None:
+        pass
+
+
+NON_RECORDING_SPAN = _NonRecordingSpan()
+
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+class Trace:
+    """1回の質問の処理で作られたspanの集まり"""
+
+    def __init__(self, name: str, session: str):
+        self.trace_id = secrets.token_hex(16)
+        self.name = name
+        self.session = session
+        self.spans: list[Span] = []
+        self._lock = threading.Lock()
+        self.root = self.start_span(name, None, {"session.id": session})
+
+    def start_span(
+        self, name: str, parent_id: str | None, attributes: dict[str, Any] | None
+    ) -> Span:
+        span = Span(self, name, parent_id, attributes)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def close(self) -> None:
+        """End the root span, and the spans still open (e.g. cancelled map batches) with it."""
+        self.root.end()
+        with self._lock:
+            for span in self.spans:
+                if span.end_ns is None:
+                    span.end_ns = self.root.end_ns
+                    span.attributes["span.unfinished"] = True
+
+    @property
+    def duration_ms(self) -> float:
+        return self.root.duration_ms
+
+    def waterfall(self) -> list[dict]:
+        """Return the spans in depth-first order with their offsets from the root."""
+        with self._lock:
+            spans = list(self.spans)
+        children: dict[str | None, list[Span]] = {}
+        for span in spans:
+            children.setdefault(span.parent_id, []).append(span)
+        rows = []
+        name_counts: dict[str, int] = {}
+
+        def _visit(span: Span, depth: int) -> None:
+            name_counts[span.name] = name_counts.get(span.name, 0) + 1
+            count = name_counts[span.name]
+            rows.append(
+                {
+                    # 同じ名前のspan(map batchなど)も別の行に並べる
+                    "label": "· " * depth
+                    + span.name
+                    + (f" #{count}" if count > 1 else ""),
+                    "depth": depth,
+                    "start_ms": (span.start_ns - self.root.start_ns) / 1e6,
+                    "end_ms": (span.end_ns - self.root.start_ns) / 1e6,
+                    "duration_ms": span.duration_ms,
+                    "attributes": span.attributes,
+                    "error": span.error,
+                }
+            )
+            for child in sorted(
+                children.get(span.span_id, []), key=lambda s: s.start_ns
+            ):
+                _visit(child, depth + 1)
+
+        _visit(self.root, 0)
+        return rows
+
+    def to_otlp(self) -> dict:
+        """Return the trace as an OTLP/JSON ExportTraceServiceRequest."""
+        with self._lock:
+            spans = list(self.spans)
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": _otlp_attributes({"service.name": SERVICE_NAME})
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": SCOPE_NAME},
+                            "spans": [self._otlp_span(span) for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    def _otlp_span(self, span: Span) -> dict:
+        record = {
+            "traceId": self.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": SPAN_KIND_INTERNAL,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": _otlp_attributes(span.attributes),
+            "status": (
+                {"code": STATUS_CODE_ERROR, "message": span.error} if span.error else {}
+            ),
+        }
+        if span.parent_id is not None:
+            record["parentSpanId"] = span.parent_id
+        return record
+
+
+def _otlp_value(value: Any) -> dict:
+    # OTLP/JSONでは64bit整数は文字列で表す
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, numbers.Integral):
+        return {"intValue": str(value)}
+    if isinstance(value, numbers.Real):
+        return {"doubleValue": float(value)}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [_otlp_value(v) for v in value]}}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: dict[str, Any]) -> list[dict]:
+    return [
+        {"key": key, "value": _otlp_value(value)} for key, value in attributes.items()
+    ]
+
+
+class Tracer:
+    """
+    終わったtraceを保持し、OTLPのJSON形式でファイルに書き出す。
+    - sessionごとに直近のtraceを持ち、デバッグ用のwaterfallの表示に使う
+    - export_pathを指定すると、traceごとに1行のExportTraceServiceRequestを追記する
+      (OpenTelemetry Collectorのfile exporterと同じ形式)
+    """
+
+    def __init__(
+        self,
+        export_path: str | None = DEFAULT_EXPORT_PATH,
+        max_traces: int = 100,
+    ):
+        self.export_path = export_path
+        self.max_traces = max_traces
+        self._recent: deque[Trace] = deque(maxlen=max_traces)
+        self._last_by_session: OrderedDict[str, Trace] = OrderedDict()
+        self._lock = threading.Lock()
+        self._export_lock = threading.Lock()
+
+    def finish(self, trace: Trace) -> None:
+        trace.close()
+        with self._lock:
+            self._recent.append(trace)
+            self._last_by_session[trace.session] = trace
+            self._last_by_session.move_to_end(trace.session)
+            while len(self._last_by_session) > self.max_traces:
+                self._last_by_session.popitem(last=False)
+        if self.export_path:
+            self._export(trace)
+
+    def _export(self, trace: Trace) -> None:
+        line = json.dumps(trace.to_otlp(), ensure_ascii=False) + "\n"
+        try:
+            os.makedirs(
+                os.path.dirname(os.path.abspath(self.export_path)), exist_ok=True
+            )
+            with self._export_lock, open(self.export_path, "a", encoding="utf-8") as f:
+                f.write(line)
+        except OSError:
+            # traceの書き出しに失敗しても質問の処理は続ける
+            log.exception("failed to export trace to %s", self.export_path)
+
+    def last_trace(self, session: str | None = None) -> Trace | None:
+        """Return the last finished trace of `session` (the current session by default)."""
+        with self._lock:
+            return self._last_by_session.get(session or current_session.get())
+
+    def recent_traces(self) -> list[Trace]:
+        with self._lock:
+            return list(self._recent)
+
+
+_tracer: Tracer | None = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer() -> Tracer:
+    global _tracer
+    with _tracer_lock:
+        if _tracer is None:
+            _tracer = Tracer()
+        return _tracer
+
+
+def current_span() -> Span | _NonRecordingSpan:
+    """Return the innermost open span, or a span recording nothing outside a trace."""
+    return _current_span.get() or NON_RECORDING_SPAN
+
+
+@contextmanager
+def trace(
+    name: str, attributes: dict[str, Any] | None = None, tracer: Tracer | None = None
+) -> Iterator[Span]:
+    """Start a new trace whose root span is `name`, and hand it to the tracer at the end."""
+    tracer = tracer or get_tracer()
+    new_trace = Trace(name, current_session.get())
+    root = new_trace.root
+    root.set_attributes(attributes or {})
+    token = _current_span.set(root)
+    try:
+        yield root
+    except BaseException as e:
+        root.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        tracer.finish(new_trace)
+
+
+def start_span(
+    name: str,
+    attributes: dict[str, Any] | None = None,
+    parent: Span | _NonRecordingSpan | None = None,
+) -> Span | _NonRecordingSpan:
+    """
+    Start a child span of `parent` (the current span by default) without making it current.
+
+    For stages that span the yields of an async generator; the caller must call end().
+    """
+    parent = parent or _current_span.get()
+    if parent is None or not parent.recording:
+        return NON_RECORDING_SPAN
+    return parent.trace.start_span(name, parent.span_id, attributes)
+
+
+@contextmanager
+def span(
+    name: str,
+    attributes: dict[str, Any] | None = None,
+    parent: Span | _NonRecordingSpan | None = None,
+) -> Iterator[Span | _NonRecordingSpan]:
+    """Record the enclosed block as a child span. Outside a trace nothing is recorded."""
+    child = start_span(name, attributes, parent)
+    if not child.recording:
+        yield child
+        return
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        child.end()
@@ -0,0 +1,302 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+import os
+import random
+import string
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import BinaryIO
+
+import openai
+
+from . import openai_clients
+
+DEFAULT_INPUT_DIR = "data/assistants_api/input"
+DEFAULT_INDEX_PATH = "data/assistants_api/uploaded_files.json"
+CHUNK_SIZE = 1024 * 1024
+
+QUEUED = "queued"
+UPLOADING = "uploading"
+PROCESSING = "processing"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+TERMINAL_STATUSES = {SUCCEEDED, FAILED}
+
+
+@dataclass
+class LocalFile:
+    path: str
+    sha256: str
+    size: int
+
+
+def save_upload(
+    uploaded_file: BinaryIO, name: str, directory: str = DEFAULT_INPUT_DIR
+) -> LocalFile:
+    """
+    Copy an uploaded file to `directory/<sha256>/<name>` in chunks, hashing it on the way.
+
+    The file is written to a temporary path first, so sessions uploading different
+    files of the same name never overwrite each other.
+    """
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    uploaded_file.seek(0)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while chunk := uploaded_file.read(CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        sha256 = digest.hexdigest()
+        # 内容ごとのディレクトリに置くため、同じパスには常に同じ内容が入る
+        content_dir = os.path.join(directory, sha256)
+        os.makedirs(content_dir, exist_ok=True)
+        path = os.path.join(content_dir, os.path.basename(name))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return LocalFile(path=path, sha256=sha256, size=size)
+
+
+class UploadedFileIndex:
+    """
+    アップロード済みのファイルのsha256とOpenAIのfile idの対応を保存する。
+    fileはOpenAIのアカウントごとにあるため、API keyのhashごとに分けて持つ。
+    """
+
+    def __init__(self, path: str = DEFAULT_INDEX_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self) -> dict[str, dict[str, str]]:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def get(self, api_key: str, sha256: str) -> str | None:
+        with self._lock:
+            return (
+                self._read().get(openai_clients.api_key_hash(api_key), {}).get(sha256)
+            )
+
+    def set(self, api_key: str, sha256: str, file_id: str | None) -> None:
+        with self._lock:
+            index = self._read()
+            files = index.setdefault(openai_clients.api_key_hash(api_key), {})
+            if file_id is None:
+                files.pop(sha256, None)
+            else:
+                files[sha256] = file_id
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self.path)
+
+
+class _ProgressReader:
+    """File wrapper counting the bytes httpx has read while streaming the upload."""
+
+    def __init__(self, f: BinaryIO, on_read):
+        self._f = f
+        self._on_read = on_read
+        self.name = f.name
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self._f.read(size)
+        self._on_read(len(chunk))
+        return chunk
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        # 再送のために先頭へ戻した場合は、送った量も戻す
+        if offset == 0 and whence == os.SEEK_SET:
+            self._on_read(-self._f.tell())
+        return self._f.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._f.tell()
+
+    def fileno(self) -> int:
+        return self._f.fileno()
+
+
+@dataclass
+class VectorStoreUpload:
+    upload_id: str
+    files: list[LocalFile]
+    status: str = QUEUED
+    created_at: float = field(default_factory=time.time)
+    finished_at: float | None = None
+    uploaded_files: int = 0
+    skipped_files: int = 0
+    uploaded_bytes: int = 0
+    vector_store_id: str | None = None
+    error: str | None = None
+
+    @property
+    def total_files(self) -> int:
+        return len(self.files)
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(local_file.size for local_file in self.files)
+
+    @property
+    def done(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+    @property
+    def progress(self) -> float:
+        if self.status == SUCCEEDED:
+            return 1.0
+        if self.total_bytes == 0:
+            return 0.0
+        # VectorStoreでの処理の分を最後の1割とする
+        return 0.9 * min(self.uploaded_bytes / self.total_bytes, 1.0)
+
+
+class VectorStoreUploadManager:
+    """
+    VectorStoreの作成をバックグラウンドのthreadのevent loopで行う。
+    - ファイルはディスクからchunkごとに読みながら、max_concurrent_uploads本まで並行に送る
+    - 同じ内容(sha256)のファイルがアップロード済みであれば、そのfile idを使う
+    - 画面は`get`で進捗をポーリングする
+    """
+
+    def __init__(
+        self,
+        max_concurrent_uploads: int = 4,
+        index: UploadedFileIndex | None = None,
+        poll_interval_ms: int = 1000,
+    ):
+        self.max_concurrent_uploads = max_concurrent_uploads
+        self.index = index or UploadedFileIndex()
+        self.poll_interval_ms = poll_interval_ms
+        self._uploads: dict[str, VectorStoreUpload] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, api_key: str, files: list[LocalFile]) -> str:
+        upload_id = "vsu_" + "".join(
+            random.choices(string.ascii_letters + string.digits, k=16)
+        )
+        # 同じ内容のファイルは1度だけ送る
+        unique_files = list(
+            {local_file.sha256: local_file for local_file in files}.values()
+        )
+        upload = VectorStoreUpload(upload_id=upload_id, files=unique_files)
+        with self._lock:
+            self._uploads[upload_id] = upload
+        # rate limiterがsessionを区別できるよう、呼び出し元のcontextvarsで動かす
+        threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(openai_clients.run, self._run(upload, api_key)),
+            name=f"vector-store-upload-{upload_id}",
+            daemon=True,
+        ).start()
+        return upload_id
+
+    def get(self, upload_id: str) -> VectorStoreUpload | None:
+        with self._lock:
+            return self._uploads.get(upload_id)
+
+    async def _run(self, upload: VectorStoreUpload, api_key: str) -> None:
+        client = openai_clients.get_async_openai_client(api_key)
+        try:
+            upload.status = UPLOADING
+            vector_store = await client.beta.vector_stores.create(
+                name="RAG Demo",
+                expires_after={"anchor": "last_active_at", "days": 1},
+            )
+            upload.vector_store_id = vector_store.id
+
+            semaphore = asyncio.Semaphore(self.max_concurrent_uploads)
+
+            async def _upload(local_file: LocalFile) -> str:
+                async with semaphore:
+                    return await self._upload_file(client, api_key, upload, local_file)
+
+            file_ids = await asyncio.gather(
+                *(_upload(local_file) for local_file in upload.files)
+            )
+
+            upload.status = PROCESSING
+            batch = await client.beta.vector_stores.file_batches.create_and_poll(
+                vector_store_id=vector_store.id,
+                file_ids=file_ids,
+                poll_interval_ms=self.poll_interval_ms,
+            )
+            if batch.file_counts.failed:
+                raise RuntimeError(
+                    f"{batch.file_counts.failed} files failed to be processed"
+                )
+            upload.status = SUCCEEDED
+        except Exception as e:
+            upload.error = str(e)
+            upload.status = FAILED
+        finally:
+            upload.finished_at = time.time()
+
+    async def _upload_file(
+        self, client, api_key: str, upload: VectorStoreUpload, local_file: LocalFile
+    ) -> str:
+        # indexはJSONファイルの読み書きのため、event loopを止めないよう別スレッドで行う
+        file_id = await asyncio.to_thread(self.index.get, api_key, local_file.sha256)
+        if file_id is not None:
+            try:
+                await client.files.retrieve(file_id)
+                upload.skipped_files += 1
+                upload.uploaded_bytes += local_file.size
+                return file_id
+            except openai.NotFoundError:
+                # OpenAI側で削除されていれば、もう1度送る
+                await asyncio.to_thread(
+                    self.index.set, api_key, local_file.sha256, None
+                )
+
+        loop = asyncio.get_running_loop()
+
+        def _add_uploaded_bytes(n: int) -> None:
+            upload.uploaded_bytes += n
+
+        def _on_read(n: int) -> None:
+            # 送った量は、並行する他のuploadと競合しないようevent loopで足す
+            loop.call_soon_threadsafe(_add_uploaded_bytes, n)
+
+        def _create_file():
+            # httpxのmultipartはファイルを同期的に読むため、ファイルを開いて読みながら
+            # 送る処理は、同期のclientで別スレッドから行う
+            with open(local_file.path, "rb") as f:
+                return openai_clients.get_openai_client(api_key).files.create(
+                    file=(
+                        os.path.basename(local_file.path),
+                        _ProgressReader(f, _on_read),
+                    ),
+                    purpose="assistants",
+                )
+
+        file = await asyncio.to_thread(_create_file)
+        await asyncio.to_thread(self.index.set, api_key, local_file.sha256, file.id)
+        upload.uploaded_files += 1
+        return file.id
+
+
+_upload_manager: VectorStoreUploadManager | None = None
+_upload_manager_lock = threading.Lock()
+
+
+def get_upload_manager() -> VectorStoreUploadManager:
+    global _upload_manager
+    with _upload_manager_lock:
+        if _upload_manager is None:
+            _upload_manager = VectorStoreUploadManager()
+        return _upload_manager
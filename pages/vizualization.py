@@ -1,52 +1,62 @@
-import pandas as pd
+import json
+
 import streamlit as st
-from streamlit_agraph import Config, Edge, Node, agraph
-
-
-def convert_entities_to_nodes(df):
-    """Convert the entities dataframe to a list of Node objects for streamlit-agraph."""
-    nodes = []
-    for _, row in df.iterrows():
-        node_id = row["title"]
-        nodes.append(
-            Node(
-                id=node_id,
-                label=node_id,
-                size=4 + row["size"] * 4,  # Adjust size factor as needed
-                color=community_to_color(row["community"]),
-            )
-        )
-    return nodes
-
-
-def convert_relationships_to_edges(df):
-    """Convert the relationships dataframe to a list of Edge objects for streamlit-agraph."""
-    edges = []
-    for _, row in df.iterrows():
-        edges.append(
-            Edge(
-                source=row["source"],
-                target=row["target"],
-                title=row.get("description", ""),
-                width=row["weight"] * 2,  # Adjust width factor as needed
-            )
-        )
-    return edges
-
-
-def community_to_color(community):
-    """Map a community to a color."""
-    colors = [
-        "crimson",
-        "darkorange",
-        "indigo",
-        "cornflowerblue",
-        "cyan",
-        "teal",
-        "green",
-    ]
-    return (
-        colors[int(community) % len(colors)] if community is not None else "lightgray"
+from streamlit_agraph import Config, _agraph
+
+from pages.util.graph_filter import (
+    GraphFilter,
+    GraphFilterIndex,
+    load_graph_filter_index,
+)
+from pages.util.graph_lod import load_graph_lod_index
+from pages.util.graph_payload import GraphPayload, load_graph_payload, view_records
+
+# これを超えるentity数のグラフは全体を描画するとブラウザが固まる
+FULL_GRAPH_MAX_NODES = 2000
+
+
+def render_payload(payload: GraphPayload, config: Config):
+    """Render a graph like `agraph()`, reusing the payload's cached JSON."""
+    # agraph()は毎回すべてのノード・edgeをjson.dumpsするため、キャッシュ済みのJSONを
+    # component(_agraph)に直接渡す。_agraphは非公開のため、requirements.txtで
+    # streamlit-agraphのversionを固定している(0.0.45のagraph()と同じ引数で呼ぶ)
+    return _agraph(data=payload.data_json, config=json.dumps(config.__dict__))
+
+
+def filter_controls(filter_index: GraphFilterIndex) -> GraphFilter:
+    lod = filter_index.lod
+    col1, col2, col3 = st.columns(3)
+    level = col1.selectbox("Community level", options=lod.levels)
+    communities = col2.multiselect(
+        "Community", options=list(lod.community_labels[level])
+    )
+    entity_types = col3.multiselect(
+        "Entity type", options=filter_index.entity_type_options()
+    )
+
+    col1, col2, col3 = st.columns(3)
+    max_degree = int(filter_index.sorted_degrees[-1]) if len(lod.titles) else 0
+    min_degree, max_degree = col1.slider(
+        "Degree", min_value=0, max_value=max(max_degree, 1), value=(0, max_degree)
+    )
+    weights = filter_index.sorted_weights
+    max_weight = float(weights[-1]) if len(weights) else 0.0
+    min_weight, max_weight = col2.slider(
+        "Edge weight",
+        min_value=0.0,
+        max_value=max(max_weight, 1.0),
+        value=(0.0, max(max_weight, 1.0)),
+    )
+    title_prefix = col3.text_input("Entity名(前方一致)")
+    return GraphFilter(
+        level=level,
+        communities=communities,
+        entity_types=entity_types,
+        min_degree=min_degree,
+        max_degree=max_degree,
+        min_weight=min_weight,
+        max_weight=max_weight,
+        title_prefix=title_prefix,
     )
 
 
@@ -60,16 +70,73 @@ def visualization():
     if not (len(graph_store_id) == 27 and graph_store_id.startswith("gs_")):
         return
 
-    input_dir = f"data/graphrag/{graph_store_id}/output/default/artifacts"
+    root = f"data/graphrag/{graph_store_id}"
+    index = load_graph_lod_index(root)
 
-    entity_table = "create_final_nodes"
-    relationship_table = "create_final_relationships"
-
-    entity_df = pd.read_parquet(f"{input_dir}/{entity_table}.parquet")
-    relationship_df = pd.read_parquet(f"{input_dir}/{relationship_table}.parquet")
+    with st.container(border=True):
+        mode = st.radio(
+            "表示モード",
+            ["Community", "Entityの近傍", "フィルタ", "全体"],
+            horizontal=True,
+        )
+        if mode == "Community":
+            col1, col2 = st.columns(2)
+            level = col1.selectbox("Community level", options=index.levels)
+            # ノードをクリックしたcommunityを展開する
+            expanded = st.session_state.get("expanded_community")
+            options = ["(展開しない)"] + list(index.community_labels[level])
+            community = col2.selectbox(
+                "展開するcommunity",
+                options=options,
+                index=options.index(expanded) if expanded in options else 0,
+            )
+            if community == "(展開しない)":
+                view = index.community_overview(level)
+            else:
+                view = index.expand_community(level, community)
+        elif mode == "Entityの近傍":
+            col1, col2, col3 = st.columns([2, 1, 1])
+            title = col1.text_input(
+                "Entity", value=st.session_state.get("focused_entity", "")
+            )
+            # graphragはentityの名前を大文字で抽出する
+            if title not in index.title_to_id:
+                title = title.upper()
+            k = col2.slider("hop数", min_value=1, max_value=3, value=1)
+            max_nodes = col3.slider("最大ノード数", 50, 500, value=200, step=50)
+            if title not in index.title_to_id:
+                st.info("表示するentityの名前を入力してください。")
+                if title:
+                    candidates = load_graph_filter_index(root).search_titles(title, 10)
+                    if candidates:
+                        st.caption("候補: " + ", ".join(candidates))
+                return
+            view = index.k_hop(title, k, max_nodes=max_nodes)
+        elif mode == "フィルタ":
+            filter_index = load_graph_filter_index(root)
+            graph_filter = filter_controls(filter_index)
+            view = filter_index.query(graph_filter)
+            st.caption(f"{len(view.nodes)} entities, {len(view.edges)} edges")
+        else:
+            if len(index.titles) > FULL_GRAPH_MAX_NODES:
+                st.warning(
+                    f"entityが{FULL_GRAPH_MAX_NODES}件を超えるため全体は表示できません。"
+                    "CommunityまたはEntityの近傍を表示してください。"
+                )
+                return
+            col1, col2 = st.columns(2)
+            level = col1.selectbox("Community level", options=index.levels)
+            min_weight = col2.number_input(
+                "表示するedgeの最小weight", min_value=0.0, value=0.0, step=0.5
+            )
+            view = None
 
-    nodes = convert_entities_to_nodes(entity_df)
-    edges = convert_relationships_to_edges(relationship_df)
+    if view is None:
+        payload = load_graph_payload(root, level, min_weight)
+    else:
+        if view.truncated:
+            st.caption("表示する要素数の上限に達したため、一部のみを表示しています。")
+        payload = GraphPayload(*view_records(view))
 
     config = Config(
         width=2000,
@@ -80,7 +147,17 @@ def visualization():
         collapsible=True,
     )
     with st.container(border=True):
-        agraph(nodes=nodes, edges=edges, config=config)
+        selected = render_payload(payload, config)
+
+    # community: クリックでそのcommunityを展開、entity: クリックで近傍表示の対象にする
+    if selected:
+        if selected.startswith("community:"):
+            community = selected.removeprefix("community:")
+            if st.session_state.get("expanded_community") != community:
+                st.session_state["expanded_community"] = community
+                st.rerun()
+        elif st.session_state.get("focused_entity") != selected:
+            st.session_state["focused_entity"] = selected
 
 
 if __name__ == "__main__":